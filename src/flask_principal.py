@@ -14,19 +14,41 @@ from __future__ import with_statement
 
 __version__ = '0.4.0'
 
+import asyncio
+import contextvars
+import copy
+import csv
+import hashlib
+import heapq
+import json
+import mmap
+import os
 import sys
-
-from functools import partial, wraps
-from collections import deque
-from typing import cast, Any, Callable, Deque, Dict, Optional, Set, Tuple, TypeVar, Union, cast
+import threading
+import time
+import weakref
+
+from array import array
+from bisect import bisect_left
+from concurrent import futures
+from functools import lru_cache, partial, wraps
+from itertools import islice
+from inspect import iscoroutinefunction
+from types import MappingProxyType
+from collections import Counter, deque, OrderedDict
+from typing import cast, Any, Awaitable, Callable, Deque, Dict, Hashable, Iterable, Iterator, Mapping, Optional, Set, Tuple, TypeVar, Union, cast
 from collections import namedtuple
 
-from flask import g, session, current_app, abort, request
+from flask import g, session, current_app, abort, request, has_app_context, \
+    has_request_context
+from flask.sessions import SecureCookieSessionInterface
 from blinker.base import Namespace
-from flask import Flask
+from flask import Blueprint, Flask, Request
 
 PY3 = sys.version_info[0] == 3
 
+F = TypeVar('F', bound=Callable[..., Any])
+
 signals = Namespace()
 
 
@@ -47,6 +69,9 @@ For example::
         username = req.form.get('username')
         # check the credentials
         identity_changed.send(app, identity=Identity(username))
+
+Sending an identity equal to the current one is a no-op, unless the signal is
+sent with ``force=True``.
 """)
 
 
@@ -119,10 +144,954 @@ are.
 """
 
 
+class PredicateNeed(object):
+    """A need met when a function of the identity returns true.
+
+    Predicate needs express rules on request time attributes, such as the
+    remote address or the time of day, and are used in permissions like
+    other needs::
+
+        def from_office(identity):
+            return request.remote_addr.startswith('10.1.')
+
+        office_admin = Permission(RoleNeed('admin')) & \\
+            Permission(PredicateNeed(from_office))
+
+    A permission only calls its predicates when its static needs and
+    excludes do not decide, cheapest ``cost`` first, and each predicate is
+    called at most once per identity and request. Permissions with
+    predicates have no :meth:`BasePermission.cache_key`.
+
+    :param func: The function, called with the identity
+    :param cost: The relative cost of calling the function
+    :param name: The name of the predicate, the function's by default
+    """
+
+    def __init__(self, func: Callable[['Identity'], bool], cost: float = 1,
+                 name: Optional[str] = None) -> None:
+        self.func = func
+        self.cost = cost
+        self.name = name or getattr(func, '__name__', repr(func))
+
+    def __call__(self, identity: 'Identity') -> bool:
+        if not has_request_context():
+            return bool(self.func(identity))
+        memo = g.get('_principal_predicates')
+        if memo is None:
+            memo = g._principal_predicates = weakref.WeakKeyDictionary()
+        try:
+            results = memo.get(identity)
+            if results is None:
+                results = memo[identity] = {}
+        except TypeError:
+            # not weakly referenceable, or unhashable
+            return bool(self.func(identity))
+        result = results.get(self)
+        if result is None:
+            result = results[self] = bool(self.func(identity))
+        return result
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self.name} cost={self.cost}>'
+
+
+def _predicates(needs: Iterable[Any]) -> list:
+    """The predicate needs among the needs, cheapest first."""
+    return sorted((n for n in needs if isinstance(n, PredicateNeed)),
+                  key=lambda n: n.cost)
+
+
+def _cost(permission: 'BasePermission') -> float:
+    """The cost of the predicates a permission may call."""
+    if isinstance(permission, Permission):
+        # predicate needs are not typed among the needs of permissions
+        needs: Iterable[Any] = permission.perms
+        return sum(n.cost for n in needs if isinstance(n, PredicateNeed))
+    if isinstance(permission, _NaryOperatorPermission):
+        return sum(map(_cost, permission.permissions))
+    if isinstance(permission, NotPermission):
+        return _cost(permission.permission)
+    return 0
+
+
+@lru_cache(maxsize=65536, typed=True)
+def _need_digest(need: Any) -> int:
+    """A digest of a need that is the same in every process, for needs
+    whose ``repr`` is.
+    """
+    if isinstance(need, tuple):
+        data = repr(tuple(need))
+    else:
+        cls = type(need)
+        data = f'{cls.__module__}.{cls.__qualname__}:{need!r}'
+    return int.from_bytes(
+        hashlib.blake2b(data.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _digest_of(needs: Iterable[Any]) -> int:
+    digest = 0
+    for need in needs:
+        digest ^= _need_digest(need)
+    return digest
+
+
+def _encode_into(value: Any, parts: list) -> bool:
+    if value is None:
+        parts.append(b'n')
+        return True
+    if isinstance(value, tuple):
+        parts.append(b't' + len(value).to_bytes(4, 'little'))
+        return all(_encode_into(v, parts) for v in value)
+    if isinstance(value, str):
+        tag, data = b's', value.encode('utf-8', 'surrogatepass')
+    elif isinstance(value, bytes):
+        tag, data = b'b', value
+    elif isinstance(value, (int, float)):
+        # equal numbers, such as 1, 1.0 and True, are encoded alike
+        if isinstance(value, float) and not value.is_integer():
+            if value != value:
+                return False
+            tag, data = b'f', repr(value).encode('ascii')
+        else:
+            try:
+                tag, data = b'i', str(int(value)).encode('ascii')
+            except ValueError:
+                return False
+    else:
+        return False
+    parts.append(tag + len(data).to_bytes(4, 'little') + data)
+    return True
+
+
+@lru_cache(maxsize=65536)
+def _encode_need(need: Any) -> Optional[bytes]:
+    """An encoding of a need, the same for equal needs and different for
+    different ones, or ``None`` if it holds other values than strings,
+    bytes, numbers, ``None`` and tuples of them.
+    """
+    parts: list = []
+    return b''.join(parts) if _encode_into(need, parts) else None
+
+
+def _need_entry(need: Any) -> Optional[Tuple[int, bytes]]:
+    """The digest and encoding of a need, or ``None`` if it has none."""
+    try:
+        encoding = _encode_need(need)
+    except TypeError:
+        return None
+    if encoding is None:
+        return None
+    return _need_digest(need), encoding
+
+
+def _holds(digests: Any, offsets: Any, blob: Any, digest: int, encoding: bytes) -> bool:
+    """Whether sorted need digests, and the encodings of the needs at
+    ``blob[offsets[i]:offsets[i + 1]]``, hold a need.
+    """
+    i = bisect_left(digests, digest)
+    n = len(digests)
+    while i < n and digests[i] == digest:
+        if blob[offsets[i]:offsets[i + 1]] == encoding:
+            return True
+        i += 1
+    return False
+
+
+class Provides(set):
+    """The set of needs provided by an identity.
+
+    This is a regular set that also maintains a digest of its needs as they
+    are added and removed, see :meth:`fingerprint`.
+
+    Needs may be granted for a limited time with :meth:`grant`. Expired
+    needs are removed by :meth:`purge`, which is called when the earliest
+    expiry has passed and the set is checked with ``in``, iterated, or
+    copied by the extension. Set operations and copies taking the set as an
+    argument, such as ``needs & identity.provides`` or ``set(provides)``,
+    read it directly and only see needs removed until then: call
+    :meth:`purge` before them.
+    """
+
+    def __init__(self, needs: Iterable[Any] = ()) -> None:
+        _purge_expired(needs)
+        set.__init__(self, needs)
+        self._key: Optional[frozenset] = None
+        self._digest = _digest_of(self)
+        #: The expiry of the needs granted for a limited time, and a heap of
+        #: ``(expiry, need)`` that may still hold replaced expiries.
+        self._expiry: Dict[Any, float] = {}
+        self._heap: list = []
+        if isinstance(needs, Provides) and needs._expiry:
+            for need, expires_at in needs._expiry.items():
+                self.grant(need, expires_at=expires_at)
+
+    @property
+    def _digest(self) -> int:
+        return self._xor
+
+    @_digest.setter
+    def _digest(self, digest: int) -> None:
+        # the needs changed, so does their key, see _needs_key()
+        self._xor = digest
+        self._key = None
+
+    def fingerprint(self) -> str:
+        """A digest of the needs, the same for equal sets in every process.
+
+        Needs are digested from their ``repr``, so distinct needs with the
+        same ``repr`` are not told apart, and, like any digest, different
+        sets may share a fingerprint. Do not take equal fingerprints for
+        equal permissions where that matters, :class:`DecisionCache` does
+        not.
+        """
+        _purge_expired(self)
+        return '{0:016x}-{1}'.format(self._digest, len(self))
+
+    def copy(self) -> 'Provides':
+        return Provides(self)
+
+    def __contains__(self, need: object) -> bool:
+        _purge_expired(self)
+        return set.__contains__(self, need)
+
+    def __iter__(self) -> Iterator[Any]:
+        _purge_expired(self)
+        return set.__iter__(self)
+
+    def grant(self, need: Any, ttl: Optional[float] = None,
+              expires_at: Optional[float] = None) -> None:
+        """Add a need until it expires, for example::
+
+            identity.provides.grant(RoleNeed('admin'), ttl=30 * 60)
+
+        Granting a provided need again sets its expiry, adding it makes it
+        permanent.
+
+        :param need: The need
+        :param ttl: How long, in seconds, the need is provided
+        :param expires_at: When the need expires, as a :func:`time.time`
+                           timestamp
+        """
+        if expires_at is None:
+            if ttl is None:
+                raise TypeError('grant() needs a ttl or an expiry')
+            expires_at = time.time() + ttl
+        if not set.__contains__(self, need):
+            set.add(self, need)
+            self._digest ^= _need_digest(need)
+        self._expiry[need] = expires_at
+        heapq.heappush(self._heap, (expires_at, id(need), need))
+
+    def expiry(self, need: Any) -> Optional[float]:
+        """When a provided need expires, or ``None`` if it does not."""
+        _purge_expired(self)
+        return self._expiry.get(need) if set.__contains__(self, need) else None
+
+    def expiring(self) -> Dict[Any, float]:
+        """The expiry of each provided need that expires."""
+        _purge_expired(self)
+        return {n: t for n, t in self._expiry.items()
+                if set.__contains__(self, n)}
+
+    def expires_at(self) -> Optional[float]:
+        """When the first provided need expires, or ``None``."""
+        heap, expiry = self._heap, self._expiry
+        while heap and (not set.__contains__(self, heap[0][2])
+                        or expiry.get(heap[0][2]) != heap[0][0]):
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def purge(self, now: Optional[float] = None) -> int:
+        """Remove the expired needs.
+
+        Returns the number of needs removed.
+
+        :param now: The current :func:`time.time`
+        """
+        if now is None:
+            now = time.time()
+        heap, expiry = self._heap, self._expiry
+        removed = 0
+        while heap and heap[0][0] <= now:
+            expires_at, _, need = heapq.heappop(heap)
+            if expiry.get(need) == expires_at:
+                del expiry[need]
+                if set.__contains__(self, need):
+                    set.discard(self, need)
+                    self._digest ^= _need_digest(need)
+                    removed += 1
+        return removed
+
+    def add(self, need: Any) -> None:
+        if self._expiry:
+            self._expiry.pop(need, None)
+        if not set.__contains__(self, need):
+            set.add(self, need)
+            self._digest ^= _need_digest(need)
+
+    def discard(self, need: Any) -> None:
+        if set.__contains__(self, need):
+            set.discard(self, need)
+            self._digest ^= _need_digest(need)
+
+    def remove(self, need: Any) -> None:
+        set.remove(self, need)
+        self._digest ^= _need_digest(need)
+
+    def pop(self) -> Any:
+        need = set.pop(self)
+        self._digest ^= _need_digest(need)
+        return need
+
+    def clear(self) -> None:
+        set.clear(self)
+        self._digest = 0
+        self._expiry.clear()
+        del self._heap[:]
+
+    def update(self, *others: Iterable[Any]) -> None:
+        for other in others:
+            added = set(other)
+            if self._expiry:
+                for need in added:
+                    self._expiry.pop(need, None)
+            added.difference_update(self)
+            set.update(self, added)
+            self._digest ^= _digest_of(added)
+
+    def difference_update(self, *others: Iterable[Any]) -> None:
+        for other in others:
+            removed = self.intersection(other)
+            set.difference_update(self, removed)
+            self._digest ^= _digest_of(removed)
+
+    def intersection_update(self, *others: Iterable[Any]) -> None:
+        removed = self.difference(self.intersection(*others))
+        set.difference_update(self, removed)
+        self._digest ^= _digest_of(removed)
+
+    def symmetric_difference_update(self, other: Iterable[Any]) -> None:
+        other = set(other)
+        if self._expiry:
+            for need in other:
+                self._expiry.pop(need, None)
+        set.symmetric_difference_update(self, other)
+        self._digest ^= _digest_of(other)
+
+    def __ior__(self, other: Any) -> 'Provides':  # type: ignore
+        self.update(other)
+        return self
+
+    def __iand__(self, other: Any) -> 'Provides':  # type: ignore
+        self.intersection_update(other)
+        return self
+
+    def __isub__(self, other: Any) -> 'Provides':  # type: ignore
+        self.difference_update(other)
+        return self
+
+    def __ixor__(self, other: Any) -> 'Provides':  # type: ignore
+        self.symmetric_difference_update(other)
+        return self
+
+
+class CompactProvides(object):
+    """A read-only set of needs using a fraction of the memory of a set,
+    for identities providing millions of needs.
+
+    Needs are kept as their sorted 64 bit digests (see
+    :meth:`Provides.fingerprint`), in an array searched by bisection, and
+    their encodings, in a single bytes object. It answers ``need in
+    provides`` and :meth:`contains_any`, which permissions use instead of
+    intersecting sets, but cannot list its needs. Assign it to an identity
+    in place of its provides::
+
+        @identity_loaded.connect_via(app)
+        def on_identity_loaded(sender, identity):
+            identity.provides = CompactProvides(needs_of(identity.id))
+
+    Needs are found by digest and confirmed by comparing their encoding,
+    which is exact for needs made of strings, bytes, numbers, ``None`` and
+    tuples of them, such as :class:`ItemNeed`. Other needs are kept as they
+    are, in a regular set.
+
+    :param needs: The needs
+    """
+
+    def __init__(self, needs: Iterable[Any] = ()) -> None:
+        digest = _need_digest.__wrapped__  # type: ignore
+        encode = _encode_need.__wrapped__  # type: ignore
+        entries = set()
+        others = set()
+        for need in needs:
+            encoding = encode(need)
+            if encoding is None:
+                others.add(need)
+            else:
+                entries.add((digest(need), encoding))
+        self._init(sorted(entries), others)
+
+    def _init(self, entries: list, others: Iterable[Any]) -> None:
+        self._digests = array('Q', [d for d, _ in entries])
+        self._offsets = array('Q', [0])
+        position = 0
+        for _, encoding in entries:
+            position += len(encoding)
+            self._offsets.append(position)
+        self._blob = b''.join(e for _, e in entries)
+        self._others = frozenset(others)
+        self._xor = _digest_of_digests(self._digests) ^ _digest_of(self._others)
+
+    def _entries(self) -> Iterator[Tuple[int, bytes]]:
+        """The digests and encodings of the needs."""
+        offsets, blob = self._offsets, self._blob
+        for i, digest in enumerate(self._digests):
+            yield digest, blob[offsets[i]:offsets[i + 1]]
+
+    def __contains__(self, need: Any) -> bool:
+        try:
+            encoding = _encode_need(need)
+        except TypeError:
+            return False
+        if encoding is None:
+            return need in self._others
+        return _holds(self._digests, self._offsets, self._blob,
+                      _need_digest(need), encoding)
+
+    def contains_any(self, needs: Iterable[Any]) -> bool:
+        """Whether any of the needs is provided."""
+        return any(need in self for need in needs)
+
+    def intersection(self, needs: Iterable[Any]) -> Set[Any]:
+        """The needs provided among ``needs``."""
+        return {need for need in needs if need in self}
+
+    def digests(self) -> array:
+        """The sorted digests of the needs, but those kept in a set."""
+        return self._digests
+
+    def save(self, f: Any) -> None:
+        """Write the needs to a binary file, which :class:`MappedNeedFile`
+        can read: their number, sorted digests, the offsets of their
+        encodings and the encodings.
+
+        :param f: The file
+        """
+        if self._others:
+            raise TypeError('Only needs made of strings, bytes, numbers, None '
+                            'and tuples of them can be saved')
+        array('Q', [len(self._digests)]).tofile(f)
+        self._digests.tofile(f)
+        self._offsets.tofile(f)
+        f.write(self._blob)
+
+    def with_changes(self, add: Iterable[Any] = (), remove: Iterable[Any] = ()) -> 'CompactProvides':
+        """A copy with needs added and removed.
+
+        :param add: The needs to add
+        :param remove: The needs to remove
+        """
+        changes = CompactProvides(remove)
+        removed = set(changes._entries())
+        entries = {e for e in self._entries() if e not in removed}
+        others = self._others - changes._others
+        changes = CompactProvides(add)
+        entries.update(changes._entries())
+        provides = CompactProvides.__new__(CompactProvides)
+        provides._init(sorted(entries), others | changes._others)
+        return provides
+
+    def fingerprint(self) -> str:
+        """The same digest as :meth:`Provides.fingerprint` for the same
+        needs.
+        """
+        return '{0:016x}-{1}'.format(self._xor, len(self))
+
+    def __len__(self) -> int:
+        return len(self._digests) + len(self._others)
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} needs={len(self)}>'
+
+
+def _digest_of_digests(digests: Iterable[int]) -> int:
+    result = 0
+    for d in digests:
+        result ^= d
+    return result
+
+
+class LazyProvides(object):
+    """A read-only set of needs looked up in a backend when checked.
+
+    Permissions ask it whether any of their needs is provided with
+    :meth:`contains_any`, which looks up all the needs it does not already
+    know about in a single backend query. The answers are kept in a small
+    lookaside cache, and its fingerprint and length are read once, each
+    identity given these provisions by :class:`Principal` gets its own copy.
+    See :class:`SQLiteNeedStore` and :class:`MappedNeedFile` for the
+    backends. They hold the digests and encodings of needs made of strings,
+    bytes, numbers, ``None`` and tuples of them (see :class:`CompactProvides`),
+    other needs are never provided but through :meth:`with_changes`.
+
+    :param backend: The backend, with ``lookup(entries)`` returning the
+                    entries it holds among the sorted ``(digest, encoding)``
+                    ``entries``, and ``summary()`` returning the digest and
+                    number of all its needs
+    :param maxsize: The maximum number of needs kept in the lookaside cache
+    """
+
+    def __init__(self, backend: Any, maxsize: int = 1024) -> None:
+        self.backend = backend
+        self.maxsize = maxsize
+        self._known: Dict[Any, bool] = {}
+        self._added: frozenset = frozenset()
+        self._removed: frozenset = frozenset()
+        self._summary: Optional[Tuple[int, int]] = None
+        #: The number of backend queries made
+        self.lookups = 0
+
+    def copy(self) -> 'LazyProvides':
+        """A copy with an empty lookaside cache."""
+        provides = LazyProvides(self.backend, self.maxsize)
+        provides._added, provides._removed = self._added, self._removed
+        return provides
+
+    def _lookup(self, needs: Iterable[Any]) -> Dict[Any, bool]:
+        """Whether each of the needs is provided, looking up those not
+        already known in a single backend query.
+        """
+        known = self._known
+        found = {}
+        unknown = {}
+        for need in needs:
+            if need in self._added:
+                found[need] = True
+            elif need in self._removed:
+                found[need] = False
+            elif need in known:
+                found[need] = known[need]
+            else:
+                entry = _need_entry(need)
+                if entry is None:
+                    found[need] = False
+                else:
+                    unknown[entry] = need
+        if not unknown:
+            return found
+
+        self.lookups += 1
+        held = self.backend.lookup(sorted(unknown))
+        if len(known) + len(unknown) > self.maxsize:
+            known.clear()
+        for entry, need in unknown.items():
+            found[need] = entry in held
+            if len(known) < self.maxsize:
+                known[need] = found[need]
+        return found
+
+    def contains_any(self, needs: Iterable[Any]) -> bool:
+        """Whether any of the needs is provided."""
+        unknown = []
+        for need in needs:
+            if need in self._added:
+                return True
+            if need in self._removed:
+                continue
+            found = self._known.get(need)
+            if found:
+                return True
+            if found is None:
+                unknown.append(need)
+        return any(self._lookup(unknown).values()) if unknown else False
+
+    def intersection(self, needs: Iterable[Any]) -> Set[Any]:
+        """The needs provided among ``needs``, looked up in a single backend
+        query.
+        """
+        return {need for need, found in self._lookup(needs).items() if found}
+
+    def __contains__(self, need: Any) -> bool:
+        return self.contains_any((need,))
+
+    def with_changes(self, add: Iterable[Any] = (), remove: Iterable[Any] = ()) -> 'LazyProvides':
+        """A copy with needs added and removed, the backend is unchanged.
+
+        :param add: The needs to add
+        :param remove: The needs to remove
+        """
+        add, remove = frozenset(add), frozenset(remove)
+        provides = self.copy()
+        provides._added = (self._added - remove) | add
+        provides._removed = (self._removed - add) | remove
+        return provides
+
+    def _changes(self) -> Tuple[list, list]:
+        """The digests the changes add to, and remove from, the backend's."""
+        entries = {}
+        added = []
+        for need in self._added | self._removed:
+            entry = _need_entry(need)
+            if entry is not None:
+                entries[entry] = need
+            elif need in self._added:
+                # the backend cannot hold it
+                added.append(_need_digest(need))
+        self.lookups += 1
+        held = self.backend.lookup(sorted(entries))
+        added.extend(e[0] for e, n in entries.items()
+                     if n in self._added and e not in held)
+        removed = [e[0] for e, n in entries.items()
+                   if n in self._removed and e in held]
+        return added, removed
+
+    def _digests_summary(self) -> Tuple[int, int]:
+        """The digest and number of the needs, read from the backend once."""
+        if self._summary is None:
+            self.lookups += 1
+            xor, count = self.backend.summary()
+            if self._added or self._removed:
+                added, removed = self._changes()
+                xor ^= _digest_of_digests(added + removed)
+                count += len(added) - len(removed)
+            self._summary = (xor, count)
+        return self._summary
+
+    def fingerprint(self) -> str:
+        """The same digest as :meth:`Provides.fingerprint` for the same
+        needs.
+        """
+        return '{0:016x}-{1}'.format(*self._digests_summary())
+
+    def __len__(self) -> int:
+        return self._digests_summary()[1]
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} backend={self.backend!r}>'
+
+
+def _signed(digest: int) -> int:
+    """A digest as an SQLite integer."""
+    return digest - (1 << 64) if digest >= 1 << 63 else digest
+
+
+class SQLiteNeedStore(object):
+    """Keeps the needs of identities in an SQLite database, for
+    :class:`LazyProvides`.
+
+    Needs are stored as their digests and encodings, so only needs made of
+    strings, bytes, numbers, ``None`` and tuples of them can be, along with
+    the digest and number of the needs of each identity so fingerprints do
+    not read them all. For example::
+
+        store = SQLiteNeedStore(sqlite3.connect('grants.db'))
+        store.grant(user.id, [ItemNeed('read', post.id, 'posts')])
+
+        @identity_loaded.connect_via(app)
+        def on_identity_loaded(sender, identity):
+            identity.provides = store.provides(identity.id)
+
+    The connection must be usable from the threads checking permissions.
+
+    :param connection: The database connection
+    :param table: The prefix of the tables' names
+    """
+
+    def __init__(self, connection: Any, table: str = 'principal_needs') -> None:
+        self.connection = connection
+        self.table = table
+        with connection:
+            connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} ('
+                'identity, digest INTEGER, need BLOB,'
+                ' PRIMARY KEY (identity, digest, need)) WITHOUT ROWID')
+            connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {table}_digests ('
+                'identity PRIMARY KEY, xor INTEGER, count INTEGER)')
+
+    def grant(self, identity_id: Any, needs: Iterable[Any]) -> None:
+        """Add needs to an identity.
+
+        :param identity_id: The id of the identity
+        :param needs: The needs
+        :raises TypeError: If a need is not made of strings, bytes, numbers,
+                           ``None`` and tuples of them
+        """
+        self._change(identity_id, needs, True)
+
+    def revoke(self, identity_id: Any, needs: Iterable[Any]) -> None:
+        """Remove needs from an identity.
+
+        :param identity_id: The id of the identity
+        :param needs: The needs
+        """
+        self._change(identity_id, needs, False)
+
+    def _change(self, identity_id: Any, needs: Iterable[Any], grant: bool) -> None:
+        digest = _need_digest.__wrapped__  # type: ignore
+        encode = _encode_need.__wrapped__  # type: ignore
+        unique = set()
+        for need in needs:
+            encoding = encode(need)
+            if encoding is not None:
+                unique.add((digest(need), encoding))
+            elif grant:
+                raise TypeError(f'{need!r} cannot be stored')
+        entries = sorted(unique)
+        backend = _SQLiteIdentityNeeds(self, identity_id)
+        connection = self.connection
+        with connection:
+            if not connection.in_transaction:
+                # take the write lock before reading, so concurrent changes
+                # cannot interleave with the digests read here
+                connection.execute('BEGIN IMMEDIATE')
+            held = backend.lookup(entries)
+            changed = [e for e in entries if (e in held) is not grant]
+            if not changed:
+                return
+            xor, count = backend.summary()
+            xor ^= _digest_of_digests(d for d, _ in changed)
+            count += len(changed) if grant else -len(changed)
+            rows = [(identity_id, _signed(d), e) for d, e in changed]
+            if grant:
+                connection.executemany(
+                    f'INSERT INTO {self.table} VALUES (?, ?, ?)', rows)
+            else:
+                connection.executemany(
+                    f'DELETE FROM {self.table}'
+                    ' WHERE identity = ? AND digest = ? AND need = ?',
+                    rows)
+            connection.execute(
+                f'INSERT OR REPLACE INTO {self.table}_digests VALUES (?, ?, ?)',
+                (identity_id, _signed(xor), count))
+
+    def provides(self, identity_id: Any, maxsize: int = 1024) -> LazyProvides:
+        """The needs of an identity, looked up when checked.
+
+        :param identity_id: The id of the identity
+        :param maxsize: The size of the lookaside cache
+        """
+        return LazyProvides(_SQLiteIdentityNeeds(self, identity_id), maxsize)
+
+
+class _SQLiteIdentityNeeds(object):
+    """The :class:`LazyProvides` backend of an identity's stored needs."""
+
+    #: The most parameters of a query, the default limit of old SQLite
+    batch = 999
+
+    def __init__(self, store: SQLiteNeedStore, identity_id: Any) -> None:
+        self.store = store
+        self.identity_id = identity_id
+
+    def lookup(self, entries: list) -> Set[Tuple[int, bytes]]:
+        held: Set[Tuple[int, bytes]] = set()
+        table = self.store.table
+        for i in range(0, len(entries), self.batch - 1):
+            chunk = [_signed(d) for d, _ in entries[i:i + self.batch - 1]]
+            rows = self.store.connection.execute(
+                f'SELECT digest, need FROM {table} WHERE identity = ? AND digest IN '
+                f'({", ".join("?" * len(chunk))})',
+                [self.identity_id] + chunk)
+            held.update((d & 0xffffffffffffffff, bytes(e)) for d, e in rows)
+        return held.intersection(entries)
+
+    def summary(self) -> Tuple[int, int]:
+        row = self.store.connection.execute(
+            f'SELECT xor, count FROM {self.store.table}_digests WHERE identity = ?',
+            (self.identity_id,)).fetchone()
+        return (row[0] & 0xffffffffffffffff, row[1]) if row else (0, 0)
+
+    def __repr__(self) -> str:
+        return f'<SQLite needs of {self.identity_id!r}>'
+
+
+class MappedNeedFile(object):
+    """A file of needs, as written by :meth:`CompactProvides.save`, memory mapped for :class:`LazyProvides`.
+
+    The file is only read as needs are looked up, so processes share the
+    pages holding it. For example::
+
+        with open('service.needs', 'wb') as f:
+            CompactProvides(needs).save(f)
+
+        service_needs = MappedNeedFile('service.needs')
+
+        @identity_loaded.connect_via(app)
+        def on_identity_loaded(sender, identity):
+            if identity.id == 'service':
+                identity.provides = service_needs.provides()
+
+    The file is in the byte order of the machine writing it.
+
+    :param path: The path of the file
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if size else None
+        self._view = memoryview(self._mmap if self._mmap is not None else b'')
+        count = self._view[:8].cast('Q')[0] if size else 0
+        digests_end = 8 + 8 * count
+        offsets_end = digests_end + 8 * (count + 1)
+        self._digests = self._view[8:digests_end].cast('Q')
+        self._offsets = self._view[digests_end:offsets_end].cast('Q')
+        self._blob = self._view[offsets_end:]
+        self._xor: Optional[int] = None
+
+    def lookup(self, entries: list) -> Set[Tuple[int, bytes]]:
+        return {entry for entry in entries
+                if _holds(self._digests, self._offsets, self._blob, *entry)}
+
+    def summary(self) -> Tuple[int, int]:
+        if self._xor is None:
+            self._xor = _digest_of_digests(self._digests)
+        return self._xor, len(self._digests)
+
+    def provides(self, maxsize: int = 1024) -> LazyProvides:
+        """The needs of the file, looked up when checked.
+
+        :param maxsize: The size of the lookaside cache
+        """
+        return LazyProvides(self, maxsize)
+
+    def close(self) -> None:
+        """Unmap the file."""
+        for view in (self._digests, self._offsets, self._blob, self._view):
+            view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self.path!r}>'
+
+
+def _intersects(needs: Set[Any], provides: Any) -> bool:
+    """Whether any of the needs is provided."""
+    if isinstance(provides, (set, frozenset)):
+        # CPython only takes the fast path when the argument is an exact
+        # set, provides is usually a subclass
+        return not provides.isdisjoint(needs)
+    contains_any = getattr(provides, 'contains_any', None)
+    if contains_any is not None:
+        return bool(contains_any(needs))
+    return bool(needs.intersection(provides))
+
+
+class _FrozenProvides(frozenset):
+    """An immutable copy of a provides set, keeping the expiry of the needs
+    granted for a limited time. Expired needs are left out of ``in`` checks,
+    :meth:`isdisjoint` and iteration.
+    """
+
+    #: The expiry of the needs granted for a limited time
+    expiries: Mapping[Any, float] = MappingProxyType({})
+    _key: Optional[frozenset] = None
+
+    def __contains__(self, need: object) -> bool:
+        if not frozenset.__contains__(self, need):
+            return False
+        expires_at = self.expiries.get(need) if self.expiries else None
+        return expires_at is None or expires_at > time.time()
+
+    def __iter__(self) -> Iterator[Any]:
+        if not self.expiries:
+            return frozenset.__iter__(self)
+        now = time.time()
+        expiries = self.expiries
+        return (n for n in frozenset.__iter__(self) if expiries.get(n, now + 1) > now)
+
+    def isdisjoint(self, other: Iterable[Any]) -> bool:
+        if not self.expiries:
+            return frozenset.isdisjoint(self, other)
+        return not any(need in self for need in other)
+
+    def expiry(self, need: Any) -> Optional[float]:
+        """When a provided need expires, or ``None`` if it does not."""
+        return self.expiries.get(need) if need in self else None
+
+    def expiring(self) -> Dict[Any, float]:
+        """The expiry of each provided need that expires."""
+        now = time.time()
+        return {n: t for n, t in self.expiries.items() if t > now}
+
+
+def _with_expiries(needs: Iterable[Any], expiries: Optional[Mapping[Any, float]]) -> _FrozenProvides:
+    """Needs as a :class:`_FrozenProvides` expiring as in ``expiries``."""
+    frozen = _FrozenProvides(needs)
+    if expiries:
+        frozen.expiries = MappingProxyType(
+            {n: t for n, t in expiries.items() if frozenset.__contains__(frozen, n)})
+    return frozen
+
+
+def _frozen(provides: Any) -> Any:
+    """An immutable copy of a provides set, or the set if read-only."""
+    if isinstance(provides, (CompactProvides, LazyProvides, _FrozenProvides)):
+        return provides
+    _purge_expired(provides)
+    if isinstance(provides, Provides) and provides._expiry:
+        return _with_expiries(provides, provides.expiring())
+    return _FrozenProvides(provides)
+
+
+def _update_provides(provides: Provides, frozen: Any) -> None:
+    """Add the needs of a copy made by :func:`_frozen` to a provides set,
+    granting those that expire until their expiry.
+    """
+    expiries = getattr(frozen, 'expiries', None)
+    if not expiries:
+        provides.update(frozen)
+        return
+    provides.update(frozenset.difference(frozen, expiries))
+    now = time.time()
+    for need, expires_at in expiries.items():
+        if expires_at > now:
+            provides.grant(need, expires_at=expires_at)
+
+
+def _merge_provisions(identity: Any, provides: Any) -> None:
+    """Give an identity the needs of a copy made by :func:`_frozen`."""
+    if isinstance(provides, CompactProvides):
+        identity.provides = provides
+    elif isinstance(provides, LazyProvides):
+        identity.provides = provides.copy()
+    else:
+        _update_provides(identity.provides, provides)
+
+
+def _partition(identity: Any) -> Optional[Any]:
+    """The needs an identity provides within its active tenant, if any."""
+    tenant = getattr(identity, 'tenant', None)
+    if tenant is None:
+        return None
+    partition = identity.tenant_provides.get(tenant)
+    if partition is not None:
+        _purge_expired(partition)
+    return partition
+
+
+def _purge_expired(provides: Any) -> None:
+    """Remove the expired needs of ``provides``, if they are due."""
+    heap = getattr(provides, '_heap', None)
+    if heap and heap[0][0] <= time.time():
+        provides.purge()
+
+
 class PermissionDenied(RuntimeError):
     """Permission denied to the resource"""
 
 
+class DeadlineExceeded(RuntimeError):
+    """An identity loader or provision receiver ran out of time"""
+
+
 class IdentityContext(object):
     """The context of an identity for a permission.
 
@@ -132,18 +1101,33 @@ class IdentityContext(object):
     The principal behaves as either a context manager or a decorator. The
     permission is checked for provision in the identity, and if available the
     flow is continued (context manager) or the function is executed (decorator).
+
+    Coroutine functions, such as async views, are decorated with coroutine
+    functions, and the principal may also be used as an async context
+    manager.
+
+    A principal bound to an ``identity`` checks it instead of the request's
+    identity, and works outside of Flask contexts.
     """
 
-    def __init__(self, permission: 'BasePermission', http_exception: Optional[int] = None) -> None:
+    def __init__(
+        self,
+        permission: 'BasePermission',
+        http_exception: Optional[int] = None,
+        identity: Optional['Identity'] = None
+    ) -> None:
         self.permission = permission
         self.http_exception = http_exception
         """The permission of this principal
         """
+        self._identity = identity
 
     @property
     def identity(self) -> 'Identity':
         """The identity of this principal
         """
+        if self._identity is not None:
+            return self._identity
         return cast(Identity, g.identity)
 
     def can(self) -> bool:
@@ -152,6 +1136,14 @@ class IdentityContext(object):
         return self.identity.can(self.permission)
 
     def __call__(self, f: Callable[..., Any]) -> Callable[..., Any]:
+        if iscoroutinefunction(f):
+            @wraps(f)
+            async def _decorated_async(*args: Any, **kw: Any) -> Any:
+                with self:
+                    rv = await f(*args, **kw)
+                return rv
+            return _decorated_async
+
         @wraps(f)
         def _decorated(*args: Any, **kw: Any) -> Any:
             with self:
@@ -159,6 +1151,12 @@ class IdentityContext(object):
             return rv
         return _decorated
 
+    async def __aenter__(self) -> None:
+        self.__enter__()
+
+    async def __aexit__(self, *args: Any) -> None:
+        self.__exit__(*args)
+
     def __enter__(self) -> None:
         # check the permission here
         if not self.can():
@@ -212,7 +1210,11 @@ class BasePermission:
     def invert(self) -> Union['NotPermission', 'BasePermission']:
         return NotPermission(self)
 
-    def require(self, http_exception: Optional[int] = None) -> IdentityContext:
+    def require(
+        self,
+        http_exception: Optional[int] = None,
+        identity: Optional['Identity'] = None
+    ) -> IdentityContext:
         """Create a principal for this permission.
 
         The principal may be used as a context manager, or a decroator.
@@ -223,14 +1225,16 @@ class BasePermission:
         requirements.
 
         :param http_exception: the HTTP exception code (403, 401 etc)
+        :param identity: The identity to check, the request's identity by
+                         default
         """
 
         if http_exception is None:
             http_exception = self.http_exception
 
-        return IdentityContext(self, http_exception)
+        return IdentityContext(self, http_exception, identity)
 
-    def test(self, http_exception: Optional[int] = None) -> None:
+    def test(self, http_exception: Optional[int] = None, identity: Optional['Identity'] = None) -> None:
         """
         Checks if permission available and raises relevant exception
         if not. This is useful if you just want to check permission
@@ -242,7 +1246,7 @@ class BasePermission:
                 pass
         """
 
-        with self.require(http_exception):
+        with self.require(http_exception, identity):
             pass
 
     def allows(self, identity: 'Identity') -> bool:
@@ -253,13 +1257,38 @@ class BasePermission:
 
         raise NotImplementedError
 
-    def can(self) -> bool:
+    def cache_key(self) -> Optional[Hashable]:
+        """A hashable key describing what this permission checks.
+
+        Permissions with equal keys allow the same identities, so their
+        decisions may be shared through a :class:`DecisionCache`. ``None``,
+        the default, means the decisions depend on more than the needs an
+        identity provides and may not be cached.
+        """
+        return None
+
+    def can(self, identity: Optional['Identity'] = None) -> bool:
         """Whether the required context for this permission has access
 
         This creates an identity context and tests whether it can access this
         permission
+
+        :param identity: The identity to check, the request's identity by
+                         default
         """
-        return self.require().can()
+        return self.require(identity=identity).can()
+
+    def allows_for(self, identity: 'Identity') -> bool:
+        """Whether the identity has access to this permission, outside of
+        any Flask context.
+
+        Unlike :meth:`allows`, the decision goes through the installed
+        :class:`DecisionCache`. Pass an :meth:`Identity.snapshot` to check
+        permissions in other threads or processes.
+
+        :param identity: The identity
+        """
+        return identity.can(self)
 
 class Identity:
     """Represent the user's identity.
@@ -277,25 +1306,139 @@ class Identity:
 
     Needs that are provided by this identity should be added to the `provides`
     set after loading.
+
+    Needs that only apply within a tenant may be kept apart, in the set
+    returned by :meth:`provides_for`. Permissions are then checked against
+    `provides` and the needs of the active ``tenant`` only, see the
+    ``tenant_resolver`` argument of :class:`Principal`.
     """
+
+    #: The active tenant
+    tenant: Optional[Hashable] = None
+
     def __init__(self, id: Optional[Any], auth_type: Optional[str] = None) -> None:
         self.id = id
         self.auth_type = auth_type
-        self.provides: Set[Union[Need, ItemNeed]] = set()
+        self.provides: Set[Union[Need, ItemNeed]] = Provides()
+        #: The needs provided within each tenant, see :meth:`provides_for`
+        self.tenant_provides: Dict[Hashable, Provides] = {}
+
+    def provides_for(self, tenant: Hashable) -> Provides:
+        """The set of needs provided within a tenant, for example::
+
+            @identity_loaded.connect_via(app)
+            def on_identity_loaded(sender, identity):
+                for role in roles_of(identity.id, identity.tenant):
+                    identity.provides_for(identity.tenant).add(RoleNeed(role))
+
+        :param tenant: The tenant
+        """
+        provides = self.tenant_provides.get(tenant)
+        if provides is None:
+            provides = self.tenant_provides[tenant] = Provides()
+        return provides
 
     def can(self, permission: BasePermission) -> bool:
         """Whether the identity has access to the permission.
 
         :param permission: The permission to test provision for.
         """
+        if _decision_cache is not None:
+            return _decision_cache.decide(self, permission)
         return permission.allows(self)
 
+    def fingerprint(self) -> str:
+        """A stable digest of the needs this identity provides.
+
+        Identities providing the same needs have the same fingerprint, in
+        every process, so it can key anything that only depends on the
+        identity's permissions, see :func:`fingerprint_cache_key`. It is a
+        digest, see :meth:`Provides.fingerprint` for its limits.
+        """
+        provides = self.provides
+        if not isinstance(provides, (Provides, CompactProvides, LazyProvides)):
+            provides = Provides(provides)
+        partition = _partition(self)
+        if partition:
+            return '{0}+{1}'.format(provides.fingerprint(), partition.fingerprint())
+        return provides.fingerprint()
+
+    def snapshot(self) -> 'IdentitySnapshot':
+        """A frozen, picklable copy of this identity's id, authentication
+        type and provided needs, including those of the active tenant.
+
+        :raises TypeError: If it provides a :class:`LazyProvides`, whose
+                           needs are not known until looked up
+        """
+        _purge_expired(self.provides)
+        partition = _partition(self)
+        if partition and isinstance(self.provides, (CompactProvides, LazyProvides)):
+            provides = self.provides.with_changes(add=partition)
+            return IdentitySnapshot(self.id, self.auth_type, provides)
+        if partition:
+            return IdentitySnapshot(self.id, self.auth_type,
+                                    set(self.provides) | partition)
+        return IdentitySnapshot(self.id, self.auth_type, self.provides)
+
     def __repr__(self) -> str:
         return '<{0} id="{1}" auth_type="{2}" provides={3}>'.format(
             self.__class__.__name__, self.id, self.auth_type, self.provides
         )
 
 
+class IdentitySnapshot(Identity):
+    """A frozen identity, as returned by :meth:`Identity.snapshot`.
+
+    It cannot be changed and pickles to its id, authentication type and
+    provided needs, so permissions can be checked against it in thread and
+    process pools with :meth:`BasePermission.allows_for`.
+
+    :param id: The user id
+    :param auth_type: The authentication type
+    :param provides: The provided needs, not a :class:`LazyProvides`
+    :raises TypeError: If ``provides`` is a :class:`LazyProvides`, whose
+                       needs are not known until looked up
+    """
+
+    _fingerprint: str
+
+    def __init__(self, id: Optional[Any], auth_type: Optional[str] = None,
+                 provides: Union[Iterable[Any], CompactProvides] = ()) -> None:
+        if isinstance(provides, LazyProvides):
+            raise TypeError(
+                'A LazyProvides cannot be snapshotted, its needs are only '
+                'known as they are looked up')
+        if not isinstance(provides, CompactProvides):
+            provides = Provides(provides)
+        self.__dict__.update(
+            id=id, auth_type=auth_type, provides=_frozen(provides),
+            _fingerprint=provides.fingerprint())
+
+    def fingerprint(self) -> str:
+        return self._fingerprint
+
+    def snapshot(self) -> 'IdentitySnapshot':
+        return self
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError('An identity snapshot cannot be changed')
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError('An identity snapshot cannot be changed')
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (IdentitySnapshot, (self.id, self.auth_type, self.provides))
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, IdentitySnapshot):
+            return NotImplemented
+        return (self.id, self.auth_type, self.provides) == \
+            (other.id, other.auth_type, other.provides)
+
+    def __hash__(self) -> int:
+        return hash((self.id, self.auth_type, self.provides))
+
+
 class AnonymousIdentity(Identity):
     """An anonymous identity"""
 
@@ -303,6 +1446,112 @@ class AnonymousIdentity(Identity):
         Identity.__init__(self, None)
 
 
+class _SharedProvides(_FrozenProvides):
+    """The provisions of the shared anonymous identity, changing them
+    changes those of its private copy instead.
+    """
+
+    #: Returns the set of the private copy taking the changes
+    writable: Callable[[], Provides]
+
+
+def _copy_on_write(name: str) -> Callable[..., Any]:
+    def method(self: _SharedProvides, *args: Any) -> Any:
+        return getattr(self.writable(), name)(*args)
+    method.__name__ = name
+    return method
+
+
+for _name in ('add', 'discard', 'remove', 'pop', 'clear', 'update', 'grant',
+              'purge', 'difference_update', 'intersection_update',
+              'symmetric_difference_update', '__ior__', '__iand__',
+              '__isub__', '__ixor__'):
+    setattr(_SharedProvides, _name, _copy_on_write(_name))
+del _name
+
+
+class _SharedAnonymousIdentity(AnonymousIdentity):
+    """An anonymous identity shared between requests, it is copied on write.
+
+    The first change made to it while it is the request's identity, to its
+    attributes, its provides or the needs of a tenant, replaces it with a
+    private copy, which takes the change, see :meth:`copy`.
+    """
+
+    _fingerprint: str
+    _expires_at: Optional[float]
+
+    def __init__(self, identity: AnonymousIdentity) -> None:
+        self.__dict__.update(vars(identity))
+        self.__dict__['provides'] = self._shared(
+            identity.provides, self._writable)
+        self.__dict__['tenant_provides'] = MappingProxyType({
+            tenant: self._shared(needs, partial(self._writable, tenant))
+            for tenant, needs in identity.tenant_provides.items()
+        })
+        self.__dict__['_fingerprint'] = Identity.fingerprint(identity)
+        expiries = [t for needs in [self.provides, *self.tenant_provides.values()]
+                    for t in getattr(needs, 'expiries', {}).values()]
+        # when the first of its needs expires, it is then replaced
+        self.__dict__['_expires_at'] = min(expiries) if expiries else None
+
+    @staticmethod
+    def _shared(provides: Any, writable: Callable[[], Provides]) -> Any:
+        frozen = _frozen(provides)
+        if isinstance(frozen, _FrozenProvides):
+            shared = _SharedProvides(frozen)
+            shared.expiries = frozen.expiries
+            shared.writable = writable
+            return shared
+        return frozen
+
+    def fingerprint(self) -> str:
+        return self._fingerprint
+
+    def _writable(self, tenant: Hashable = None) -> Provides:
+        """The needs of the private copy, or of its tenant, to change."""
+        identity = self._private()
+        if tenant is None:
+            return cast(Provides, identity.provides)
+        return identity.provides_for(tenant)
+
+    def _private(self) -> AnonymousIdentity:
+        """The private copy of this identity, set as the request's identity
+        on the first change.
+        """
+        if has_app_context():
+            copied = g.get('_principal_anonymous_copy')
+            if copied is not None and copied[0] is self:
+                return cast(AnonymousIdentity, copied[1])
+            if g.get('identity') is self:
+                identity = g.identity = self.copy()
+                g._principal_anonymous_copy = (self, identity)
+                return identity
+        raise AttributeError(
+            'The shared anonymous identity can only be changed as the '
+            "request's identity, use copy()")
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._private(), name, value)
+
+    def __delattr__(self, name: str) -> None:
+        delattr(self._private(), name)
+
+    def provides_for(self, tenant: Hashable) -> Provides:
+        return self._private().provides_for(tenant)
+
+    def copy(self) -> AnonymousIdentity:
+        """A private, changeable copy of this identity."""
+        identity = AnonymousIdentity()
+        identity.__dict__.update(
+            (name, value) for name, value in vars(self).items()
+            if name not in ('_fingerprint', '_expires_at'))
+        identity.provides = Provides()
+        _merge_provisions(identity, self.provides)
+        identity.tenant_provides = {}
+        for tenant, needs in self.tenant_provides.items():
+            _update_provides(identity.provides_for(tenant), needs)
+        return identity
 
 
 class _NaryOperatorPermission(BasePermission):
@@ -310,6 +1559,23 @@ class _NaryOperatorPermission(BasePermission):
     def __init__(self, *permissions: BasePermission) -> None:
         self.permissions: Set[BasePermission] = set(permissions)
 
+    def _ordered(self) -> list:
+        """The permissions, those calling the cheapest predicates first."""
+        order = self.__dict__.get('_order')
+        if order is None or order[0] != self.permissions:
+            order = self._order = (
+                frozenset(self.permissions), sorted(self.permissions, key=_cost))
+        return order[1]
+
+    def cache_key(self) -> Optional[Hashable]:
+        keys = []
+        for permission in self.permissions:
+            key = permission.cache_key()
+            if key is None:
+                return None
+            keys.append(key)
+        return (self.__class__, frozenset(keys))
+
 
 # These classes would be unnecessary if we have predicate calculus
 # primatives of some kind.
@@ -325,7 +1591,7 @@ class OrPermission(_NaryOperatorPermission):
         :param identity: The identity.
         """
 
-        return any(p.allows(identity) for p in self.permissions)
+        return any(p.allows(identity) for p in self._ordered())
 
 
 class AndPermission(_NaryOperatorPermission):
@@ -339,7 +1605,7 @@ class AndPermission(_NaryOperatorPermission):
         :param identity: The identity.
         """
 
-        return all(p.allows(identity) for p in self.permissions)
+        return all(p.allows(identity) for p in self._ordered())
 
 
 class NotPermission(BasePermission):
@@ -357,6 +1623,12 @@ class NotPermission(BasePermission):
     def invert(self) -> BasePermission:
         return self.permission
 
+    def cache_key(self) -> Optional[Hashable]:
+        key = self.permission.cache_key()
+        if key is None:
+            return None
+        return (self.__class__, key)
+
     def allows(self, identity: Identity) -> bool:
         return not self.permission.allows(identity)
 
@@ -449,15 +1721,44 @@ class Permission(BasePermission):
             self.excludes.issubset(other.excludes)
         )
 
+    def cache_key(self) -> Optional[Hashable]:
+        if type(self).allows is not Permission.allows:
+            return None
+        cached = self.__dict__.get('_cache_key')
+        if cached is not None and cached[0] is self.perms \
+                and cached[1] == len(self.perms):
+            return cached[2]
+        key: Optional[Hashable] = (Permission, frozenset(self.perms.items()))
+        if any(isinstance(n, PredicateNeed) for n in self.perms):
+            key = None
+        self._cache_key = (self.perms, len(self.perms), key)
+        return key
+
     def allows(self, identity: Identity) -> bool:
         """Whether the identity can access this permission.
 
+        Predicate needs are only called when the other needs and excludes
+        do not decide, see :class:`PredicateNeed`.
+
         :param identity: The identity
         """
-        if self.needs and not self.needs.intersection(identity.provides):
+        provides = identity.provides
+        _purge_expired(provides)
+        partition = _partition(identity)
+        needs, excludes = self.needs, self.excludes
+        provided = not needs or _intersects(needs, provides) or \
+            bool(partition and _intersects(needs, partition))
+        if not provided and not any(isinstance(n, PredicateNeed) for n in needs):
+            return False
+
+        if excludes and (_intersects(excludes, provides) or
+                         partition and _intersects(excludes, partition)):
+            return False
+
+        if not provided and not any(p(identity) for p in _predicates(needs)):
             return False
 
-        if self.excludes and self.excludes.intersection(identity.provides):
+        if excludes and any(p(identity) for p in _predicates(excludes)):
             return False
 
         return True
@@ -472,6 +1773,1087 @@ class Denial(Permission):
         self.perms = {e: False for e in excludes}
 
 
+def _provisions_key(identity: Identity) -> Optional[Hashable]:
+    """The exact needs an identity provides, as a key, or ``None`` if they
+    are not known up front.
+    """
+    provides = identity.provides
+    if isinstance(provides, LazyProvides):
+        return None
+    if isinstance(provides, CompactProvides):
+        # it cannot change, so its decisions are its own
+        key: Hashable = (CompactProvides, provides)
+    else:
+        key = _needs_key(provides)
+    partition = _partition(identity)
+    if partition:
+        return (key, _needs_key(partition))
+    return key
+
+
+#: The keys of the needs currently provided, so equal keys are the same
+#: object and compare in constant time
+_needs_keys: 'weakref.WeakValueDictionary[frozenset, frozenset]' = \
+    weakref.WeakValueDictionary()
+
+
+def _needs_key(provides: Any) -> frozenset:
+    """The unexpired needs of a provides set, as a key.
+
+    The key of a :class:`Provides` is kept until its needs change, and equal
+    keys are the same object, so keying on it takes constant time.
+    """
+    _purge_expired(provides)
+    key = getattr(provides, '_key', None)
+    if key is not None:
+        return key
+    if getattr(provides, 'expiries', None):
+        # frozenset() would read the expired needs too
+        return frozenset(iter(provides))
+    key = frozenset(provides)
+    if isinstance(provides, (Provides, _FrozenProvides)):
+        key = provides._key = _needs_keys.setdefault(key, key)
+    return key
+
+
+class DecisionCache(object):
+    """A bounded cache of permission decisions shared by all identities.
+
+    Decisions are kept by the needs an identity provides and permission
+    cache key (see :meth:`BasePermission.cache_key`), so identities with the
+    same provisions share them, and an identity whose provisions change no
+    longer sees its old decisions. The needs themselves are compared, not
+    their fingerprint, so different provisions never share decisions; the
+    key of the needs is kept by :class:`Provides` until they change, so
+    looking a decision up does not depend on how many there are.
+    Decisions for :class:`LazyProvides` are not cached. Install it with
+    :func:`set_decision_cache`.
+
+    :param maxsize: The maximum number of decisions kept, the least recently
+                    used are dropped first.
+    """
+
+    def __init__(self, maxsize: int = 4096) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._decisions: 'OrderedDict[Hashable, bool]' = OrderedDict()
+
+    @property
+    def hit_rate(self) -> float:
+        """The share of cacheable decisions served from the cache."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def decide(self, identity: Identity, permission: BasePermission) -> bool:
+        """Whether the identity can access the permission.
+
+        :param identity: The identity
+        :param permission: The permission
+        """
+        permission_key = permission.cache_key()
+        provisions = _provisions_key(identity) if permission_key is not None \
+            else None
+        if provisions is None:
+            return permission.allows(identity)
+
+        key = (provisions, permission_key)
+        with self._lock:
+            decision = self._decisions.get(key)
+            if decision is not None:
+                self._decisions.move_to_end(key)
+                self.hits += 1
+                return decision
+            self.misses += 1
+
+        decision = permission.allows(identity)
+        with self._lock:
+            self._decisions[key] = decision
+            while len(self._decisions) > self.maxsize:
+                self._decisions.popitem(last=False)
+        return decision
+
+    def clear(self) -> None:
+        """Forget all decisions."""
+        with self._lock:
+            self._decisions.clear()
+
+    def __len__(self) -> int:
+        return len(self._decisions)
+
+
+_decision_cache: Optional[DecisionCache] = None
+
+
+def set_decision_cache(cache: Optional[DecisionCache]) -> Optional[DecisionCache]:
+    """Install the process wide decision cache used by :meth:`Identity.can`.
+
+    Returns the previously installed cache.
+
+    :param cache: The :class:`DecisionCache`, or ``None`` to stop caching
+    """
+    global _decision_cache
+    previous, _decision_cache = _decision_cache, cache
+    return previous
+
+
+def _triggers(permission: BasePermission) -> Optional[frozenset]:
+    """Needs at least one of which an identity must provide to be allowed
+    the permission, or ``None`` if no such needs are known.
+    """
+    if isinstance(permission, Permission) \
+            and type(permission).allows is Permission.allows:
+        needs = permission.needs
+        if not needs or any(isinstance(n, PredicateNeed) for n in needs):
+            return None
+        return frozenset(needs)
+
+    if isinstance(permission, OrPermission):
+        triggers: Set[Any] = set()
+        for child in permission.permissions:
+            child_triggers = _triggers(child)
+            if child_triggers is None:
+                return None
+            triggers.update(child_triggers)
+        return frozenset(triggers)
+
+    if isinstance(permission, AndPermission):
+        known = [t for t in map(_triggers, permission.permissions) if t is not None]
+        return min(known, key=len) if known else None
+
+    return None
+
+
+class PermissionRegistry(object):
+    """A collection of named permissions, indexed by the needs they require.
+
+    :meth:`allowed_for` only checks the permissions an identity could be
+    allowed according to the needs it provides, plus those that do not
+    require any particular need (such as :class:`Denial`, ``~permission``
+    or custom permissions). For example, to render navigation::
+
+        registry = PermissionRegistry()
+        registry.register('posts.edit', Permission(RoleNeed('editor')))
+        registry.register('admin', Permission(RoleNeed('admin')))
+
+        links = registry.allowed_for(g.identity)
+    """
+
+    def __init__(self) -> None:
+        self._permissions: Dict[str, BasePermission] = {}
+        self._triggers: Dict[str, Optional[frozenset]] = {}
+        self._positions: Dict[str, int] = {}
+        self._index: Dict[Any, Set[str]] = {}
+        self._always: Set[str] = set()
+        self._counter = 0
+        self._tenants: Dict[Hashable, 'PermissionRegistry'] = {}
+
+    def for_tenant(self, tenant: Hashable) -> 'PermissionRegistry':
+        """The registry of the permissions only checked for identities
+        whose active tenant is ``tenant``, see :meth:`Identity.provides_for`.
+        Its names are separate from this registry's.
+
+        :param tenant: The tenant
+        """
+        registry = self._tenants.get(tenant)
+        if registry is None:
+            registry = self._tenants[tenant] = PermissionRegistry()
+        return registry
+
+    def register(self, name: str, permission: BasePermission) -> BasePermission:
+        """Add a permission, replacing any permission with the same name.
+
+        Returns the permission.
+
+        :param name: The name of the permission
+        :param permission: The permission
+        """
+        if name in self._permissions:
+            self.unregister(name)
+
+        triggers = _triggers(permission)
+        self._permissions[name] = permission
+        self._triggers[name] = triggers
+        self._positions[name] = self._counter
+        self._counter += 1
+        if triggers is None:
+            self._always.add(name)
+        else:
+            for need in triggers:
+                self._index.setdefault(need, set()).add(name)
+        return permission
+
+    def unregister(self, name: str) -> None:
+        """Remove a permission.
+
+        :param name: The name of the permission
+        """
+        del self._permissions[name]
+        del self._positions[name]
+        triggers = self._triggers.pop(name)
+        if triggers is None:
+            self._always.discard(name)
+            return
+        for need in triggers:
+            names = self._index[need]
+            names.discard(name)
+            if not names:
+                del self._index[need]
+
+    def candidates_for(self, identity: Identity) -> Set[str]:
+        """The names of the permissions the identity could be allowed.
+
+        :param identity: The identity
+        """
+        candidates = set(self._always)
+        index = self._index
+        for provides in (identity.provides, _partition(identity)):
+            if provides is None:
+                continue
+            if isinstance(provides, (set, frozenset)) \
+                    and len(provides) <= len(index):
+                for need in provides:
+                    names = index.get(need)
+                    if names:
+                        candidates.update(names)
+                continue
+            intersection = getattr(provides, 'intersection', None)
+            if intersection is not None:
+                # one batched lookup for lazy provisions
+                for need in intersection(index):
+                    candidates.update(index[need])
+            else:
+                for need, names in index.items():
+                    if need in provides:
+                        candidates.update(names)
+        return candidates
+
+    def allowed_for(self, identity: Identity) -> list:
+        """The names of the permissions the identity is allowed, in the
+        order they were registered, followed by those of the registry of
+        its active tenant.
+
+        :param identity: The identity
+        """
+        candidates = sorted(self.candidates_for(identity),
+                            key=self._positions.__getitem__)
+        permissions = self._permissions
+        allowed = [name for name in candidates if identity.can(permissions[name])]
+        tenant = getattr(identity, 'tenant', None)
+        if tenant is not None and tenant in self._tenants:
+            allowed.extend(self._tenants[tenant].allowed_for(identity))
+        return allowed
+
+    def __getitem__(self, name: str) -> BasePermission:
+        return self._permissions[name]
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._permissions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._permissions)
+
+    def __len__(self) -> int:
+        return len(self._permissions)
+
+
+def _compile_access(permission: BasePermission, interned: Dict[Any, int]) -> tuple:
+    """A permission as a tree over need bit masks, interning its needs."""
+    def mask(needs: Iterable[Any]) -> int:
+        bits = 0
+        for need in needs:
+            bits |= 1 << interned.setdefault(need, len(interned))
+        return bits
+
+    if isinstance(permission, Permission) \
+            and type(permission).allows is Permission.allows \
+            and not _predicates(permission.perms):
+        return ('perm', mask(permission.needs), mask(permission.excludes))
+    if isinstance(permission, _NaryOperatorPermission):
+        op = 'or' if isinstance(permission, OrPermission) else 'and'
+        return (op, tuple(_compile_access(p, interned)
+                          for p in permission.permissions))
+    if isinstance(permission, NotPermission):
+        return ('not', _compile_access(permission.permission, interned))
+    return ('custom', permission)
+
+
+def _has_custom(node: tuple) -> bool:
+    if node[0] == 'custom':
+        return True
+    if node[0] == 'not':
+        return _has_custom(node[1])
+    if node[0] in ('or', 'and'):
+        return any(map(_has_custom, node[1]))
+    return False
+
+
+def _allows_compiled(node: tuple, bits: int, identity: Optional[Identity]) -> bool:
+    op = node[0]
+    if op == 'perm':
+        needs, excludes = node[1], node[2]
+        return (not needs or bool(needs & bits)) and not excludes & bits
+    if op == 'or':
+        return any(_allows_compiled(n, bits, identity) for n in node[1])
+    if op == 'and':
+        return all(_allows_compiled(n, bits, identity) for n in node[1])
+    if op == 'not':
+        return not _allows_compiled(node[1], bits, identity)
+    return node[1].allows(identity)
+
+
+_access_table: Optional[list] = None
+
+
+def _init_access_worker(table: list) -> None:
+    global _access_table
+    _access_table = table
+
+
+def _evaluate_access_chunk(chunk: list, table: Optional[list] = None) -> list:
+    """The allowed permission names of each ``(id, bits, provides)`` row."""
+    if table is None:
+        table = cast(list, _access_table)
+    rows = []
+    for identity_id, bits, provides in chunk:
+        identity = None
+        if provides is not None:
+            identity = Identity(identity_id)
+            identity.provides.update(provides)
+        rows.append((identity_id, [
+            name for name, node in table
+            if _allows_compiled(node, bits, identity)
+        ]))
+    return rows
+
+
+def evaluate_access(
+    identities: Iterable[Tuple[Any, Iterable[Any]]],
+    permissions: Union[Mapping[str, BasePermission], PermissionRegistry],
+    chunksize: int = 1000,
+    processes: Optional[int] = None
+) -> Iterator[Tuple[Any, list]]:
+    """Compute which permissions each identity is allowed, offline.
+
+    Yields ``(identity id, allowed permission names)`` for each identity, in
+    the order of ``identities``, reading them lazily. Needs are interned
+    into bit positions once, so each check is a couple of integer
+    operations, and identities are evaluated in chunks on a process pool
+    with a bounded number of chunks in flight. Write the rows with
+    :func:`write_access_csv` or :func:`write_access_jsonl`::
+
+        rows = evaluate_access(
+            ((user.id, provides_of(user)) for user in users), registry)
+        with open('access.csv', 'w', newline='') as f:
+            write_access_csv(rows, f)
+
+    Permissions other than :class:`Permission`, :class:`Denial` and their
+    combinations are checked with their ``allows`` on an :class:`Identity`
+    built from the provides, and must be picklable to use processes.
+
+    :param identities: The ``(identity id, provided needs)`` pairs
+    :param permissions: The permissions by name, a mapping or a
+                        :class:`PermissionRegistry`
+    :param chunksize: The number of identities evaluated at a time
+    :param processes: The number of worker processes, ``None`` for the
+                      number of CPUs or ``0`` to evaluate in this process
+    """
+    interned: Dict[Any, int] = {}
+    table = [(name, _compile_access(permissions[name], interned))
+             for name in permissions]
+    custom = any(_has_custom(node) for name, node in table)
+
+    def chunks() -> Iterator[list]:
+        it = iter(identities)
+        while True:
+            chunk = []
+            for identity_id, provides in islice(it, chunksize):
+                if custom:
+                    provides = list(provides)
+                bits = 0
+                for need in provides:
+                    position = interned.get(need)
+                    if position is not None:
+                        bits |= 1 << position
+                chunk.append((identity_id, bits, provides if custom else None))
+            if not chunk:
+                return
+            yield chunk
+
+    if processes == 0:
+        for chunk in chunks():
+            yield from _evaluate_access_chunk(chunk, table)
+        return
+
+    with futures.ProcessPoolExecutor(
+        max_workers=processes, initializer=_init_access_worker,
+        initargs=(table,)
+    ) as executor:
+        window = 2 * (processes or os.cpu_count() or 1)
+        running: Deque[futures.Future] = deque()
+        for chunk in chunks():
+            running.append(executor.submit(_evaluate_access_chunk, chunk))
+            if len(running) >= window:
+                yield from running.popleft().result()
+        while running:
+            yield from running.popleft().result()
+
+
+def write_access_csv(rows: Iterable[Tuple[Any, list]], f: Any) -> int:
+    """Write the rows of :func:`evaluate_access` as CSV, one
+    ``identity,permission`` line per allowed permission.
+
+    Returns the number of lines written, after the header.
+
+    :param rows: The ``(identity id, permission names)`` rows
+    :param f: A text file, opened with ``newline=''``
+    """
+    writer = csv.writer(f)
+    writer.writerow(['identity', 'permission'])
+    count = 0
+    for identity_id, names in rows:
+        writer.writerows((identity_id, name) for name in names)
+        count += len(names)
+    return count
+
+
+def write_access_jsonl(rows: Iterable[Tuple[Any, list]], f: Any) -> int:
+    """Write the rows of :func:`evaluate_access` as JSON lines, one
+    ``{"identity": ..., "permissions": [...]}`` object per identity.
+
+    Returns the number of lines written.
+
+    :param rows: The ``(identity id, permission names)`` rows
+    :param f: A text file
+    """
+    count = 0
+    for identity_id, names in rows:
+        f.write(json.dumps({'identity': identity_id, 'permissions': names}))
+        f.write('\n')
+        count += 1
+    return count
+
+
+def _identity_key(identity: Identity, chain: Optional[str] = None) -> Hashable:
+    """The key under which provisioning work for an identity is shared."""
+    return (
+        identity.__class__, identity.id, identity.auth_type,
+        identity.fingerprint(), chain, getattr(identity, 'tenant', None)
+    )
+
+
+def _identity_state(identity: Identity) -> Dict[str, Any]:
+    """The attributes set on an identity by its provisioning."""
+    state = dict(vars(identity))
+    for name in ('id', 'auth_type', 'provides', 'tenant'):
+        state.pop(name, None)
+    if 'tenant_provides' in state:
+        state['tenant_provides'] = {
+            tenant: _frozen(needs)
+            for tenant, needs in state['tenant_provides'].items()
+        }
+    return state
+
+
+def _adopt_provisions(identity: Identity, provides: frozenset, state: Dict[str, Any]) -> None:
+    """Give an identity the outcome of provisioning an equal identity."""
+    _merge_provisions(identity, provides)
+    for name, value in state.items():
+        if name == 'tenant_provides':
+            for tenant, needs in value.items():
+                _update_provides(identity.provides_for(tenant), needs)
+        else:
+            identity.__dict__.setdefault(name, value)
+
+
+class _Flight(object):
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls that share a key.
+
+    The first caller for a key runs the function, any caller arriving while
+    it is still running waits for it and shares its result (or exception)
+    instead of running the function again.
+
+    ``calls`` counts the functions actually run and ``coalesced`` counts the
+    callers that waited for another caller's result.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, f: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Run ``f`` unless a call for ``key`` is already in flight.
+
+        Returns a ``(result, shared)`` tuple, ``shared`` being ``True`` when
+        the result was computed by another caller.
+
+        :param key: The key identifying the work
+        :param f: The function computing the result
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = f()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+        return flight.result, False
+
+
+class NegativeCache(object):
+    """Remembers rejected credentials for a short time.
+
+    Credentials are remembered by the fingerprint supplied by an identity
+    loader (see :meth:`Principal.identity_loader`). While a fingerprint is
+    remembered, requests presenting it are treated as anonymous without
+    running the identity loaders again.
+
+    :param ttl: How long, in seconds, a rejected credential is remembered.
+    :param maxsize: The maximum number of remembered credentials, the oldest
+                    are forgotten first.
+    """
+
+    def __init__(self, ttl: float = 30.0, maxsize: int = 10000) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Hashable, float]' = OrderedDict()
+
+    def add(self, fingerprint: Hashable) -> None:
+        """Remember a rejected credential.
+
+        :param fingerprint: The credential fingerprint
+        """
+        with self._lock:
+            self._entries[fingerprint] = time.monotonic() + self.ttl
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, fingerprint: Hashable) -> None:
+        """Forget a credential, for example once it has been (re)issued.
+
+        :param fingerprint: The credential fingerprint
+        """
+        with self._lock:
+            self._entries.pop(fingerprint, None)
+
+    def clear(self) -> None:
+        """Forget all credentials."""
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, fingerprint: Hashable) -> bool:
+        with self._lock:
+            expires = self._entries.get(fingerprint)
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[fingerprint]
+                expires = None
+            if expires is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ProvisionCache(object):
+    """Keeps the provisions loaded for identities.
+
+    Provisions are kept by identity, the most recently loaded first. They are
+    used in place of the `identity-loaded` receivers while younger than
+    ``ttl``, and as a stale fallback when the receivers run out of time (see
+    the ``timeout_fallback`` argument of :class:`Principal`).
+
+    Only the ``provides`` set is kept, any other attributes set by the
+    receivers are not restored from the cache. Provisions including needs
+    granted for a limited time (see :meth:`Provides.grant`) are only fresh
+    until the first of them expires, and expired needs are left out of
+    stale provisions.
+
+    :param maxsize: The maximum number of identities to keep provisions for.
+    :param ttl: How long, in seconds, provisions may be used instead of
+                running the receivers. ``None`` keeps them for fallbacks only.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Hashable, Tuple[frozenset, float, Optional[Dict[Any, float]]]]' = \
+            OrderedDict()
+        self._partitions: Dict[Hashable, frozenset] = {}
+
+    def get(self, key: Hashable, fresh: bool = False) -> Optional[frozenset]:
+        """The provisions kept for ``key``, or ``None``.
+
+        :param key: The identity key
+        :param fresh: Whether to only return provisions younger than ``ttl``
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            provides = None
+            if entry is not None:
+                provides, stored, expiries = entry
+                if fresh and (self.ttl is None
+                              or stored + self.ttl <= time.monotonic()):
+                    provides = None
+                elif expiries:
+                    now = time.time()
+                    expired = {n for n, t in expiries.items() if t <= now}
+                    if expired and fresh:
+                        provides = None
+                    elif expired and isinstance(provides, frozenset):
+                        provides = _with_expiries(provides - expired, expiries)
+            if provides is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return provides
+
+    def set(self, key: Hashable, provides: frozenset,
+            expiries: Optional[Dict[Any, float]] = None,
+            partition: Optional[frozenset] = None) -> None:
+        """Keep the provisions loaded for ``key``.
+
+        :param key: The identity key
+        :param provides: The loaded provisions
+        :param expiries: The expiry of the needs granted for a limited time,
+                         see :meth:`Provides.expiring`
+        :param partition: The provisions of the identity's active tenant,
+                          see :meth:`Identity.provides_for`
+        """
+        if expiries:
+            # the needs expire out of stale provisions
+            if isinstance(provides, frozenset):
+                provides = _with_expiries(provides, expiries)
+            if partition:
+                partition = _with_expiries(partition, expiries)
+        with self._lock:
+            self._entries[key] = (provides, time.monotonic(), expiries or None)
+            self._entries.move_to_end(key)
+            if partition:
+                self._partitions[key] = partition
+            else:
+                self._partitions.pop(key, None)
+            while len(self._entries) > self.maxsize:
+                self._partitions.pop(self._entries.popitem(last=False)[0], None)
+
+    def partition(self, key: Hashable) -> frozenset:
+        """The provisions of the active tenant kept for ``key``, without
+        expired needs.
+
+        :param key: The identity key
+        """
+        with self._lock:
+            partition = self._partitions.get(key, frozenset())
+            entry = self._entries.get(key)
+            if partition and entry is not None and entry[2]:
+                now = time.time()
+                partition = _with_expiries(partition - {
+                    n for n, t in entry[2].items() if t <= now}, entry[2])
+            return partition
+
+    def update_provisions(self, identity_id: Any, add: Iterable[Any] = (), remove: Iterable[Any] = ()) -> int:
+        """Patch the provisions kept for an identity, keeping their age.
+
+        Returns the number of entries patched.
+
+        :param identity_id: The id of the identity
+        :param add: The needs to add
+        :param remove: The needs to remove
+        """
+        add = frozenset(add)
+        remove = frozenset(remove)
+        patched = 0
+        with self._lock:
+            for key, (provides, stored, expiries) in list(self._entries.items()):
+                if cast(tuple, key)[1] == identity_id:
+                    if expiries:
+                        expiries = {n: t for n, t in expiries.items()
+                                    if n not in remove and n not in add}
+                    if isinstance(provides, (CompactProvides, LazyProvides)):
+                        provides = provides.with_changes(add, remove)
+                    else:
+                        provides = _with_expiries((provides - remove) | add, expiries)
+                    self._entries[key] = (provides, stored, expiries or None)
+                    patched += 1
+        return patched
+
+    def clear(self) -> None:
+        """Forget all provisions."""
+        with self._lock:
+            self._entries.clear()
+            self._partitions.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def fingerprint_cache_key(*parts: Any, identity: Optional[Identity] = None) -> str:
+    """A cache key shared by all identities with the same provisions.
+
+    Use it to cache anything that depends on the identity's permissions
+    rather than on the identity itself, for example a rendered page::
+
+        key = fingerprint_cache_key('page', request.path)
+
+    :param parts: The other parts of the key
+    :param identity: The identity, the current one by default
+    """
+    if identity is None:
+        identity = cast(Identity, g.identity)
+    return ':'.join(['principal', identity.fingerprint()] + [str(p) for p in parts])
+
+
+def add_fingerprint_headers(
+    response: Any,
+    identity: Optional[Identity] = None,
+    header: str = 'X-Principal-Fingerprint'
+) -> Any:
+    """Tag a response with the fingerprint of the identity it was made for.
+
+    The fingerprint is sent in ``header``, which is added to the ``Vary``
+    header for caches keying responses on it, and is folded into the
+    response's ``ETag`` (one is computed from the body if missing), so a
+    response is only revalidated for identities with the same provisions.
+    Returns the response, so it can be used as an ``after_request``
+    function::
+
+        app.after_request(add_fingerprint_headers)
+
+    :param response: The response to tag
+    :param identity: The identity, the current one by default
+    :param header: The name of the header carrying the fingerprint
+    """
+    if identity is None:
+        identity = cast(Identity, g.identity)
+    fingerprint = identity.fingerprint()
+    response.headers[header] = fingerprint
+    response.vary.add(header)
+
+    etag, weak = response.get_etag()
+    if etag is None:
+        if response.is_streamed:
+            return response
+        etag = hashlib.blake2b(response.get_data(), digest_size=16).hexdigest()
+    response.set_etag('{0}.{1}'.format(fingerprint, etag), weak)
+    return response
+
+
+def _request_decisions(identity: Identity) -> Dict[Hashable, bool]:
+    """The permission decisions of the request, for the identity."""
+    fingerprint = identity.fingerprint()
+    decisions = g.get('_principal_decisions')
+    if decisions is None \
+            or g.get('_principal_decisions_identity') is not identity \
+            or g.get('_principal_decisions_fingerprint') != fingerprint:
+        decisions = g._principal_decisions = {}
+        g._principal_decisions_identity = identity
+        g._principal_decisions_fingerprint = fingerprint
+    return decisions
+
+
+def _template_can(permission: BasePermission) -> bool:
+    """The ``can`` test and global of templates, see the
+    ``template_helpers`` option of :class:`Principal`.
+    """
+    if not has_request_context():
+        return permission.can()
+    identity = cast(Identity, g.identity)
+    decisions = _request_decisions(identity)
+    key = permission.cache_key() or permission
+    decision = decisions.get(key)
+    if decision is None:
+        decision = decisions[key] = identity.can(permission)
+    return decision
+
+
+def _prefetch_permissions(*permissions: BasePermission) -> str:
+    """The ``prefetch_permissions`` global of templates, deciding the
+    permissions at once for the following ``can`` checks.
+    """
+    if not has_request_context():
+        return ''
+    identity = cast(Identity, g.identity)
+    decisions = _request_decisions(identity)
+    for permission in permissions:
+        key = permission.cache_key() or permission
+        if key not in decisions:
+            decisions[key] = identity.can(permission)
+    return ''
+
+
+class _Item(object):
+
+    def __repr__(self) -> str:
+        return 'ITEM'
+
+
+ITEM = _Item()
+"""Stands for the item being filtered in the value of an :class:`ItemNeed`,
+see :func:`sql_filter`.
+"""
+
+
+def _is_template(need: Any) -> bool:
+    return isinstance(need, tuple) and len(need) == 3 and need[1] is ITEM
+
+
+def bind_item(permission: BasePermission, item: Any) -> BasePermission:
+    """The permission for one item of a permission over :data:`ITEM`.
+
+    :param permission: The permission, which may be composite
+    :param item: The value replacing :data:`ITEM`
+    """
+    def bind(need: Any) -> Any:
+        if _is_template(need):
+            return need.__class__(need[0], item, need[2])
+        return need
+
+    if isinstance(permission, Permission) \
+            and type(permission).allows is Permission.allows:
+        bound = Permission()
+        bound.perms = {bind(n): v for n, v in permission.perms.items()}
+        return bound
+    if isinstance(permission, _NaryOperatorPermission):
+        return permission.__class__(
+            *[bind_item(p, item) for p in permission.permissions])
+    if isinstance(permission, NotPermission):
+        return NotPermission(bind_item(permission.permission, item))
+    return permission
+
+
+def _filter_tree(permission: BasePermission, identity: Identity,
+                 items: Optional[Dict[Tuple[Any, Any], Set[Any]]]) -> Any:
+    """The permission as a tree of ``True``, ``False``, ``('in', values)``,
+    ``('and', children)``, ``('or', children)`` and ``('not', child)``.
+    """
+    if isinstance(permission, Permission) \
+            and type(permission).allows is Permission.allows:
+        def any_of(needs: Iterable[Any]) -> Any:
+            children: list = []
+            for need in needs:
+                if _is_template(need):
+                    if items is None:
+                        raise TypeError(
+                            '{0} cannot list its needs, so permissions over '
+                            'ITEM cannot be translated into a filter'.format(
+                                type(identity.provides).__name__))
+                    children.append(('in', items.get((need[0], need[2]), set())))
+                elif isinstance(need, PredicateNeed):
+                    if need(identity):
+                        return True
+                elif need in identity.provides or \
+                        partition is not None and need in partition:
+                    return True
+            return _combine('or', children)
+
+        partition = _partition(identity)
+        needs, excludes = permission.needs, permission.excludes
+        allowed = any_of(needs) if needs else True
+        return _combine('and', [allowed, _negate(any_of(excludes))])
+
+    if isinstance(permission, _NaryOperatorPermission):
+        op = 'or' if isinstance(permission, OrPermission) else 'and'
+        return _combine(op, [_filter_tree(p, identity, items)
+                             for p in permission.permissions])
+
+    if isinstance(permission, NotPermission):
+        return _negate(_filter_tree(permission.permission, identity, items))
+
+    return permission.allows(identity)
+
+
+def _negate(tree: Any) -> Any:
+    if isinstance(tree, bool):
+        return not tree
+    return ('not', tree)
+
+
+def _combine(op: str, children: list) -> Any:
+    # folds constants: True absorbs an "or", False an "and"
+    absorbing = op == 'or'
+    kept = []
+    for child in children:
+        if isinstance(child, bool):
+            if child is absorbing:
+                return absorbing
+            continue
+        if child[0] == 'in' and not child[1]:
+            if not absorbing:
+                return False
+            continue
+        kept.append(child)
+    if not kept:
+        return not absorbing
+    if len(kept) == 1:
+        return kept[0]
+    return (op, kept)
+
+
+def _provided_items(identity: Identity) -> Optional[Dict[Tuple[Any, Any], Set[Any]]]:
+    """The values of the provided item needs by method and type, or ``None``
+    if the provides set cannot list its needs.
+    """
+    items: Dict[Tuple[Any, Any], Set[Any]] = {}
+    for provides in (identity.provides, _partition(identity) or ()):
+        if not hasattr(provides, '__iter__'):
+            return None
+        for need in provides:
+            if isinstance(need, tuple) and len(need) == 3:
+                items.setdefault((need[0], need[2]), set()).add(need[1])
+    return items
+
+
+def _sorted_values(values: Set[Any]) -> list:
+    try:
+        return sorted(values)
+    except TypeError:
+        return sorted(values, key=repr)
+
+
+def sql_filter(
+    permission: BasePermission,
+    column: str,
+    identity: Optional[Identity] = None,
+    paramstyle: str = 'qmark'
+) -> Tuple[str, Any]:
+    """Translate a permission over items into an SQL ``WHERE`` clause.
+
+    The permission uses :data:`ITEM` in place of the value of its
+    :class:`ItemNeed` s, and the clause selects the rows whose ``column``
+    holds the values for which the identity would be allowed the permission
+    (see :func:`bind_item`). For example, to list the posts the current
+    identity may read::
+
+        can_read = Permission(ItemNeed('read', ITEM, 'posts'), RoleNeed('admin'))
+        where, params = sql_filter(can_read, 'posts.id')
+        rows = db.execute('SELECT * FROM posts WHERE ' + where, params)
+
+    Needs that do not use :data:`ITEM`, and permissions other than
+    :class:`Permission`, :class:`Denial` and their combinations, are
+    evaluated against the identity first. Needs using :data:`ITEM` are
+    matched against the needs the identity provides, so they raise
+    :exc:`TypeError` for provides sets that cannot list them, such as
+    :class:`CompactProvides` and :class:`LazyProvides`.
+
+    Returns the clause and its parameters, a list, or a dict for the
+    ``named`` paramstyle.
+
+    :param permission: The permission
+    :param column: The SQL expression of the item values
+    :param identity: The identity, the current one by default
+    :param paramstyle: The DB-API paramstyle: ``'qmark'``, ``'format'`` or
+                       ``'named'``
+    """
+    if paramstyle not in ('qmark', 'format', 'named'):
+        raise ValueError(f'Unsupported paramstyle {paramstyle!r}')
+    if identity is None:
+        identity = cast(Identity, g.identity)
+    tree = _filter_tree(permission, identity, _provided_items(identity))
+
+    params: list = []
+
+    def placeholder() -> str:
+        if paramstyle == 'qmark':
+            return '?'
+        if paramstyle == 'format':
+            return '%s'
+        return ':p{0}'.format(len(params) - 1)
+
+    def render(tree: Any) -> str:
+        if tree is True:
+            return '1 = 1'
+        if tree is False:
+            return '1 = 0'
+        op = tree[0]
+        if op == 'in':
+            marks = []
+            for value in _sorted_values(tree[1]):
+                params.append(value)
+                marks.append(placeholder())
+            return '{0} IN ({1})'.format(column, ', '.join(marks))
+        if op == 'not':
+            return 'NOT ({0})'.format(render(tree[1]))
+        joiner = ' {0} '.format(op.upper())
+        return joiner.join('({0})'.format(render(c)) for c in tree[1])
+
+    clause = render(tree)
+    if paramstyle == 'named':
+        return clause, {'p{0}'.format(i): v for i, v in enumerate(params)}
+    return clause, params
+
+
+def sqlalchemy_filter(permission: BasePermission, column: Any, identity: Optional[Identity] = None) -> Any:
+    """Like :func:`sql_filter`, as an SQLAlchemy expression on ``column``.
+
+    For example::
+
+        query = select(Post).where(sqlalchemy_filter(can_read, Post.id))
+
+    :param permission: The permission
+    :param column: The SQLAlchemy column of the item values
+    :param identity: The identity, the current one by default
+    """
+    import sqlalchemy as sa
+
+    if identity is None:
+        identity = cast(Identity, g.identity)
+    tree = _filter_tree(permission, identity, _provided_items(identity))
+
+    def build(tree: Any) -> Any:
+        if tree is True:
+            return sa.true()
+        if tree is False:
+            return sa.false()
+        op = tree[0]
+        if op == 'in':
+            return column.in_(_sorted_values(tree[1]))
+        if op == 'not':
+            return sa.not_(build(tree[1]))
+        children = [build(c) for c in tree[1]]
+        return sa.or_(*children) if op == 'or' else sa.and_(*children)
+
+    return build(tree)
+
+
 def session_identity_loader() -> Optional[Identity]:
     if 'identity.id' in session and 'identity.auth_type' in session:
         identity = Identity(session['identity.id'],
@@ -486,6 +2868,203 @@ def session_identity_saver(identity: Identity) -> None:
     session.modified = True
 
 
+ProviderTiming = namedtuple('ProviderTiming', ['calls', 'total', 'last'])
+"""How long a provider took: the number of calls, and the total and last
+durations in seconds.
+"""
+
+
+_LOADERS, _SAVERS, _PROVIDERS = range(3)
+
+
+def _blueprint_name(blueprint: Union[str, Blueprint]) -> str:
+    return blueprint if isinstance(blueprint, str) else blueprint.name
+
+
+class _Provider(object):
+
+    def __init__(self, name: str, f: Callable[..., Any],
+                 requires: Tuple[str, ...]) -> None:
+        self.name = name
+        self.f = f
+        self.requires = requires
+
+
+def _ensure_sync(f: Callable[..., Any]) -> Callable[..., Any]:
+    """A function calling ``f`` synchronously, even if it is a coroutine
+    function and an event loop is running in this thread, as in an async
+    view, where :meth:`flask.Flask.ensure_sync` cannot.
+    """
+    if not iscoroutinefunction(f):
+        return f
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return current_app.ensure_sync(f)
+
+    @wraps(f)
+    def run_in_thread(*args: Any, **kwargs: Any) -> Any:
+        # Blocks the running loop, the request's own, until ``f`` returns
+        context = contextvars.copy_context()
+        thread_pool = futures.ThreadPoolExecutor(1)
+        try:
+            return thread_pool.submit(
+                context.run, asyncio.run, f(*args, **kwargs)).result()
+        finally:
+            thread_pool.shutdown(wait=False)
+    return run_in_thread
+
+
+def _view_chain(view: Any) -> Iterator[Any]:
+    """A view function, its class for class based views, and the functions
+    it wraps, as recorded by :func:`functools.wraps`.
+    """
+    seen: Set[int] = set()
+    pending = [view]
+    while pending:
+        view = pending.pop()
+        if view is None or id(view) in seen:
+            continue
+        seen.add(id(view))
+        yield view
+        pending.append(getattr(view, '__wrapped__', None))
+        pending.append(getattr(view, 'view_class', None))
+
+
+def _endpoint_blueprints(endpoint: str) -> Iterator[str]:
+    """The names of the blueprints of an endpoint, nested ones included."""
+    parts = endpoint.split('.')[:-1]
+    for i in range(len(parts), 0, -1):
+        yield '.'.join(parts[:i])
+
+
+class _PrefixTrie(object):
+    """Matches paths against many prefixes in a single walk of the path."""
+
+    def __init__(self, prefixes: Iterable[str]) -> None:
+        self.root: Dict[Optional[str], Any] = {}
+        for prefix in prefixes:
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[None] = True
+
+    def match(self, path: str) -> bool:
+        """Whether the path starts with any of the prefixes."""
+        node = self.root
+        if not node:
+            return False
+        if None in node:
+            return True
+        for char in path:
+            child = node.get(char)
+            if child is None:
+                return False
+            if None in child:
+                return True
+            node = child
+        return False
+
+
+class _ReceiverSnapshot(object):
+    """The `identity-loaded` receivers for a sender, as of a version.
+
+    Receivers are held weakly, like the signal does, and flagged ``direct``
+    when they can simply be called.
+    """
+
+    def __init__(self, sender: Any, version: int,
+                 budgets: Dict[Callable[..., Any], float],
+                 default_budget: Optional[float]) -> None:
+        self.version = version
+        self.receivers = []
+        for receiver in identity_loaded.receivers_for(sender):
+            budget = budgets.get(receiver, default_budget)
+            direct = budget is None and not iscoroutinefunction(receiver)
+            self.receivers.append((_weak_or_strong(receiver), direct, budget))
+
+
+def _weak_or_strong(f: Callable[..., Any]) -> Callable[[], Optional[Callable[..., Any]]]:
+    try:
+        if hasattr(f, '__self__') and hasattr(f, '__func__'):
+            return weakref.WeakMethod(f)  # type: ignore
+        return weakref.ref(f)
+    except TypeError:
+        return lambda: f
+
+
+class _LoaderIndex(object):
+    """Identity loaders indexed by their preconditions.
+
+    Each loader is filed under its header, else its cookie, else its path
+    prefix precondition, so a request only looks up the headers and cookies
+    some loader asks for. Loaders are returned in their original order.
+    """
+
+    def __init__(self, app: Flask, loaders: Tuple[Callable[[], Optional[Identity]], ...],
+                 options: Dict[Callable[[], Optional[Identity]], Dict[str, Any]]) -> None:
+        self.app = app
+        self.loaders = loaders
+        self.always: list = []
+        self.by_header: Dict[str, list] = {}
+        self.by_cookie: Dict[str, list] = {}
+        self.by_path_prefix: list = []
+        self.conditions: Dict[int, Tuple[Optional[str], Optional[str], Optional[str]]] = {}
+
+        interface = app.session_interface
+        session_cookie = None
+        if isinstance(interface, SecureCookieSessionInterface):
+            session_cookie = interface.get_cookie_name(app)
+
+        for position, loader in enumerate(loaders):
+            opts = options.get(loader, {})
+            header = opts.get('header')
+            cookie = opts.get('cookie')
+            if cookie is None and opts.get('session'):
+                # Without its cookie a cookie session is always empty
+                cookie = session_cookie
+            path_prefix = opts.get('path_prefix')
+            self.conditions[position] = (header, cookie, path_prefix)
+
+            if header is not None:
+                self.by_header.setdefault(header.lower(), []).append(position)
+            elif cookie is not None:
+                self.by_cookie.setdefault(cookie, []).append(position)
+            elif path_prefix is not None:
+                self.by_path_prefix.append((path_prefix, position))
+            else:
+                self.always.append(position)
+
+    def select(self, request: Request) -> list:
+        """The loaders whose preconditions the request meets."""
+        if not (self.by_header or self.by_cookie or self.by_path_prefix):
+            return list(self.loaders)
+
+        positions = list(self.always)
+        for name, filed in self.by_header.items():
+            if name in request.headers:
+                positions.extend(filed)
+        if self.by_cookie:
+            cookies = request.cookies
+            for name, filed in self.by_cookie.items():
+                if name in cookies:
+                    positions.extend(filed)
+        path = request.path
+        for path_prefix, position in self.by_path_prefix:
+            if path.startswith(path_prefix):
+                positions.append(position)
+
+        selected = []
+        for position in sorted(positions):
+            header, cookie, path_prefix = self.conditions[position]
+            if cookie is not None and cookie not in request.cookies:
+                continue
+            if path_prefix is not None and not path.startswith(path_prefix):
+                continue
+            selected.append(self.loaders[position])
+        return selected
+
+
 class Principal(object):
     """Principal extension
 
@@ -493,18 +3072,128 @@ class Principal(object):
     :param use_sessions: Whether to use sessions to extract and store
                          identification.
     :param skip_static: Whether to ignore static endpoints.
+    :param single_flight: Whether concurrent requests loading the same
+                          identity share a single run of the
+                          `identity-loaded` receivers. Attributes set by
+                          the receivers are then shared between those
+                          requests.
+    :param negative_cache: A :class:`NegativeCache` remembering credentials
+                           that no identity loader accepted.
+    :param loader_timeout: The default time budget, in seconds, of each
+                           identity loader.
+    :param receiver_timeout: The default time budget, in seconds, of each
+                             `identity-loaded` receiver.
+    :param timeout_fallback: What to do when a loader or receiver runs out of
+                             time: ``'anonymous'`` continues with an
+                             anonymous identity, ``'stale'`` uses the
+                             provisions last kept in ``provision_cache`` (or
+                             continues anonymously without any) and
+                             ``'abort'`` aborts the request with a 503.
+    :param provision_cache: A :class:`ProvisionCache` keeping loaded
+                            provisions.
+    :param max_workers: The size of the thread pool running functions with a
+                        time budget.
+    :param skip_endpoints: The endpoints to ignore.
+    :param skip_blueprints: The blueprints whose endpoints to ignore.
+    :param skip_paths: The path prefixes to ignore.
+    :param anonymous_provisions: Whether to provision the anonymous identity
+                                 with the `identity-loaded` receivers. This
+                                 is done once per application, and requests
+                                 without an identity share the result. The
+                                 first change to it during a request
+                                 replaces ``g.identity`` with a private
+                                 copy taking the change.
+    :param template_helpers: Whether to add the ``can`` test and global, and
+                             the ``prefetch_permissions`` global, to the
+                             templates. Their decisions are kept for the
+                             rest of the request, as long as the identity
+                             and its provisions do not change::
+
+                                 {{ prefetch_permissions(edit, delete) }}
+                                 {% for post in posts %}
+                                   {% if edit is can %}...{% endif %}
+                                   {% if can(delete) %}...{% endif %}
+                                 {% endfor %}
+
+    :param tenant_resolver: A function returning the tenant of the request,
+                            which becomes the active ``tenant`` of the
+                            identities set without one. Permissions are
+                            checked against the needs provided within it,
+                            see :meth:`Identity.provides_for`, and cached
+                            provisions are kept by tenant.
     """
+
+    TIMEOUT_FALLBACKS = ('anonymous', 'stale', 'abort')
+
     def __init__(
         self, 
         app: Optional[Flask] = None, 
         use_sessions: bool = True, 
-        skip_static: bool = False
+        skip_static: bool = False,
+        single_flight: bool = False,
+        negative_cache: Optional[NegativeCache] = None,
+        loader_timeout: Optional[float] = None,
+        receiver_timeout: Optional[float] = None,
+        timeout_fallback: str = 'anonymous',
+        provision_cache: Optional[ProvisionCache] = None,
+        max_workers: int = 4,
+        anonymous_provisions: bool = False,
+        skip_endpoints: Iterable[str] = (),
+        skip_blueprints: Iterable[str] = (),
+        skip_paths: Iterable[str] = (),
+        template_helpers: bool = False,
+        tenant_resolver: Optional[Callable[[], Optional[Hashable]]] = None
     ) -> None:
+        if timeout_fallback not in self.TIMEOUT_FALLBACKS:
+            raise ValueError(f'Unknown timeout fallback {timeout_fallback!r}')
+
         self.identity_loaders: Deque[Callable[[], Optional[Identity]]] = deque()
         self.identity_savers: Deque[Callable[[Identity], None]] = deque()
+        self._loader_options: Dict[Callable[[], Optional[Identity]], Dict[str, Any]] = {}
+        self.negative_cache = negative_cache
+        self.loader_timeout = loader_timeout
+        self.receiver_timeout = receiver_timeout
+        self.timeout_fallback = timeout_fallback
+        self.provision_cache = provision_cache
+        self.max_workers = max_workers
+        #: The number of times each loader or receiver ran out of time, by
+        #: qualified name.
+        self.timeouts: 'Counter[str]' = Counter()
+        self._time_budgets: Dict[Callable[..., Any], float] = {}
+        self._executor: Optional[futures.ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._loader_indexes: Dict[Optional[str], _LoaderIndex] = {}
+        self._blueprint_loaders: Dict[str, Deque[Callable[[], Optional[Identity]]]] = {}
+        self._blueprint_savers: Dict[str, Deque[Callable[[Identity], None]]] = {}
+        self._blueprint_providers: Dict[str, 'OrderedDict[str, _Provider]'] = {}
+        self._endpoint_chains: Dict[str, Tuple[Optional[str], ...]] = {}
+        self.anonymous_provisions = anonymous_provisions
+        self.providers: 'OrderedDict[str, _Provider]' = OrderedDict()
+        self._receivers_version = 0
+        self._receiver_snapshots: 'weakref.WeakKeyDictionary[Flask, _ReceiverSnapshot]' = \
+            weakref.WeakKeyDictionary()
+        #: The :class:`ProviderTiming` of each provider, by name.
+        self.provider_timings: Dict[str, ProviderTiming] = {}
+        self._anonymous_identities: 'weakref.WeakKeyDictionary[Flask, _SharedAnonymousIdentity]' = \
+            weakref.WeakKeyDictionary()
         # XXX This will probably vanish for a better API
         self.use_sessions = use_sessions
         self.skip_static = skip_static
+        self.skip_endpoints = frozenset(skip_endpoints)
+        self.skip_blueprints = frozenset(skip_blueprints)
+        self.skip_paths = tuple(skip_paths)
+        self.template_helpers = template_helpers
+        self.tenant_resolver = tenant_resolver
+        self._exempt_views: Set[Callable[..., Any]] = set()
+        self._view_permissions: Dict[Callable[..., Any], list] = {}
+        self._endpoint_permissions: 'weakref.WeakKeyDictionary[Flask, Mapping[str, Tuple[Tuple[BasePermission, Optional[int]], ...]]]' = \
+            weakref.WeakKeyDictionary()
+        self._skip_trie = _PrefixTrie(self.skip_paths)
+        self._skipped_endpoints: 'weakref.WeakKeyDictionary[Flask, Dict[str, bool]]' = \
+            weakref.WeakKeyDictionary()
+        #: The :class:`SingleFlight` coalescing identity provisioning, or
+        #: ``None`` when disabled. Its counters report the coalesced waits.
+        self.single_flight = SingleFlight() if single_flight else None
 
         if app is not None:
             self.init_app(app)
@@ -523,24 +3212,278 @@ class Principal(object):
         else:
             self._static_path = app.static_path  # type: ignore
 
+        skip_paths = list(self.skip_paths)
+        if self.skip_static and self._static_path:
+            skip_paths.append(self._static_path)
+        self._skip_trie = _PrefixTrie(skip_paths)
+
         app.before_request(self._on_before_request)
         identity_changed.connect(self._on_identity_changed, app)
+        identity_loaded.receiver_connected.connect(self._on_receivers_changed)
+        identity_loaded.receiver_disconnected.connect(self._on_receivers_changed)
+
+        if self.template_helpers:
+            app.add_template_test(_template_can, 'can')
+            app.add_template_global(_template_can, 'can')
+            app.add_template_global(_prefetch_permissions, 'prefetch_permissions')
 
         if self.use_sessions:
+            self._loader_options[session_identity_loader] = {'session': True}
             self.identity_loader(session_identity_loader)
             self.identity_saver(session_identity_saver)
 
-    def set_identity(self, identity: Identity) -> None:
+    def set_identity(self, identity: Identity, force: bool = False) -> None:
         """Set the current identity.
 
+        Setting an identity equal to the one already set during the request,
+        same id, auth type and provisions as it was set or as it was loaded,
+        is a no-op: the `identity-loaded`
+        receivers and the identity savers are not called again, and the
+        identity takes on the provisions of the one already loaded.
+
         :param identity: The identity to set
+        :param force: Whether to load and save the identity even when it is
+                      unchanged.
         """
 
-        self._set_thread_identity(identity)
-        for saver in self.identity_savers:
-            saver(identity)
+        if self.tenant_resolver is not None and identity.tenant is None:
+            identity.tenant = self.tenant_resolver()
+        chain = self._chain(_PROVIDERS)
+        key = _identity_key(identity, chain)
+        current = g.get('identity')
+        loaded_key = g.get('_principal_identity_key')
+        # unchanged from the identity as it was set, or as it was loaded
+        if not force and current is not None and loaded_key is not None \
+                and (key == loaded_key or key == _identity_key(current, chain)):
+            if identity is not current:
+                _adopt_provisions(identity, _frozen(current.provides),
+                                  _identity_state(current))
+                g.identity = identity
+            return
+
+        self._set_thread_identity(identity, key)
+        # A fallback identity set on timeout is not the requested one
+        g._principal_identity_key = key if g.identity is identity else None
+        for saver in self._chain_savers():
+            _ensure_sync(saver)(identity)
 
-    def identity_loader(self, f: Callable[[], Optional[Identity]]) -> Callable[[], Optional[Identity]]:
+    async def set_identity_async(self, identity: Identity, force: bool = False) -> None:
+        """Like :meth:`set_identity`, for async views.
+
+        The identity is loaded and saved in a worker thread, in the context
+        of the request, so the view's event loop keeps running.
+
+        :param identity: The identity to set
+        :param force: Whether to load and save the identity even when it is
+                      unchanged.
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        await loop.run_in_executor(
+            None, partial(context.run, self.set_identity, identity, force))
+
+    def permission_required(self, *permissions: BasePermission, http_exception: Optional[int] = None) -> Callable[[F], F]:
+        """Decorator declaring the permissions a view requires.
+
+        Unlike ``permission.require()``, the view is not wrapped: its
+        permissions are compiled into a table of the permissions required by
+        each endpoint (see :meth:`compile_endpoint_permissions`), which is
+        checked before the request, right after the identity is loaded. All
+        the permissions are required, the view may be decorated more than
+        once, and other decorators may wrap it as long as they use
+        :func:`functools.wraps`. Class based views may be decorated too. The
+        routes of a view with permissions must not be ignored (see the
+        ``skip_*`` options and :meth:`exempt`). For example::
+
+            @app.route('/admin')
+            @principals.permission_required(admin_permission, http_exception=403)
+            def admin():
+                return render_template('admin.html')
+
+        :param permissions: The permissions the view requires
+        :param http_exception: The HTTP exception code to abort with when a
+                               permission is not met, see
+                               :meth:`BasePermission.require`.
+        """
+        def decorator(f: F) -> F:
+            entries = self._view_permissions.setdefault(f, [])
+            for permission in permissions:
+                code = http_exception
+                if code is None:
+                    code = permission.http_exception
+                entries.append((permission, code))
+            self._endpoint_permissions.clear()
+            return f
+        return decorator
+
+    def compile_endpoint_permissions(self, app: Flask) -> Mapping[str, Tuple[Tuple[BasePermission, Optional[int]], ...]]:
+        """Compile the table of the permissions required by each endpoint
+        of the application.
+
+        The table is compiled on the first request, call this once all the
+        views are registered to do it at startup. It is also available as
+        :attr:`endpoint_permissions` for auditing.
+
+        Raises :exc:`ValueError` if an endpoint requiring permissions is
+        ignored, as it would not be checked. Requests to ignored paths of
+        such an endpoint that are not known beforehand, through a variable
+        part of its rule, are denied.
+
+        :param app: The application
+        """
+        table = {}
+        for endpoint, view in app.view_functions.items():
+            entries = [entry for f in _view_chain(view)
+                       for entry in self._view_permissions.get(f, ())]
+            if not entries:
+                continue
+            if self._is_skipped_endpoint(app, endpoint) or any(
+                    self._skip_trie.match(rule.rule)
+                    for rule in app.url_map.iter_rules(endpoint)):
+                raise ValueError(
+                    f'Endpoint {endpoint!r} requires permissions but is '
+                    'ignored by Principal')
+            table[endpoint] = tuple(entries)
+        self._endpoint_permissions[app] = compiled = MappingProxyType(table)
+        return compiled
+
+    @property
+    def endpoint_permissions(self) -> Mapping[str, Tuple[Tuple[BasePermission, Optional[int]], ...]]:
+        """The permissions required by each endpoint of the current
+        application, as ``(permission, http_exception)`` pairs.
+        """
+        app = current_app._get_current_object()  # type: ignore
+        table = self._endpoint_permissions.get(app)
+        if table is None:
+            table = self.compile_endpoint_permissions(app)
+        return table
+
+    def exempt(self, f: F) -> F:
+        """Decorator to ignore a view, no identity is loaded for it.
+
+        For example::
+
+            @app.route('/health')
+            @principals.exempt
+            def health():
+                return 'OK'
+        """
+        self._exempt_views.add(f)
+        self._skipped_endpoints.clear()
+        return f
+
+    def update_provisions(self, identity_id: Any, add: Iterable[Any] = (), remove: Iterable[Any] = ()) -> None:
+        """Grant or revoke needs without reloading the identity.
+
+        The needs are added to, or removed from, the current identity if it
+        has the given id, and any provisions kept for the identity by
+        ``provision_cache`` or shared with anonymous requests. The
+        `identity-loaded` receivers are not called.
+
+        For example, after granting a role to a user::
+
+            principals.update_provisions(user.id, add=[RoleNeed('editor')])
+
+        The receivers should still provide the granted needs, so that the
+        identity gets them when it is next loaded.
+
+        :param identity_id: The id of the identity to update
+        :param add: The needs to add
+        :param remove: The needs to remove
+        """
+        add = frozenset(add)
+        remove = frozenset(remove)
+
+        if has_app_context():
+            identity = g.get('identity')
+            if identity is not None and identity.id == identity_id:
+                if isinstance(identity, _SharedAnonymousIdentity):
+                    identity = identity._private()
+                if isinstance(identity.provides, (CompactProvides, LazyProvides)):
+                    identity.provides = identity.provides.with_changes(add, remove)
+                else:
+                    identity.provides.difference_update(remove)
+                    identity.provides.update(add)
+
+        if self.provision_cache is not None:
+            self.provision_cache.update_provisions(identity_id, add, remove)
+
+        if identity_id is None:
+            for app, shared in list(self._anonymous_identities.items()):
+                identity = shared.copy()
+                identity.provides.difference_update(remove)
+                identity.provides.update(add)
+                self._anonymous_identities[app] = \
+                    _SharedAnonymousIdentity(identity)
+
+    def provider(
+        self,
+        name: Optional[str] = None,
+        requires: Iterable[str] = (),
+        timeout: Optional[float] = None,
+        blueprint: Union[str, Blueprint, None] = None
+    ) -> Callable[[F], F]:
+        """Decorator to define a function as a provisions provider.
+
+        Providers are an alternative to `identity-loaded` receivers. They are
+        called with the identity being loaded and return the needs it
+        provides. Providers that do not depend on each other run concurrently
+        in the principal's thread pool, and their needs are added to the
+        identity in the order the providers were defined, before the
+        `identity-loaded` signal is sent.
+
+        A provider runs after the providers it ``requires``, which can for
+        example store what they loaded on the identity for it::
+
+            @principals.provider()
+            def user(identity):
+                identity.user = db.get_user(identity.id)
+                return [RoleNeed(role.name) for role in identity.user.roles]
+
+            @principals.provider(requires=['user'])
+            def flags(identity):
+                return [ActionNeed(flag) for flag in flag_store.on_for(identity.user)]
+
+        Providers may be coroutine functions, they then run concurrently as
+        tasks of an event loop. How long each provider takes is recorded in
+        :attr:`provider_timings`.
+
+        :param name: The name of the provider, the function name by default
+        :param requires: The names of the providers to run before this one,
+                         which must already be defined.
+        :param timeout: The time budget of the provider, see
+                        :meth:`time_budget`.
+        :param blueprint: The blueprint whose provider chain to add the
+                          provider to, see :meth:`identity_loader`.
+        """
+        def decorator(f: F) -> F:
+            provider_name = name or f.__name__
+            if blueprint is None:
+                providers = self.providers
+            else:
+                providers = self._blueprint_providers.setdefault(
+                    _blueprint_name(blueprint), OrderedDict())
+                self._endpoint_chains.clear()
+            for dependency in requires:
+                if dependency not in providers:
+                    raise ValueError(f'Unknown provider {dependency!r}')
+            providers[provider_name] = _Provider(
+                provider_name, f, tuple(requires))
+            if timeout is not None:
+                self._time_budgets[f] = timeout
+            return f
+        return decorator
+
+    def identity_loader(
+        self,
+        f: Optional[Callable[[], Optional[Identity]]] = None,
+        fingerprint: Optional[Callable[[], Optional[Hashable]]] = None,
+        timeout: Optional[float] = None,
+        header: Optional[str] = None,
+        cookie: Optional[str] = None,
+        path_prefix: Optional[str] = None,
+        blueprint: Union[str, Blueprint, None] = None
+    ) -> Any:
         """Decorator to define a function as an identity loader.
 
         An identity loader function is called before request to find any
@@ -555,11 +3498,107 @@ class Principal(object):
             @principals.identity_loader
             def load_identity_from_weird_usecase():
                 return Identity('ali')
+
+        Loaders may be coroutine functions, as may savers and
+        `identity-loaded` receivers. They are run with
+        :meth:`flask.Flask.ensure_sync`, which needs Flask's ``async`` extra,
+        or, when the identity is set from an async view, in a thread of
+        their own. Async views may instead await
+        :meth:`set_identity_async`, which does not block their event loop.
+
+        When the principal has a :class:`NegativeCache`, a loader may pass a
+        ``fingerprint`` function returning a key for the credential it is
+        about to check, or ``None`` if there is no such credential. When no
+        loader accepts the request, the fingerprint is remembered and later
+        requests presenting the same credential are anonymous straight away::
+
+            @principals.identity_loader(
+                fingerprint=lambda: request.headers.get('X-Api-Token'))
+            def load_identity_from_token():
+                return lookup_token(request.headers.get('X-Api-Token'))
+
+        A loader may also declare cheap preconditions, a request ``header``,
+        a ``cookie`` or a ``path_prefix``, and is then only called for the
+        requests meeting all of them::
+
+            @principals.identity_loader(header='Authorization')
+            def load_identity_from_bearer_token():
+                return lookup_token(request.headers['Authorization'])
+
+        Loaders, savers and providers may also be defined for a
+        ``blueprint`` (its name, dotted for nested blueprints, or the
+        blueprint itself). The requests to a blueprint's endpoints then only
+        use the blueprint's loaders instead of the application's, and the
+        same goes for its savers and providers. A nested blueprint without
+        its own uses those of its parent::
+
+            @principals.identity_loader(blueprint='api', header='Authorization')
+            def load_identity_from_api_token():
+                return lookup_token(request.headers['Authorization'])
+
+        :param fingerprint: Returns the fingerprint of the credential checked
+                            by the loader.
+        :param timeout: The time budget of the loader, see
+                        :meth:`time_budget`.
+        :param header: Only call the loader when this header is sent.
+        :param cookie: Only call the loader when this cookie is sent.
+        :param path_prefix: Only call the loader for paths starting with
+                            this prefix.
+        :param blueprint: The blueprint whose loader chain to add the loader
+                          to.
         """
-        self.identity_loaders.appendleft(f)
+        if f is None:
+            return partial(self.identity_loader, fingerprint=fingerprint,
+                           timeout=timeout, header=header, cookie=cookie,
+                           path_prefix=path_prefix, blueprint=blueprint)
+
+        options = {
+            'fingerprint': fingerprint,
+            'header': header,
+            'cookie': cookie,
+            'path_prefix': path_prefix,
+        }
+        options = {k: v for k, v in options.items() if v is not None}
+        if options:
+            self._loader_options.setdefault(f, {}).update(options)
+        if timeout is not None:
+            self._time_budgets[f] = timeout
+        if blueprint is None:
+            self.identity_loaders.appendleft(f)
+        else:
+            self._blueprint_loaders.setdefault(
+                _blueprint_name(blueprint), deque()).appendleft(f)
+            self._endpoint_chains.clear()
         return f
 
-    def identity_saver(self, f: Callable[[Identity], None]) -> Callable[[Identity], None]:
+    def time_budget(self, seconds: float) -> Callable[[F], F]:
+        """Decorator giving an identity loader or an `identity-loaded`
+        receiver its own time budget.
+
+        A function with a time budget runs in the principal's thread pool.
+        When it does not return within budget the request carries on as set
+        by ``timeout_fallback``, while the function keeps running in the
+        background. For example::
+
+            @identity_loaded.connect_via(app)
+            @principals.time_budget(0.25)
+            def on_identity_loaded(sender, identity):
+                for group in ldap.groups(identity.id):
+                    identity.provides.add(RoleNeed(group))
+
+        :param seconds: The time budget, in seconds
+        """
+        def decorator(f: F) -> F:
+            self._time_budgets[f] = seconds
+            self._receivers_version += 1
+            return f
+        return decorator
+
+    def identity_saver(
+        self,
+        f: Optional[Callable[[Identity], None]] = None,
+        blueprint: Union[str, Blueprint, None] = None
+    ) -> Any:
         """Decorator to define a function as an identity saver.
 
         An identity loader saver is called when the identity is set to persist
@@ -574,35 +3613,400 @@ class Principal(object):
             @principals.identity_saver
             def save_identity_to_weird_usecase(identity):
                 my_special_cookie['identity'] = identity
+
+        :param blueprint: The blueprint whose saver chain to add the saver
+                          to, see :meth:`identity_loader`.
         """
-        self.identity_savers.appendleft(f)
+        if f is None:
+            return partial(self.identity_saver, blueprint=blueprint)
+
+        if blueprint is None:
+            self.identity_savers.appendleft(f)
+        else:
+            self._blueprint_savers.setdefault(
+                _blueprint_name(blueprint), deque()).appendleft(f)
+            self._endpoint_chains.clear()
         return f
 
-    def _set_thread_identity(self, identity: Identity) -> None:
+    def _set_thread_identity(self, identity: Identity, key: Optional[Hashable] = None) -> None:
         g.identity = identity
-        identity_loaded.send(current_app._get_current_object(),  # type: ignore
-                           identity=identity)
+        if key is None:
+            key = _identity_key(identity, self._chain(_PROVIDERS))
+        cache = self.provision_cache
+        if cache is not None and cache.ttl is not None:
+            provides = cache.get(key, fresh=True)
+            if provides is not None:
+                _merge_provisions(identity, provides)
+                if identity.tenant is not None:
+                    identity.provides_for(identity.tenant).update(
+                        cache.partition(key))
+                return
+
+        try:
+            if self.single_flight is None:
+                self._load_identity(identity, key)
+                return
+
+            # Requests for the same identity arriving while it is being
+            # provisioned wait for that run and copy its outcome.
+            (provides, state), shared = self.single_flight.do(
+                key, partial(self._load_identity, identity, key))
+        except DeadlineExceeded:
+            self._on_deadline_exceeded(identity, key)
+            return
+
+        if shared:
+            _adopt_provisions(identity, provides, state)
+
+    def _load_identity(self, identity: Identity, key: Hashable) -> Tuple[frozenset, Dict[str, Any]]:
+        providers = self._chain_providers()
+        if providers:
+            self._run_providers(identity, providers)
+        self._send_identity_loaded(identity)
+        provides = _frozen(identity.provides)
+        if self.provision_cache is not None:
+            expiries: Dict[Any, float] = {}
+            partition = _partition(identity)
+            for needs in (identity.provides, partition):
+                if isinstance(needs, Provides):
+                    expiries.update(needs.expiring())
+            self.provision_cache.set(
+                key, provides, expiries,
+                _frozen(partition) if partition else None)
+        return provides, _identity_state(identity)
+
+    def _run_providers(self, identity: Identity, providers: 'OrderedDict[str, _Provider]') -> None:
+        chain = list(providers.values())
+        results: Dict[str, Optional[Iterable[Any]]] = {}
+
+        if any(iscoroutinefunction(p.f) for p in chain):
+            results = _ensure_sync(self._run_providers_async)(
+                identity, chain)
+        elif len(chain) == 1 and chain[0].f not in self._time_budgets:
+            results[chain[0].name] = self._call_provider(chain[0], identity)
+        else:
+            pending = list(chain)
+            running: Dict[futures.Future, Tuple[_Provider, Optional[float]]] = {}
+            executor = self._get_executor()
+            while pending or running:
+                for provider in list(pending):
+                    if all(name in results for name in provider.requires):
+                        pending.remove(provider)
+                        budget = self._time_budgets.get(provider.f)
+                        deadline = None if budget is None \
+                            else time.monotonic() + budget
+                        context = contextvars.copy_context()
+                        future = executor.submit(
+                            context.run, self._call_provider, provider, identity)
+                        running[future] = (provider, deadline)
+
+                deadlines = [d for p, d in running.values() if d is not None]
+                timeout = None
+                if deadlines:
+                    timeout = max(0.0, min(deadlines) - time.monotonic())
+                done, _ = futures.wait(
+                    running, timeout, return_when=futures.FIRST_COMPLETED)
+
+                for future in done:
+                    provider, deadline = running.pop(future)
+                    results[provider.name] = future.result()
+
+                now = time.monotonic()
+                for future, (provider, deadline) in running.items():
+                    if deadline is not None and deadline <= now:
+                        future.cancel()
+                        self._count_timeout(provider.f)
+                        raise DeadlineExceeded(provider.f)
+
+        for provider in chain:
+            needs = results[provider.name]
+            if needs:
+                identity.provides.update(needs)
+
+    async def _run_providers_async(self, identity: Identity, providers: list) -> Dict[str, Any]:
+        # Coroutine providers run as tasks of one event loop, so their I/O
+        # overlaps, the others still run in the thread pool.
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        tasks: Dict[str, asyncio.Future] = {}
+
+        async def run(provider: _Provider) -> Any:
+            if provider.requires:
+                await asyncio.gather(*[tasks[name] for name in provider.requires])
+            call: Awaitable[Any]
+            if iscoroutinefunction(provider.f):
+                call = self._call_provider_async(provider, identity)
+            else:
+                context = contextvars.copy_context()
+                call = loop.run_in_executor(
+                    executor, context.run, self._call_provider, provider,
+                    identity)
+            budget = self._time_budgets.get(provider.f)
+            if budget is None:
+                return await call
+            try:
+                return await asyncio.wait_for(call, budget)
+            except asyncio.TimeoutError:
+                self._count_timeout(provider.f)
+                raise DeadlineExceeded(provider.f) from None
+
+        for provider in providers:
+            tasks[provider.name] = asyncio.ensure_future(run(provider))
+        try:
+            values = await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                task.cancel()
+        return dict(zip(tasks, values))
+
+    def _call_provider(self, provider: _Provider, identity: Identity) -> Optional[Iterable[Any]]:
+        started = time.perf_counter()
+        try:
+            return provider.f(identity)
+        finally:
+            self._record_timing(provider, time.perf_counter() - started)
+
+    async def _call_provider_async(self, provider: _Provider, identity: Identity) -> Optional[Iterable[Any]]:
+        started = time.perf_counter()
+        try:
+            return await provider.f(identity)
+        finally:
+            self._record_timing(provider, time.perf_counter() - started)
+
+    def _record_timing(self, provider: _Provider, elapsed: float) -> None:
+        with self._lock:
+            timing = self.provider_timings.get(provider.name)
+            if timing is None:
+                timing = ProviderTiming(0, 0.0, 0.0)
+            self.provider_timings[provider.name] = ProviderTiming(
+                timing.calls + 1, timing.total + elapsed, elapsed)
+
+    def _send_identity_loaded(self, identity: Identity) -> None:
+        # This is ``identity_loaded.send(app, identity=identity)``, minus
+        # looking the receivers up again on every request.
+        if not identity_loaded.receivers \
+                or getattr(identity_loaded, 'is_muted', False):
+            return
+
+        sender = current_app._get_current_object()  # type: ignore
+        snapshot = self._receiver_snapshots.get(sender)
+        if snapshot is None or snapshot.version != self._receivers_version:
+            snapshot = self._receiver_snapshots[sender] = _ReceiverSnapshot(
+                sender, self._receivers_version, self._time_budgets,
+                self.receiver_timeout)
+
+        for ref, direct, budget in snapshot.receivers:
+            receiver = ref()
+            if receiver is None:
+                continue
+            if direct:
+                receiver(sender, identity=identity)
+            else:
+                self._call_with_budget(budget, receiver, sender, identity=identity)
+
+    def _call_with_budget(self, budget: Optional[float], f: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        call = _ensure_sync(f)
+        if budget is None:
+            return call(*args, **kwargs)
+
+        # The function runs in the context of the request, but in a thread
+        # that may outlive the budget.
+        context = contextvars.copy_context()
+        future = self._get_executor().submit(context.run, call, *args, **kwargs)
+        try:
+            return future.result(timeout=budget)
+        except futures.TimeoutError:
+            future.cancel()
+            self._count_timeout(f)
+            raise DeadlineExceeded(f) from None
+
+    def _count_timeout(self, f: Callable[..., Any]) -> None:
+        with self._lock:
+            self.timeouts[getattr(f, '__qualname__', repr(f))] += 1
+
+    def _get_executor(self) -> futures.ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = futures.ThreadPoolExecutor(
+                        self.max_workers, thread_name_prefix='flask-principal')
+        return self._executor
+
+    def _on_deadline_exceeded(self, identity: Identity, key: Optional[Hashable] = None) -> None:
+        if self.timeout_fallback == 'abort':
+            abort(503)
+
+        if self.timeout_fallback == 'stale' and key is not None \
+                and self.provision_cache is not None:
+            provides = self.provision_cache.get(key)
+            if provides is not None:
+                # The late receiver may still change the original identity
+                stale = copy.copy(identity)
+                stale.provides = Provides()
+                _merge_provisions(stale, provides)
+                if stale.tenant is not None:
+                    stale.tenant_provides = {}
+                    _update_provides(stale.provides_for(stale.tenant),
+                                     self.provision_cache.partition(key))
+                g.identity = stale
+                return
 
-    def _on_identity_changed(self, app: Flask, identity: Identity) -> None:
-        if self._is_static_route():
+        g.identity = AnonymousIdentity()
+
+    def _on_identity_changed(self, app: Flask, identity: Identity, force: bool = False) -> None:
+        if self._is_skipped_route():
             return
 
-        self.set_identity(identity)
+        self.set_identity(identity, force=force)
 
     def _on_before_request(self) -> None:
-        if self._is_static_route():
+        if self._is_skipped_route():
+            if self._view_permissions:
+                self._deny_skipped_endpoint()
             return
 
-        g.identity = AnonymousIdentity()
-        for loader in self.identity_loaders:
-            identity = loader()
+        self._load_request_identity()
+        if self._view_permissions:
+            self._enforce_endpoint_permissions()
+
+    def _load_request_identity(self) -> None:
+        g.identity = self._anonymous_identity()
+        rejected = []
+        for loader in self._select_loaders():
+            options = self._loader_options.get(loader)
+            if options and self.negative_cache is not None \
+                    and 'fingerprint' in options:
+                fingerprint = options['fingerprint']()
+                if fingerprint is not None:
+                    if fingerprint in self.negative_cache:
+                        return
+                    rejected.append(fingerprint)
+
+            budget = self._time_budgets.get(loader, self.loader_timeout)
+            try:
+                identity = self._call_with_budget(budget, loader)
+            except DeadlineExceeded:
+                self._on_deadline_exceeded(g.identity)
+                return
             if identity is not None:
                 self.set_identity(identity)
                 return
 
-    def _is_static_route(self) -> bool:
-        return bool(
-            self.skip_static and
-            self._static_path and 
-            request.path.startswith(self._static_path)
-        )
+        for fingerprint in rejected:
+            self.negative_cache.add(fingerprint)  # type: ignore
+
+    def _enforce_endpoint_permissions(self) -> None:
+        if request.endpoint is None:
+            return
+        for permission, http_exception in self.endpoint_permissions.get(
+                request.endpoint, ()):
+            permission.test(http_exception)
+
+    def _deny_skipped_endpoint(self) -> None:
+        if request.endpoint is None:
+            return
+        # An ignored request has no identity to check the permissions with
+        for permission, http_exception in self.endpoint_permissions.get(
+                request.endpoint, ()):
+            if http_exception:
+                abort(http_exception, permission)
+            raise PermissionDenied(permission)
+
+    def _anonymous_identity(self) -> AnonymousIdentity:
+        if not self.anonymous_provisions:
+            return AnonymousIdentity()
+
+        app = current_app._get_current_object()  # type: ignore
+        shared = self._anonymous_identities.get(app)
+        if shared is not None and shared._expires_at is not None \
+                and shared._expires_at <= time.time():
+            # the copy leaves the expired needs out
+            shared = self._anonymous_identities[app] = \
+                _SharedAnonymousIdentity(shared.copy())
+        if shared is None:
+            identity = AnonymousIdentity()
+            try:
+                self._send_identity_loaded(identity)
+            except DeadlineExceeded:
+                return AnonymousIdentity()
+            shared = self._anonymous_identities[app] = \
+                _SharedAnonymousIdentity(identity)
+        return shared
+
+    def _on_receivers_changed(self, signal: Any, **kwargs: Any) -> None:
+        self._receivers_version += 1
+        self._anonymous_identities.clear()
+
+    def _select_loaders(self) -> list:
+        app = current_app._get_current_object()  # type: ignore
+        chain = self._chain(_LOADERS)
+        if chain is None:
+            loaders = tuple(self.identity_loaders)
+        else:
+            loaders = tuple(self._blueprint_loaders[chain])
+        index = self._loader_indexes.get(chain)
+        if index is None or index.app is not app or index.loaders != loaders:
+            index = self._loader_indexes[chain] = _LoaderIndex(
+                app, loaders, self._loader_options)
+        return index.select(request)
+
+    def _chain(self, kind: int) -> Optional[str]:
+        """The blueprint whose loaders, savers or providers the current
+        request uses, ``None`` for the application's.
+        """
+        if not has_request_context():
+            return None
+        endpoint = request.endpoint
+        if endpoint is None:
+            return None
+        chains = self._endpoint_chains.get(endpoint)
+        if chains is None:
+            # from the innermost blueprint of the endpoint outwards
+            parts = endpoint.split('.')[:-1]
+            names = ['.'.join(parts[:i]) for i in range(len(parts), 0, -1)]
+            chains = self._endpoint_chains[endpoint] = tuple(
+                next((name for name in names if name in registry), None)
+                for registry in (self._blueprint_loaders,
+                                 self._blueprint_savers,
+                                 self._blueprint_providers))
+        return chains[kind]
+
+    def _chain_savers(self) -> Deque[Callable[[Identity], None]]:
+        chain = self._chain(_SAVERS)
+        if chain is None:
+            return self.identity_savers
+        return self._blueprint_savers[chain]
+
+    def _chain_providers(self) -> 'OrderedDict[str, _Provider]':
+        chain = self._chain(_PROVIDERS)
+        if chain is None:
+            return self.providers
+        return self._blueprint_providers[chain]
+
+    def _is_skipped_route(self) -> bool:
+        if self._skip_trie.match(request.path):
+            return True
+
+        endpoint = request.endpoint
+        if endpoint is None:
+            return False
+        app = current_app._get_current_object()  # type: ignore
+        skipped = self._skipped_endpoints.get(app)
+        if skipped is None:
+            skipped = self._skipped_endpoints[app] = {}
+        decision = skipped.get(endpoint)
+        if decision is None:
+            decision = skipped[endpoint] = self._is_skipped_endpoint(app, endpoint)
+        return decision
+
+    def _is_skipped_endpoint(self, app: Flask, endpoint: str) -> bool:
+        if endpoint in self.skip_endpoints:
+            return True
+        if self.skip_blueprints and not self.skip_blueprints.isdisjoint(
+                _endpoint_blueprints(endpoint)):
+            return True
+        if self.skip_static and endpoint == 'static':
+            return True
+        return bool(self._exempt_views) and any(
+            f in self._exempt_views
+            for f in _view_chain(app.view_functions.get(endpoint)))
@@ -1,14 +1,37 @@
 
 from __future__ import with_statement
 
+import asyncio
+import gc
+import io
+import json
+import os
+import pickle
+import random
+import tempfile
+import sqlite3
+import threading
+import time
 import unittest
 
-from flask import Flask, Response
+import pytest
 
-from flask_principal import BasePermission, OrPermission, AndPermission
+from flask import Blueprint, Flask, Response, g, render_template_string, \
+    request
+
+from flask_principal import BasePermission, OrPermission, AndPermission, Need
 from flask_principal import NotPermission
 from flask_principal import Principal, Permission, Denial, RoleNeed, \
-    PermissionDenied, identity_changed, Identity, identity_loaded
+    PermissionDenied, identity_changed, Identity, identity_loaded, \
+    session_identity_loader
+from flask_principal import AnonymousIdentity, CompactProvides, DecisionCache, \
+    LazyProvides, MappedNeedFile, SQLiteNeedStore, NegativeCache, ProvisionCache, \
+    Provides, SingleFlight, UserNeed, add_fingerprint_headers, \
+    fingerprint_cache_key, set_decision_cache
+from flask_principal import ITEM, IdentitySnapshot, ItemNeed, PredicateNeed, \
+    PermissionRegistry, _PrefixTrie, _need_digest, _needs_key, bind_item, \
+    evaluate_access, sql_filter, sqlalchemy_filter, write_access_csv, \
+    write_access_jsonl
 
 anon_permission = Permission()
 admin_permission = Permission(RoleNeed('admin'))
@@ -703,3 +726,2107 @@ class PrincipalApplicationTests(unittest.TestCase):
 class FactoryMethodPrincipalApplicationTests(PrincipalApplicationTests):
     def setUp(self):
         self.client = mkapp(with_factory=True).test_client()
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    def test_coalesces_concurrent_provisioning(self):
+        app = Flask(__name__)
+        principal = Principal(app, use_sessions=False, single_flight=True)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def on_loaded(sender, identity):
+            calls.append(identity.id)
+            started.set()
+            release.wait(5)
+            identity.provides.add(RoleNeed('admin'))
+            identity.user = 'ali-user'
+
+        identity_loaded.connect(on_loaded, app)
+        results = {}
+
+        def worker(name):
+            with app.test_request_context():
+                identity = Identity('ali')
+                principal.set_identity(identity)
+                results[name] = identity
+
+        first = threading.Thread(target=worker, args=('first',))
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=worker, args=('second',))
+        second.start()
+        while principal.single_flight.coalesced < 1:
+            time.sleep(0.001)
+        release.set()
+        first.join(5)
+        second.join(5)
+
+        assert calls == ['ali']
+        assert principal.single_flight.calls == 1
+        assert principal.single_flight.coalesced == 1
+        assert results['second'].provides == {RoleNeed('admin')}
+        assert results['second'].user == 'ali-user'
+        assert results['second'] is not results['first']
+
+    def test_failed_call_is_not_cached(self):
+        flight = SingleFlight()
+        self.assertRaises(ZeroDivisionError, flight.do, 'key', lambda: 1 / 0)
+        assert flight.do('key', lambda: 'ok') == ('ok', False)
+        assert flight.calls == 2
+        assert flight.coalesced == 0
+
+
+class NegativeCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.cache = NegativeCache(ttl=60)
+        self.principal = Principal(
+            self.app, use_sessions=False, negative_cache=self.cache)
+        self.lookups = []
+
+        @self.principal.identity_loader(
+            fingerprint=lambda: request.headers.get('X-Token'))
+        def load_from_token():
+            token = request.headers.get('X-Token')
+            self.lookups.append(token)
+            if token == 'good':
+                return Identity('ali')
+            return None
+
+        @self.app.route('/')
+        def index():
+            return Response(str(g.identity.id))
+
+    def test_rejected_credential_short_circuits(self):
+        client = self.app.test_client()
+        assert client.get('/', headers={'X-Token': 'bad'}).data == b'None'
+        assert client.get('/', headers={'X-Token': 'bad'}).data == b'None'
+        assert self.lookups == ['bad']
+        assert 'bad' in self.cache
+
+    def test_accepted_and_missing_credentials_are_not_cached(self):
+        client = self.app.test_client()
+        assert client.get('/', headers={'X-Token': 'good'}).data == b'ali'
+        assert client.get('/', headers={'X-Token': 'good'}).data == b'ali'
+        assert client.get('/').data == b'None'
+        assert self.lookups == ['good', 'good', None]
+        assert len(self.cache) == 0
+
+    def test_expiry_and_discard(self):
+        cache = NegativeCache(ttl=0)
+        cache.add('bad')
+        assert 'bad' not in cache
+        self.cache.add('bad')
+        self.cache.discard('bad')
+        assert 'bad' not in self.cache
+
+    def test_maxsize(self):
+        cache = NegativeCache(maxsize=2)
+        for token in ('a', 'b', 'c'):
+            cache.add(token)
+        assert 'a' not in cache
+        assert 'b' in cache and 'c' in cache
+        assert cache.hits == 2
+
+
+class TimeBudgetTests(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def mkapp(self, **kwargs):
+        app = Flask(__name__)
+        principal = Principal(app, use_sessions=False, **kwargs)
+
+        @app.route('/')
+        def index():
+            return Response('{0} {1}'.format(
+                g.identity.id, sorted(n.value for n in g.identity.provides)))
+
+        return app, principal
+
+    def test_slow_loader_falls_back_to_anonymous(self):
+        app, principal = self.mkapp()
+
+        @principal.identity_loader(timeout=0.01)
+        def slow_loader():
+            self.release.wait(5)
+            return Identity('ali')
+
+        assert app.test_client().get('/').data == b'None []'
+        assert principal.timeouts == {slow_loader.__qualname__: 1}
+
+    def test_slow_receiver_aborts(self):
+        app, principal = self.mkapp(
+            receiver_timeout=0.01, timeout_fallback='abort')
+        principal.identity_loader(lambda: Identity('ali'))
+
+        def on_loaded(sender, identity):
+            self.release.wait(5)
+
+        identity_loaded.connect(on_loaded, app)
+        assert app.test_client().get('/').status_code == 503
+        assert sum(principal.timeouts.values()) == 1
+
+    def test_slow_receiver_uses_stale_provisions(self):
+        cache = ProvisionCache()
+        app, principal = self.mkapp(
+            timeout_fallback='stale', provision_cache=cache)
+        principal.identity_loader(lambda: Identity('ali'))
+        slow = []
+
+        @principal.time_budget(0.05)
+        def on_loaded(sender, identity):
+            if slow:
+                self.release.wait(5)
+            identity.provides.add(RoleNeed('admin'))
+
+        identity_loaded.connect(on_loaded, app)
+        client = app.test_client()
+        assert client.get('/').data == b"ali ['admin']"
+        assert len(cache) == 1
+        slow.append(True)
+        assert client.get('/').data == b"ali ['admin']"
+        assert principal.timeouts == {on_loaded.__qualname__: 1}
+
+    def test_fresh_provisions_skip_receivers(self):
+        app, principal = self.mkapp(provision_cache=ProvisionCache(ttl=60))
+        principal.identity_loader(lambda: Identity('ali'))
+        calls = []
+
+        def on_loaded(sender, identity):
+            calls.append(identity.id)
+            identity.provides.add(RoleNeed('admin'))
+
+        identity_loaded.connect(on_loaded, app)
+        client = app.test_client()
+        assert client.get('/').data == b"ali ['admin']"
+        assert client.get('/').data == b"ali ['admin']"
+        assert calls == ['ali']
+
+    def test_unknown_fallback(self):
+        self.assertRaises(ValueError, Principal, timeout_fallback='retry')
+
+
+class LoaderRoutingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.secret_key = 'notverysecret'
+        self.principal = Principal(self.app)
+        self.calls = []
+
+        @self.principal.identity_loader(header='X-Token')
+        def token_loader():
+            self.calls.append('token')
+            return Identity(request.headers['X-Token'])
+
+        @self.principal.identity_loader(cookie='remember', path_prefix='/api')
+        def remember_loader():
+            self.calls.append('remember')
+            return None
+
+        @self.app.route('/')
+        @self.app.route('/api/')
+        def index():
+            return Response(str(g.identity.id))
+
+        @self.app.route('/login')
+        def login():
+            identity_changed.send(self.app, identity=Identity('ali'))
+            return Response('')
+
+    def test_loaders_without_preconditions_met_are_skipped(self):
+        client = self.app.test_client()
+        assert client.get('/').data == b'None'
+        client.set_cookie('remember', 'yes')
+        assert client.get('/').data == b'None'
+        assert self.calls == []
+        assert client.get('/api/').data == b'None'
+        assert self.calls == ['remember']
+
+    def test_loaders_run_in_order(self):
+        client = self.app.test_client()
+        client.set_cookie('remember', 'yes')
+        response = client.get('/api/', headers={'X-Token': 'token-user'})
+        assert response.data == b'token-user'
+        assert self.calls == ['remember', 'token']
+
+    def test_session_loader_needs_session_cookie(self):
+        client = self.app.test_client()
+        with self.app.test_request_context():
+            selected = self.principal._select_loaders()
+        assert session_identity_loader not in selected
+        client.get('/login')
+        assert client.get('/').data == b'ali'
+
+    def test_index_follows_registered_loaders(self):
+        client = self.app.test_client()
+        client.get('/')
+        self.principal.identity_loader(lambda: Identity('late'))
+        assert client.get('/').data == b'late'
+
+
+class AnonymousProvisionsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.principal = Principal(
+            self.app, use_sessions=False, anonymous_provisions=True)
+        self.calls = []
+
+        def on_loaded(sender, identity):
+            self.calls.append(identity.id)
+            if identity.id is None:
+                identity.provides.add(RoleNeed('public'))
+
+        self.on_loaded = on_loaded
+        identity_loaded.connect(on_loaded, self.app)
+        self.seen = []
+
+        @self.app.route('/')
+        def index():
+            self.seen.append(g.identity)
+            with Permission(RoleNeed('public')).require():
+                return Response('public')
+
+    def test_anonymous_identity_is_provisioned_once(self):
+        client = self.app.test_client()
+        assert client.get('/').data == b'public'
+        assert client.get('/').data == b'public'
+        assert self.calls == [None]
+        assert self.seen[0] is self.seen[1]
+        assert isinstance(self.seen[0], AnonymousIdentity)
+
+    def test_shared_identity_is_copy_on_write(self):
+        @self.app.route('/write')
+        def write():
+            shared = g.identity
+            shared.provides.add(RoleNeed('x'))
+            shared.user = 'guest'
+            self.seen.append(g.identity)
+            return Response(str(Permission(RoleNeed('x')).can()))
+
+        client = self.app.test_client()
+        client.get('/')
+        shared = self.seen[0]
+        self.assertRaises(AttributeError, setattr, shared, 'user', None)
+        assert isinstance(shared.provides, frozenset)
+        private = shared.copy()
+        private.provides.add(RoleNeed('x'))
+        assert private.provides == {RoleNeed('public'), RoleNeed('x')}
+        assert shared.provides == {RoleNeed('public')}
+
+        assert client.get('/write').data == b'True'
+        assert self.seen[1] is not shared
+        assert self.seen[1].provides == {RoleNeed('public'), RoleNeed('x')}
+        assert self.seen[1].user == 'guest'
+        assert 'user' not in vars(shared)
+        assert client.get('/').data == b'public'
+        assert self.seen[2] is shared
+
+    def test_tenant_needs_are_copied_on_write(self):
+        def on_loaded(sender, identity):
+            identity.provides_for('beta').add(RoleNeed('tester'))
+
+        identity_loaded.connect(on_loaded, self.app)
+        self.addCleanup(identity_loaded.disconnect, on_loaded, self.app)
+
+        @self.app.route('/<tenant>/<grant>')
+        def tenant(tenant, grant):
+            g.identity.tenant = tenant
+            if grant == 'grant':
+                g.identity.provides_for(tenant).add(RoleNeed('admin'))
+                g.identity.tenant_provides['beta'].add(RoleNeed('admin'))
+            return Response('{0} {1}'.format(
+                Permission(RoleNeed('admin')).can(),
+                Permission(RoleNeed('tester')).can()))
+
+        client = self.app.test_client()
+        assert client.get('/acme/grant').data == b'True False'
+        assert client.get('/beta/grant').data == b'True True'
+        assert client.get('/acme/check').data == b'False False'
+        assert client.get('/beta/check').data == b'False True'
+        client.get('/')
+        shared = self.seen[0]
+        with self.assertRaises(TypeError):
+            shared.tenant_provides['acme'] = Provides()
+        self.assertRaises(AttributeError, shared.provides_for, 'acme')
+
+    def test_copies_of_compact_provisions(self):
+        def on_loaded(sender, identity):
+            identity.provides = CompactProvides([RoleNeed('public')])
+
+        identity_loaded.disconnect(self.on_loaded, self.app)
+        identity_loaded.connect(on_loaded, self.app)
+        self.addCleanup(identity_loaded.disconnect, on_loaded, self.app)
+        assert self.app.test_client().get('/').data == b'public'
+        private = self.seen[0].copy()
+        assert private.can(Permission(RoleNeed('public')))
+        assert private.provides is self.seen[0].provides
+
+    def test_connecting_receivers_reprovisions(self):
+        client = self.app.test_client()
+        client.get('/')
+
+        def on_loaded_again(sender, identity):
+            self.calls.append('again')
+
+        identity_loaded.connect(on_loaded_again, self.app)
+        client.get('/')
+        assert self.calls == [None, None, 'again'] or \
+            self.calls == [None, 'again', None]
+
+
+class UnchangedIdentityTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.secret_key = 'notverysecret'
+        self.principal = Principal(self.app)
+        self.loaded = []
+        self.saved = []
+
+        def on_loaded(sender, identity):
+            self.loaded.append(identity.id)
+            identity.provides.add(RoleNeed('admin'))
+
+        self.on_loaded = on_loaded
+        identity_loaded.connect(on_loaded, self.app)
+        self.principal.identity_saver(lambda identity: self.saved.append(identity.id))
+
+    def test_unchanged_identity_is_not_reloaded(self):
+        with self.app.test_request_context():
+            self.principal.set_identity(Identity('ali'))
+            identity = Identity('ali')
+            identity_changed.send(self.app, identity=identity)
+            assert g.identity is identity
+            assert identity.provides == {RoleNeed('admin')}
+        assert self.loaded == ['ali']
+        assert self.saved == ['ali']
+
+    def test_loaded_identity_is_not_reloaded(self):
+        with self.app.test_request_context():
+            self.principal.set_identity(Identity('ali'))
+            identity_changed.send(self.app, identity=g.identity)
+            self.principal.set_identity(Identity('ali'))
+            assert g.identity.provides == {RoleNeed('admin')}
+        assert self.loaded == ['ali']
+        assert self.saved == ['ali']
+
+    def test_changed_identity_is_reloaded(self):
+        with self.app.test_request_context():
+            self.principal.set_identity(Identity('ali'))
+            self.principal.set_identity(Identity('ali', 'token'))
+            self.principal.set_identity(Identity('bob', 'token'))
+        assert self.loaded == ['ali', 'ali', 'bob']
+
+    def test_force(self):
+        with self.app.test_request_context():
+            self.principal.set_identity(Identity('ali'))
+            identity_changed.send(self.app, identity=Identity('ali'), force=True)
+        assert self.loaded == ['ali', 'ali']
+        assert self.saved == ['ali', 'ali']
+
+    def test_loaded_identity_is_not_reloaded_on_login(self):
+        @self.app.route('/login')
+        def login():
+            identity_changed.send(self.app, identity=Identity('ali'))
+            return Response(str(g.identity.id))
+
+        client = self.app.test_client()
+        client.get('/login')
+        client.get('/login')
+        assert self.loaded == ['ali', 'ali']
+
+
+class UpdateProvisionsTests(unittest.TestCase):
+
+    def test_current_identity_and_cache_are_patched(self):
+        app = Flask(__name__)
+        cache = ProvisionCache(ttl=60)
+        principal = Principal(app, use_sessions=False, provision_cache=cache)
+        calls = []
+
+        def on_loaded(sender, identity):
+            calls.append(identity.id)
+            identity.provides.add(RoleNeed('editor'))
+
+        identity_loaded.connect(on_loaded, app)
+        with app.test_request_context():
+            principal.set_identity(Identity('ali'))
+            principal.update_provisions(
+                'ali', add=[RoleNeed('admin')], remove=[RoleNeed('editor')])
+            assert g.identity.provides == {RoleNeed('admin')}
+            principal.update_provisions('bob', add=[RoleNeed('manager')])
+            assert g.identity.provides == {RoleNeed('admin')}
+
+        with app.test_request_context():
+            principal.set_identity(Identity('ali'))
+            assert g.identity.provides == {RoleNeed('admin')}
+        assert calls == ['ali']
+
+    def test_shared_anonymous_identity_is_patched(self):
+        app = Flask(__name__)
+        principal = Principal(
+            app, use_sessions=False, anonymous_provisions=True)
+
+        @app.route('/')
+        def index():
+            return Response(str(sorted(n.value for n in g.identity.provides)))
+
+        client = app.test_client()
+        assert client.get('/').data == b'[]'
+        with app.test_request_context():
+            app.preprocess_request()
+            principal.update_provisions(None, add=[RoleNeed('public')])
+            assert g.identity.provides == {RoleNeed('public')}
+        assert client.get('/').data == b"['public']"
+
+
+class FingerprintTests(unittest.TestCase):
+
+    def test_needs_need_not_be_tuples(self):
+        provides = Provides([42, 'admin'])
+        provides.add(frozenset(['x']))
+        provides.discard(42)
+        assert provides.fingerprint() == \
+            Provides(['admin', frozenset(['x'])]).fingerprint()
+        assert provides.fingerprint() != Provides([('admin',)]).fingerprint()
+
+    def test_fingerprint_is_maintained_incrementally(self):
+        provides = Provides([RoleNeed('admin'), ('role', 'editor')])
+        provides.add(RoleNeed('manager'))
+        provides |= {RoleNeed('reviewer')}
+        provides.discard(RoleNeed('editor'))
+        provides -= {RoleNeed('reviewer')}
+        provides.symmetric_difference_update([RoleNeed('a'), RoleNeed('admin')])
+        provides.intersection_update([RoleNeed('a'), RoleNeed('manager')])
+        assert provides == {RoleNeed('a'), RoleNeed('manager')}
+        assert provides.fingerprint() == Provides(provides).fingerprint()
+        provides.clear()
+        assert provides.fingerprint() == Provides().fingerprint()
+
+    def test_identities_with_same_provisions_share_fingerprint(self):
+        first = Identity('ali')
+        first.provides.update([RoleNeed('admin'), UserNeed('x')])
+        second = Identity('bob', 'token')
+        second.provides = {('id', 'x'), ('role', 'admin')}
+        assert first.fingerprint() == second.fingerprint()
+        second.provides.add(RoleNeed('editor'))
+        assert first.fingerprint() != second.fingerprint()
+
+    def test_fingerprint_survives_pickling(self):
+        identity = Identity('ali')
+        identity.provides.add(RoleNeed('admin'))
+        restored = pickle.loads(pickle.dumps(identity))
+        assert restored.fingerprint() == identity.fingerprint()
+        restored.provides.add(RoleNeed('editor'))
+        assert restored.fingerprint() == Provides(restored.provides).fingerprint()
+
+    def test_cache_key_and_headers(self):
+        app = Flask(__name__)
+        Principal(app, use_sessions=False)
+        app.after_request(add_fingerprint_headers)
+
+        @app.route('/')
+        def index():
+            return Response(fingerprint_cache_key('page', 1))
+
+        response = app.test_client().get('/')
+        fingerprint = AnonymousIdentity().fingerprint()
+        assert response.data == 'principal:{0}:page:1'.format(
+            fingerprint).encode()
+        assert response.headers['X-Principal-Fingerprint'] == fingerprint
+        assert 'X-Principal-Fingerprint' in response.vary
+        assert response.get_etag()[0].startswith(fingerprint + '.')
+
+
+class DecisionCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = DecisionCache(maxsize=8)
+        previous = set_decision_cache(self.cache)
+        self.addCleanup(set_decision_cache, previous)
+
+    def test_keys_are_kept_until_the_needs_change(self):
+        provides = Provides([RoleNeed('admin'), RoleNeed('editor')])
+        key = _needs_key(provides)
+        assert _needs_key(provides) is key
+        assert _needs_key(Provides(provides)) is key
+        provides.add(RoleNeed('admin'))
+        assert _needs_key(provides) is key
+        provides.grant(RoleNeed('user'), ttl=60)
+        assert _needs_key(provides) == key | {RoleNeed('user')}
+        provides.discard(RoleNeed('user'))
+        assert _needs_key(provides) is key
+
+    def test_colliding_fingerprints_do_not_share_decisions(self):
+        class Tag(object):
+            def __repr__(self):
+                return 'Tag'
+
+        granted, other = Tag(), Tag()
+        ali = Identity('ali')
+        ali.provides.add(granted)
+        bob = Identity('bob')
+        bob.provides.add(other)
+        assert ali.fingerprint() == bob.fingerprint()
+        assert ali.can(Permission(granted))
+        assert not bob.can(Permission(granted))
+
+    def test_decisions_are_shared_by_fingerprint(self):
+        ali = Identity('ali')
+        ali.provides.add(RoleNeed('admin'))
+        bob = Identity('bob')
+        bob.provides.add(RoleNeed('admin'))
+        assert ali.can(admin_or_editor)
+        assert bob.can(Permission(RoleNeed('editor'), RoleNeed('admin')))
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+        assert self.cache.hit_rate == 0.5
+
+    def test_changed_provisions_are_decided_again(self):
+        identity = Identity('ali')
+        assert not identity.can(admin_permission)
+        identity.provides.add(RoleNeed('admin'))
+        assert identity.can(admin_permission)
+        assert identity.can(~admin_denied & admin_permission)
+        assert not identity.can(admin_denied | ~admin_permission)
+        assert self.cache.hits == 0
+
+    def test_custom_permissions_are_not_cached(self):
+        identity = Identity('ali')
+        identity.provides.add(RoleNeed('admin'))
+        assert identity.can(admin_role_permission)
+        assert identity.can(admin_role_permission | editor_permission)
+        assert len(self.cache) == 0
+
+    def test_cache_is_bounded(self):
+        identity = Identity('ali')
+        for i in range(20):
+            identity.can(Permission(RoleNeed(str(i))))
+        assert len(self.cache) == 8
+
+
+class DecisionCachePrincipalApplicationTests(PrincipalApplicationTests):
+
+    def setUp(self):
+        previous = set_decision_cache(DecisionCache())
+        self.addCleanup(set_decision_cache, previous)
+        super().setUp()
+
+
+class ProviderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.principal = Principal(self.app, use_sessions=False)
+
+    def test_independent_providers_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        @self.principal.provider()
+        def user(identity):
+            barrier.wait()
+            identity.user = identity.id.upper()
+            return [UserNeed(identity.id)]
+
+        @self.principal.provider()
+        def groups(identity):
+            barrier.wait()
+            return [RoleNeed('staff')]
+
+        @self.principal.provider(requires=['user'])
+        def flags(identity):
+            return [Need('flag', identity.user)]
+
+        with self.app.test_request_context():
+            identity = Identity('sam')
+            self.principal.set_identity(identity)
+        assert identity.provides == {
+            UserNeed('sam'), RoleNeed('staff'), Need('flag', 'SAM')}
+        assert sorted(self.principal.provider_timings) == [
+            'flags', 'groups', 'user']
+        assert self.principal.provider_timings['user'].calls == 1
+
+    def test_provisions_are_added_before_receivers(self):
+        seen = []
+
+        @self.principal.provider(name='roles')
+        def load_roles(identity):
+            return [RoleNeed('admin')]
+
+        def on_loaded(sender, identity):
+            seen.append(set(identity.provides))
+
+        identity_loaded.connect(on_loaded, self.app)
+        with self.app.test_request_context():
+            self.principal.set_identity(Identity('sam'))
+        assert seen == [{RoleNeed('admin')}]
+
+    def test_slow_provider_runs_out_of_time(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        @self.principal.provider()
+        def fast(identity):
+            return [RoleNeed('fast')]
+
+        @self.principal.provider(timeout=0.01)
+        def slow(identity):
+            release.wait(5)
+
+        with self.app.test_request_context():
+            self.principal.set_identity(Identity('sam'))
+            assert isinstance(g.identity, AnonymousIdentity)
+        assert sum(self.principal.timeouts.values()) == 1
+
+    def test_unknown_dependency(self):
+        self.assertRaises(
+            ValueError, self.principal.provider(requires=['user']), len)
+
+
+class AsyncTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.secret_key = 'notverysecret'
+        self.principal = Principal(self.app)
+        identity_loaded.connect(_on_principal_init, self.app)
+        self.addCleanup(identity_loaded.disconnect, _on_principal_init, self.app)
+
+    def test_async_views(self):
+        @self.app.route('/decorated')
+        @admin_permission.require(403)
+        async def decorated():
+            return Response('hello')
+
+        @self.app.route('/managed')
+        async def managed():
+            async with admin_permission.require(403):
+                return Response('hello')
+
+        client = self.app.test_client()
+        assert client.get('/decorated').status_code == 403
+        assert client.get('/managed').status_code == 403
+
+        @self.principal.identity_loader
+        async def load_admin():
+            return Identity('admin')
+
+        assert client.get('/decorated').data == b'hello'
+        assert client.get('/managed').data == b'hello'
+
+    def test_async_saver_and_receiver(self):
+        saved = []
+
+        @self.principal.identity_saver
+        async def save(identity):
+            saved.append(identity.id)
+
+        async def on_loaded(sender, identity):
+            identity.provides.add(RoleNeed('async'))
+
+        identity_loaded.connect(on_loaded, self.app)
+        with self.app.test_request_context():
+            self.principal.set_identity(Identity('sam'))
+            assert g.identity.provides == {RoleNeed('async')}
+        assert saved == ['sam']
+
+    def test_login_from_async_views(self):
+        saved = []
+
+        @self.principal.identity_saver
+        async def save(identity):
+            saved.append(identity.id)
+
+        async def on_loaded(sender, identity):
+            identity.provides.add(RoleNeed('async'))
+
+        @self.app.route('/login')
+        async def login():
+            identity_changed.send(self.app, identity=Identity('sam'))
+            return Response(str(g.identity.provides == {RoleNeed('async')}))
+
+        @self.app.route('/login_async')
+        async def login_async():
+            await self.principal.set_identity_async(Identity('ali'))
+            return Response(str(RoleNeed('async') in g.identity.provides))
+
+        identity_loaded.connect(on_loaded, self.app)
+        try:
+            client = self.app.test_client()
+            assert client.get('/login').data == b'True'
+            assert client.get('/login_async').data == b'True'
+        finally:
+            identity_loaded.disconnect(on_loaded, self.app)
+        assert saved[-2:] == ['sam', 'ali']
+
+    def test_async_providers_overlap(self):
+        started = set()
+
+        async def wait_for(name, other):
+            started.add(name)
+            for _ in range(1000):
+                if other in started:
+                    return [RoleNeed(name)]
+                await asyncio.sleep(0.001)
+            raise AssertionError('providers did not overlap')
+
+        @self.principal.provider()
+        async def first(identity):
+            return await wait_for('first', 'second')
+
+        @self.principal.provider()
+        async def second(identity):
+            return await wait_for('second', 'first')
+
+        @self.principal.provider(requires=['first'])
+        def third(identity):
+            return [RoleNeed('third')]
+
+        with self.app.test_request_context():
+            self.principal.set_identity(Identity('sam'))
+            assert g.identity.provides == {
+                RoleNeed('first'), RoleNeed('second'), RoleNeed('third')}
+        assert self.principal.provider_timings['second'].calls == 1
+
+    def test_slow_async_provider_runs_out_of_time(self):
+        @self.principal.provider(timeout=0.01)
+        async def slow(identity):
+            await asyncio.sleep(5)
+
+        with self.app.test_request_context():
+            self.principal.set_identity(Identity('sam'))
+            assert isinstance(g.identity, AnonymousIdentity)
+        assert sum(self.principal.timeouts.values()) == 1
+
+
+class ReceiverDispatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.principal = Principal(self.app, use_sessions=False)
+        self.calls = []
+
+    def load(self):
+        with self.app.test_request_context():
+            self.principal.set_identity(Identity('sam'))
+
+    def test_snapshot_follows_connections(self):
+        def first(sender, identity):
+            self.calls.append('first')
+
+        def second(sender, identity):
+            self.calls.append('second')
+
+        identity_loaded.connect(first, self.app)
+        self.load()
+        snapshot = self.principal._receiver_snapshots[self.app]
+        self.load()
+        assert self.principal._receiver_snapshots[self.app] is snapshot
+
+        identity_loaded.connect(second, self.app)
+        self.load()
+        identity_loaded.disconnect(first)
+        self.load()
+        assert self.calls.count('first') == 3
+        assert self.calls.count('second') == 2
+
+    def test_collected_receivers_are_not_called(self):
+        def receiver(sender, identity):
+            self.calls.append('receiver')
+
+        identity_loaded.connect(receiver, self.app)
+        self.load()
+        del receiver
+        gc.collect()
+        self.load()
+        assert self.calls == ['receiver']
+
+    def test_budget_set_after_connecting(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def receiver(sender, identity):
+            release.wait(5)
+
+        identity_loaded.connect(receiver, self.app)
+        self.principal.time_budget(0.01)(receiver)
+        self.load()
+        assert sum(self.principal.timeouts.values()) == 1
+
+
+class SkipRulesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.principal = Principal(
+            self.app, use_sessions=False, skip_static=True,
+            skip_endpoints=['health'], skip_blueprints=['assets'],
+            skip_paths=['/metrics', '/public/'])
+        self.principal.identity_loader(lambda: Identity('sam'))
+
+        def identity_view():
+            return Response(str(getattr(g.get('identity'), 'id', 'skipped')))
+
+        for rule in ('/', '/health', '/metrics/cpu', '/public/x', '/publication'):
+            self.app.add_url_rule(rule, rule.strip('/').replace('/', '_') or
+                                  'index', identity_view)
+        self.app.add_url_rule('/healthz', 'health', identity_view)
+
+        assets = Blueprint('assets', __name__)
+        assets.add_url_rule('/css', 'css', identity_view)
+        self.app.register_blueprint(assets, url_prefix='/assets')
+
+        @self.app.route('/ping')
+        @self.principal.exempt
+        def ping():
+            return identity_view()
+
+    def get(self, path):
+        return self.app.test_client().get(path).data
+
+    def test_skipped_routes(self):
+        assert self.get('/') == b'sam'
+        assert self.get('/publication') == b'sam'
+        assert self.get('/metrics/cpu') == b'skipped'
+        assert self.get('/public/x') == b'skipped'
+        assert self.get('/healthz') == b'skipped'
+        assert self.get('/assets/css') == b'skipped'
+        assert self.get('/ping') == b'skipped'
+
+    def test_static_path_is_skipped(self):
+        with self.app.test_request_context('/static/app.css'):
+            assert self.principal._is_skipped_route()
+        with self.app.test_request_context('/'):
+            assert not self.principal._is_skipped_route()
+
+    def test_skip_decisions_are_memoized(self):
+        calls = []
+        is_skipped_endpoint = self.principal._is_skipped_endpoint
+
+        def counted(app, endpoint):
+            calls.append(endpoint)
+            return is_skipped_endpoint(app, endpoint)
+
+        self.principal._is_skipped_endpoint = counted
+        for _ in range(3):
+            assert self.get('/') == b'sam'
+            assert self.get('/healthz') == b'skipped'
+        assert calls == ['index', 'health']
+
+        self.principal.exempt(self.app.view_functions['index'])
+        assert self.get('/') == b'skipped'
+        assert calls == ['index', 'health', 'index']
+
+    def test_prefix_trie(self):
+        trie = _PrefixTrie(['/a/b', '/c'])
+        assert trie.match('/a/b/c')
+        assert trie.match('/c')
+        assert not trie.match('/a/')
+        assert not trie.match('')
+        assert _PrefixTrie(['']).match('/anything')
+        assert not _PrefixTrie([]).match('/anything')
+
+
+class BlueprintChainTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.secret_key = 'notverysecret'
+        self.principal = Principal(self.app)
+        self.calls = []
+
+        api = Blueprint('api', __name__)
+        v2 = Blueprint('v2', __name__)
+
+        def identity_view():
+            return Response('{0} {1}'.format(
+                g.identity.id, sorted(n.value for n in g.identity.provides)))
+
+        api.add_url_rule('/whoami', 'whoami', identity_view)
+        v2.add_url_rule('/whoami', 'whoami', identity_view)
+        api.register_blueprint(v2, url_prefix='/v2')
+        self.app.register_blueprint(api, url_prefix='/api')
+        self.app.add_url_rule('/whoami', 'whoami', identity_view)
+
+        @self.app.route('/login')
+        def login():
+            identity_changed.send(self.app, identity=Identity('sam'))
+            return Response('')
+
+        @self.principal.identity_loader(blueprint=api)
+        def load_from_token():
+            self.calls.append('token')
+            return Identity(request.headers.get('X-Token'), 'token')
+
+        @self.principal.identity_saver(blueprint='api')
+        def save_nothing(identity):
+            self.calls.append('save')
+
+        @self.principal.provider(blueprint='api.v2')
+        def v2_roles(identity):
+            return [RoleNeed('v2')]
+
+    def test_blueprint_chains(self):
+        client = self.app.test_client()
+        client.get('/login')
+        assert client.get('/whoami').data == b'sam []'
+        assert self.calls == []
+
+        response = client.get('/api/whoami', headers={'X-Token': 'bot'})
+        assert response.data == b'bot []'
+        assert self.calls == ['token', 'save']
+
+    def test_nested_blueprint_falls_back_to_parent(self):
+        client = self.app.test_client()
+        response = client.get('/api/v2/whoami', headers={'X-Token': 'bot'})
+        assert response.data == b"bot ['v2']"
+        assert self.calls == ['token', 'save']
+
+    def test_chains_are_resolved_once_per_endpoint(self):
+        client = self.app.test_client()
+        client.get('/api/v2/whoami')
+        assert self.principal._endpoint_chains['api.v2.whoami'] == (
+            'api', 'api', 'api.v2')
+
+
+class EndpointPermissionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.testing = True
+        self.principal = Principal(self.app, use_sessions=False)
+        self.calls = []
+        identity_loaded.connect(_on_principal_init, self.app)
+        self.addCleanup(identity_loaded.disconnect, _on_principal_init, self.app)
+
+        @self.principal.identity_loader
+        def load_from_header():
+            name = request.headers.get('X-User')
+            return Identity(name) if name else None
+
+        @self.app.route('/admin')
+        @self.principal.permission_required(admin_permission, http_exception=403)
+        def admin():
+            self.calls.append('admin')
+            return Response('admin')
+
+        @self.app.route('/editor')
+        @self.principal.permission_required(admin_permission)
+        @self.principal.permission_required(editor_permission)
+        def editor():
+            return Response('editor')
+
+        @self.app.route('/open')
+        def open_view():
+            return Response('open')
+
+    def test_permissions_are_enforced_before_the_view(self):
+        client = self.app.test_client()
+        assert client.get('/admin').status_code == 403
+        assert self.calls == []
+        assert client.get('/admin', headers={'X-User': 'admin'}).data == b'admin'
+        assert client.get('/open').data == b'open'
+
+    def test_all_permissions_are_required(self):
+        client = self.app.test_client()
+        self.assertRaises(PermissionDenied, client.get, '/editor',
+                          headers={'X-User': 'admin'})
+        response = client.get('/editor', headers={'X-User': 'admin_editor'})
+        assert response.data == b'editor'
+
+    def test_table_is_introspectable(self):
+        table = self.principal.compile_endpoint_permissions(self.app)
+        assert table['admin'] == ((admin_permission, 403),)
+        assert set(table['editor']) == {
+            (admin_permission, None), (editor_permission, None)}
+        assert 'open_view' not in table
+        with self.app.app_context():
+            assert self.principal.endpoint_permissions is table
+
+    def test_wrapped_views_keep_their_permissions(self):
+        from functools import wraps
+        from flask.views import MethodView
+
+        def logged(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                return f(*args, **kwargs)
+            return decorated
+
+        @self.app.route('/wrapped')
+        @logged
+        @self.principal.permission_required(admin_permission, http_exception=403)
+        def wrapped():
+            return Response('wrapped')
+
+        @self.principal.permission_required(admin_permission, http_exception=403)
+        class Posts(MethodView):
+            def get(self):
+                return Response('posts')
+
+        self.app.add_url_rule('/posts', view_func=Posts.as_view('posts'))
+        table = self.principal.compile_endpoint_permissions(self.app)
+        assert 'wrapped' in table and 'posts' in table
+        client = self.app.test_client()
+        assert client.get('/wrapped').status_code == 403
+        assert client.get('/posts').status_code == 403
+        assert client.get('/posts', headers={'X-User': 'admin'}).data == b'posts'
+
+    def test_ignored_endpoints_with_permissions_are_rejected(self):
+        app = Flask(__name__)
+        principal = Principal(app, use_sessions=False,
+                              skip_blueprints=['internal'])
+        bp = Blueprint('internal', __name__)
+
+        @bp.route('/secret')
+        @principal.permission_required(admin_permission)
+        def secret():
+            return Response('secret')
+
+        app.register_blueprint(bp)
+        self.assertRaises(ValueError, principal.compile_endpoint_permissions, app)
+
+        app = Flask(__name__)
+        principal = Principal(app, use_sessions=False)
+
+        @app.route('/health')
+        @principal.exempt
+        @principal.permission_required(admin_permission)
+        def health():
+            return Response('OK')
+
+        self.assertRaises(ValueError, principal.compile_endpoint_permissions, app)
+
+    def test_ignored_paths_with_permissions_are_denied(self):
+        app = Flask(__name__)
+        principal = Principal(app, use_sessions=False, skip_paths=['/files/public'])
+
+        @app.route('/files/<path:name>')
+        @principal.permission_required(admin_permission, http_exception=403)
+        def files(name):
+            return Response(name)
+
+        client = app.test_client()
+        assert client.get('/files/public/a.txt').status_code == 403
+
+
+class PermissionRegistryTests(unittest.TestCase):
+
+    def test_allowed_for_matches_checking_every_permission(self):
+        rnd = random.Random(4)
+        roles = [RoleNeed(str(i)) for i in range(12)]
+
+        def permission(depth=0):
+            kind = rnd.choice(['need', 'need', 'denial', 'or', 'and', 'not',
+                               'custom'] if depth < 2 else ['need'])
+            if kind == 'need':
+                return Permission(*rnd.sample(roles, rnd.randint(0, 3)))
+            if kind == 'denial':
+                return Denial(*rnd.sample(roles, 2))
+            if kind == 'custom':
+                return RolenamePermission(rnd.choice(roles).value)
+            if kind == 'not':
+                return ~permission(depth + 1)
+            children = [permission(depth + 1) for _ in range(rnd.randint(1, 3))]
+            cls = OrPermission if kind == 'or' else AndPermission
+            return cls(*children)
+
+        registry = PermissionRegistry()
+        permissions = {}
+        for i in range(300):
+            permissions[str(i)] = registry.register(str(i), permission())
+
+        for _ in range(50):
+            identity = Identity('sam')
+            identity.provides.update(rnd.sample(roles, rnd.randint(0, 4)))
+            expected = [name for name, p in permissions.items()
+                        if p.allows(identity)]
+            assert registry.allowed_for(identity) == expected
+
+    def test_only_reachable_permissions_are_checked(self):
+        registry = PermissionRegistry()
+        registry.register('admin', admin_permission)
+        registry.register('editor', editor_permission)
+        registry.register('either', admin_permission | editor_permission)
+        registry.register('both', admin_permission & manager_permission)
+        registry.register('not admin', admin_denied)
+        identity = Identity('sam')
+        identity.provides.add(RoleNeed('admin'))
+        candidates = registry.candidates_for(identity)
+        assert {'admin', 'either', 'not admin'} <= candidates
+        assert 'editor' not in candidates
+        assert registry.allowed_for(identity) == ['admin', 'either']
+
+    def test_register_replaces_and_unregister_removes(self):
+        registry = PermissionRegistry()
+        registry.register('nav', admin_permission)
+        registry.register('nav', editor_permission)
+        identity = Identity('sam')
+        identity.provides.add(RoleNeed('editor'))
+        assert registry.allowed_for(identity) == ['nav']
+        registry.unregister('nav')
+        assert 'nav' not in registry and len(registry) == 0
+        assert registry.allowed_for(identity) == []
+
+
+class SqlFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute('CREATE TABLE posts (id INTEGER PRIMARY KEY)')
+        self.db.executemany('INSERT INTO posts VALUES (?)',
+                            [(i,) for i in range(20)])
+
+    def tearDown(self):
+        self.db.close()
+
+    def select(self, permission, identity, paramstyle='qmark'):
+        where, params = sql_filter(permission, 'posts.id', identity,
+                                   paramstyle=paramstyle)
+        rows = self.db.execute(
+            'SELECT id FROM posts WHERE ' + where + ' ORDER BY id', params)
+        return [row[0] for row in rows]
+
+    def expected(self, permission, identity):
+        return [i for i in range(20)
+                if bind_item(permission, i).allows(identity)]
+
+    def test_item_needs_become_in_clauses(self):
+        can_read = Permission(ItemNeed('read', ITEM, 'posts'))
+        identity = Identity('sam')
+        identity.provides.update([ItemNeed('read', 3, 'posts'),
+                                  ItemNeed('read', 7, 'posts'),
+                                  ItemNeed('write', 5, 'posts')])
+        where, params = sql_filter(can_read, 'posts.id', identity)
+        assert where == 'posts.id IN (?, ?)'
+        assert params == [3, 7]
+        assert self.select(can_read, identity) == [3, 7]
+
+    def test_static_needs_are_evaluated_first(self):
+        can_read = Permission(ItemNeed('read', ITEM, 'posts'), RoleNeed('admin'))
+        identity = Identity('sam')
+        assert sql_filter(can_read, 'posts.id', identity) == ('1 = 0', [])
+        identity.provides.add(RoleNeed('admin'))
+        assert sql_filter(can_read, 'posts.id', identity) == ('1 = 1', [])
+
+    def test_paramstyles(self):
+        can_read = Permission(ItemNeed('read', ITEM, 'posts'))
+        identity = Identity('sam')
+        identity.provides.add(ItemNeed('read', 4, 'posts'))
+        assert sql_filter(can_read, 'id', identity, paramstyle='format') \
+            == ('id IN (%s)', [4])
+        assert sql_filter(can_read, 'id', identity, paramstyle='named') \
+            == ('id IN (:p0)', {'p0': 4})
+        assert self.select(can_read, identity, paramstyle='named') == [4]
+        self.assertRaises(ValueError, sql_filter, can_read, 'id', identity,
+                          paramstyle='pyformat')
+
+    def test_composite_permissions_match_per_item_checks(self):
+        rnd = random.Random(42)
+        methods = ['read', 'write', 'delete']
+
+        def permission(depth=0):
+            kind = rnd.choice(['perm', 'perm', 'deny', 'or', 'and', 'not']
+                              if depth < 3 else ['perm', 'deny'])
+            if kind in ('perm', 'deny'):
+                needs = [ItemNeed(m, ITEM, 'posts')
+                         for m in rnd.sample(methods, rnd.randint(0, 2))]
+                needs += rnd.sample([RoleNeed('admin'), RoleNeed('editor')],
+                                    rnd.randint(0, 1))
+                return (Permission if kind == 'perm' else Denial)(*needs)
+            if kind == 'not':
+                return NotPermission(permission(depth + 1))
+            cls = OrPermission if kind == 'or' else AndPermission
+            return cls(*[permission(depth + 1) for _ in range(2)])
+
+        for _ in range(200):
+            identity = Identity('sam')
+            identity.provides.update(rnd.sample(
+                [RoleNeed('admin'), RoleNeed('editor')], rnd.randint(0, 2)))
+            identity.provides.update(
+                ItemNeed(rnd.choice(methods), rnd.randrange(20), 'posts')
+                for _ in range(rnd.randint(0, 12)))
+            p = permission()
+            assert self.select(p, identity) == self.expected(p, identity), p
+
+    def test_custom_permissions_are_evaluated_against_the_identity(self):
+        can_read = Permission(ItemNeed('read', ITEM, 'posts'))
+        identity = Identity('sam')
+        identity.provides.add(ItemNeed('read', 2, 'posts'))
+        either = OrPermission(can_read, RolenamePermission('admin'))
+        assert self.select(either, identity) == [2]
+        identity.provides.add(RoleNeed('admin'))
+        assert self.select(either, identity) == list(range(20))
+
+    def test_sqlalchemy_filter(self):
+        sa = pytest.importorskip('sqlalchemy')
+        engine = sa.create_engine('sqlite://')
+        posts = sa.Table('posts', sa.MetaData(),
+                         sa.Column('id', sa.Integer, primary_key=True))
+        posts.metadata.create_all(engine)
+        rnd = random.Random(3)
+        with engine.begin() as connection:
+            connection.execute(posts.insert(), [{'id': i} for i in range(20)])
+            can_read = Permission(ItemNeed('read', ITEM, 'posts'))
+            for permission in (can_read, Denial(ItemNeed('read', ITEM, 'posts')),
+                               can_read | admin_permission,
+                               can_read & ~Permission(ItemNeed('hide', ITEM, 'posts'))):
+                identity = Identity('sam')
+                identity.provides.update(
+                    ItemNeed(rnd.choice(['read', 'hide']), rnd.randrange(20), 'posts')
+                    for _ in range(8))
+                query = sa.select(posts.c.id).where(
+                    sqlalchemy_filter(permission, posts.c.id, identity)
+                ).order_by(posts.c.id)
+                assert list(connection.scalars(query)) == \
+                    self.expected(permission, identity)
+                assert list(connection.scalars(query)) == \
+                    self.select(permission, identity)
+
+    def test_provides_that_cannot_be_listed(self):
+        identity = Identity('sam')
+        identity.provides = CompactProvides([ItemNeed('read', 2, 'posts'),
+                                             RoleNeed('admin')])
+        can_read = Permission(ItemNeed('read', ITEM, 'posts'))
+        self.assertRaises(TypeError, sql_filter, can_read, 'id', identity)
+        assert sql_filter(admin_permission, 'id', identity) == ('1 = 1', [])
+
+
+class EvaluateAccessTests(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(7)
+        roles = [RoleNeed(r) for r in ('admin', 'editor', 'manager', 'viewer')]
+        self.identities = [
+            ('user%d' % i, rnd.sample(roles, rnd.randint(0, 3)))
+            for i in range(250)
+        ]
+        self.permissions = {
+            'admin': admin_permission,
+            'admin or editor': admin_or_editor,
+            'not admin': admin_denied,
+            'editor and manager': editor_permission & manager_permission,
+            'not viewer': ~Permission(RoleNeed('viewer')),
+            'anyone': anon_permission,
+        }
+
+    def expected(self, permissions=None):
+        permissions = permissions or self.permissions
+        rows = []
+        for identity_id, provides in self.identities:
+            identity = Identity(identity_id)
+            identity.provides.update(provides)
+            rows.append((identity_id, [name for name, p in permissions.items()
+                                       if p.allows(identity)]))
+        return rows
+
+    def test_in_process_matches_allows(self):
+        rows = evaluate_access(iter(self.identities), self.permissions,
+                               chunksize=16, processes=0)
+        assert list(rows) == self.expected()
+
+    def test_process_pool_keeps_order(self):
+        rows = evaluate_access(iter(self.identities), self.permissions,
+                               chunksize=10, processes=2)
+        assert list(rows) == self.expected()
+
+    def test_custom_permissions_and_registries(self):
+        registry = PermissionRegistry()
+        registry.register('viewer', RolenamePermission('viewer'))
+        registry.register('viewer or admin',
+                          RolenamePermission('viewer') | admin_permission)
+        rows = evaluate_access(self.identities, registry, processes=0)
+        assert list(rows) == self.expected(
+            {name: registry[name] for name in registry})
+
+    def test_identities_are_read_lazily(self):
+        read = []
+
+        def identities():
+            for row in self.identities:
+                read.append(row[0])
+                yield row
+
+        rows = evaluate_access(identities(), self.permissions,
+                               chunksize=10, processes=0)
+        next(rows)
+        assert len(read) == 10
+
+    def test_writers(self):
+        rows = [('ali', ['admin', 'anyone']), ('sam', [])]
+        out = io.StringIO(newline='')
+        assert write_access_csv(rows, out) == 2
+        assert out.getvalue().splitlines() == \
+            ['identity,permission', 'ali,admin', 'ali,anyone']
+        out = io.StringIO()
+        assert write_access_jsonl(rows, out) == 2
+        assert [json.loads(line) for line in out.getvalue().splitlines()] == [
+            {'identity': 'ali', 'permissions': ['admin', 'anyone']},
+            {'identity': 'sam', 'permissions': []},
+        ]
+
+
+class IdentityBoundTests(unittest.TestCase):
+
+    def identity(self, *roles):
+        identity = Identity('sam', 'token')
+        identity.provides.update(RoleNeed(role) for role in roles)
+        return identity
+
+    def test_checks_without_a_context(self):
+        identity = self.identity('editor')
+        assert admin_or_editor.allows_for(identity)
+        assert not admin_permission.allows_for(identity)
+        assert admin_or_editor.can(identity)
+        assert not admin_permission.can(identity=identity)
+        admin_or_editor.test(identity=identity)
+        self.assertRaises(PermissionDenied, admin_permission.test,
+                          identity=identity)
+
+    def test_require_with_identity(self):
+        identity = self.identity('editor')
+
+        @admin_permission.require(identity=identity)
+        def f():
+            return 'done'
+
+        self.assertRaises(PermissionDenied, f)
+        with editor_permission.require(identity=identity):
+            pass
+        assert editor_permission.require(identity=identity).identity is identity
+
+    def test_bound_identity_wins_over_the_request_identity(self):
+        app = Flask(__name__)
+        Principal(app, use_sessions=False)
+        with app.test_request_context():
+            g.identity = self.identity('admin')
+            assert admin_permission.can()
+            assert not admin_permission.can(self.identity('editor'))
+
+    def test_allows_for_uses_the_decision_cache(self):
+        cache = DecisionCache()
+        previous = set_decision_cache(cache)
+        try:
+            admin_permission.allows_for(self.identity('admin'))
+            admin_permission.allows_for(self.identity('admin').snapshot())
+        finally:
+            set_decision_cache(previous)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_snapshot_is_frozen(self):
+        identity = self.identity('admin')
+        snapshot = identity.snapshot()
+        assert isinstance(snapshot, IdentitySnapshot)
+        assert snapshot.fingerprint() == identity.fingerprint()
+        assert snapshot.snapshot() is snapshot
+        self.assertRaises(AttributeError, setattr, snapshot, 'id', 'ali')
+        assert isinstance(snapshot.provides, frozenset)
+        identity.provides.add(RoleNeed('editor'))
+        assert RoleNeed('editor') not in snapshot.provides
+
+    def test_snapshot_pickles(self):
+        snapshot = self.identity('admin', 'editor').snapshot()
+        copy = pickle.loads(pickle.dumps(snapshot))
+        assert copy == snapshot and copy is not snapshot
+        assert copy.fingerprint() == snapshot.fingerprint()
+        assert admin_permission.allows_for(copy)
+
+    def test_checks_in_worker_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        snapshot = self.identity('editor').snapshot()
+        permissions = [admin_permission, editor_permission, admin_or_editor]
+        with ThreadPoolExecutor(2) as executor:
+            results = list(executor.map(
+                lambda p: p.allows_for(snapshot), permissions))
+        assert results == [False, True, True]
+
+
+class TemplateHelpersTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app = Flask(__name__)
+        self.principal = Principal(app, use_sessions=False,
+                                   template_helpers=True)
+        self.checks = []
+        checks = self.checks
+
+        class CountingPermission(BasePermission):
+            def __init__(self, role):
+                self.role = role
+
+            def allows(self, identity):
+                checks.append(self.role)
+                return RoleNeed(self.role) in identity.provides
+
+        self.counting = CountingPermission
+
+    def render(self, source, roles, **context):
+        with self.app.test_request_context():
+            identity = Identity('sam')
+            identity.provides.update(RoleNeed(role) for role in roles)
+            g.identity = identity
+            return render_template_string(source, **context)
+
+    def test_can_test_and_global(self):
+        source = ('{% if admin is can %}admin{% endif %}'
+                  '{% if can(editor) %} editor{% endif %}')
+        assert self.render(source, ['editor'], admin=admin_permission,
+                           editor=editor_permission) == ' editor'
+
+    def test_decisions_are_kept_for_the_request(self):
+        admin = self.counting('admin')
+        source = '{% for i in range(5) %}{{ admin is can }}{% endfor %}'
+        assert self.render(source, ['admin'], admin=admin) == 'True' * 5
+        assert self.checks == ['admin']
+
+    def test_equal_permissions_share_decisions(self):
+        source = '{{ can(a) }} {{ can(b) }}'
+        first, second = Permission(RoleNeed('admin')), Permission(RoleNeed('admin'))
+        assert self.render(source, ['admin'], a=first, b=second) == 'True True'
+
+    def test_prefetch(self):
+        admin, editor = self.counting('admin'), self.counting('editor')
+        source = ('{{ prefetch_permissions(admin, editor) }}'
+                  '{% for i in range(3) %}'
+                  '{{ can(admin) }},{{ editor is can }};'
+                  '{% endfor %}')
+        assert self.render(source, ['editor'], admin=admin, editor=editor) \
+            == 'False,True;' * 3
+        assert self.checks == ['admin', 'editor']
+
+    def test_decisions_reset_when_the_identity_changes(self):
+        admin = self.counting('admin')
+        with self.app.test_request_context():
+            g.identity = Identity('sam')
+            assert render_template_string('{{ can(p) }}', p=admin) == 'False'
+            g.identity.provides.add(RoleNeed('admin'))
+            assert render_template_string('{{ can(p) }}', p=admin) == 'True'
+            g.identity = Identity('sam')
+            assert render_template_string('{{ can(p) }}', p=admin) == 'False'
+        assert self.checks == ['admin'] * 3
+
+    def test_helpers_are_opt_in(self):
+        app = Flask(__name__)
+        Principal(app, use_sessions=False)
+        assert 'can' not in app.jinja_env.tests
+        assert 'prefetch_permissions' not in app.jinja_env.globals
+
+
+class PredicateNeedTests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def predicate(self, name, result, cost=1):
+        def f(identity):
+            self.calls.append(name)
+            return result
+        return PredicateNeed(f, cost=cost, name=name)
+
+    def identity(self, *roles):
+        identity = Identity('sam')
+        identity.provides.update(RoleNeed(role) for role in roles)
+        return identity
+
+    def test_static_needs_decide_first(self):
+        office = self.predicate('office', True)
+        p = Permission(RoleNeed('admin'), office)
+        assert p.allows(self.identity('admin'))
+        assert self.calls == []
+        assert p.allows(self.identity())
+        assert self.calls == ['office']
+
+    def test_static_excludes_decide_first(self):
+        office = self.predicate('office', True)
+        p = Permission(office)
+        p.perms[RoleNeed('banned')] = False
+        assert not p.allows(self.identity('banned'))
+        assert self.calls == []
+
+    def test_predicate_excludes(self):
+        night = self.predicate('night', True)
+        p = Permission(RoleNeed('admin'))
+        p.perms[night] = False
+        assert not p.allows(self.identity('admin'))
+        assert Denial(self.predicate('day', False)).allows(self.identity())
+
+    def test_cheapest_predicates_first(self):
+        p = Permission(self.predicate('slow', True, cost=10),
+                       self.predicate('fast', True, cost=1),
+                       self.predicate('medium', True, cost=5))
+        assert p.allows(self.identity())
+        assert self.calls == ['fast']
+
+    def test_composites_check_cheapest_first(self):
+        slow = Permission(self.predicate('slow', True, cost=10))
+        p = OrPermission(slow, admin_permission,
+                         Permission(self.predicate('fast', False)))
+        assert p.allows(self.identity('admin'))
+        assert self.calls == []
+        assert not (slow & admin_permission).allows(self.identity())
+        assert self.calls == []
+
+    def test_memoized_per_request(self):
+        app = Flask(__name__)
+        office = self.predicate('office', True)
+        p = Permission(office)
+        identity = self.identity()
+        with app.test_request_context():
+            assert p.allows(identity) and p.allows(identity)
+            assert Permission(RoleNeed('editor'), office).allows(identity)
+        assert self.calls == ['office']
+        with app.test_request_context():
+            assert p.allows(identity)
+        assert self.calls == ['office', 'office']
+
+    def test_memo_is_kept_by_identity(self):
+        app = Flask(__name__)
+        alice = PredicateNeed(lambda identity: identity.id == 'alice')
+        p = Permission(alice)
+        with app.test_request_context():
+            results = [p.allows(Identity(name))
+                       for name in ('alice', 'bob', 'carol')]
+        assert results == [True, False, False]
+
+    def test_not_cached_or_indexed(self):
+        p = Permission(RoleNeed('admin'), self.predicate('office', True))
+        assert p.cache_key() is None
+        assert (p | admin_permission).cache_key() is None
+        registry = PermissionRegistry()
+        registry.register('office', p)
+        assert registry.allowed_for(self.identity()) == ['office']
+
+    def test_sql_filter_evaluates_predicates(self):
+        p = Permission(ItemNeed('read', ITEM, 'posts'),
+                       self.predicate('office', True))
+        assert sql_filter(p, 'id', self.identity()) == ('1 = 1', [])
+
+
+class ExpiringNeedsTests(unittest.TestCase):
+
+    def test_grant_and_purge(self):
+        provides = Provides([RoleNeed('editor')])
+        now = time.time()
+        provides.grant(RoleNeed('admin'), expires_at=now + 10)
+        provides.grant(RoleNeed('manager'), ttl=60)
+        assert RoleNeed('admin') in provides
+        assert provides.expiry(RoleNeed('admin')) == now + 10
+        assert provides.expiry(RoleNeed('editor')) is None
+        assert provides.expires_at() == now + 10
+        assert provides.purge(now + 5) == 0
+        assert provides.purge(now + 30) == 1
+        assert provides == {RoleNeed('editor'), RoleNeed('manager')}
+        assert provides.fingerprint() == \
+            Provides([RoleNeed('editor'), RoleNeed('manager')]).fingerprint()
+        self.assertRaises(TypeError, provides.grant, RoleNeed('admin'))
+
+    def test_regrant_add_and_remove(self):
+        provides = Provides()
+        now = time.time()
+        provides.grant(RoleNeed('admin'), expires_at=now + 10)
+        provides.grant(RoleNeed('admin'), expires_at=now + 100)
+        assert provides.purge(now + 50) == 0
+        assert provides.expires_at() == now + 100
+        provides.add(RoleNeed('admin'))
+        assert provides.expiring() == {}
+        assert provides.purge(now + 200) == 0
+        provides.grant(RoleNeed('editor'), expires_at=now + 10)
+        provides.discard(RoleNeed('editor'))
+        assert provides.expires_at() is None
+        provides.update([RoleNeed('editor')])
+        assert provides.purge(now + 200) == 0
+        assert provides == {RoleNeed('admin'), RoleNeed('editor')}
+
+    def test_copies_keep_expiries(self):
+        provides = Provides()
+        provides.grant(RoleNeed('admin'), ttl=60)
+        for other in (provides.copy(), pickle.loads(pickle.dumps(provides))):
+            assert other.expiring() == provides.expiring()
+
+    def test_expired_needs_drop_out_of_permissions(self):
+        identity = Identity('sam')
+        identity.provides.grant(RoleNeed('admin'), expires_at=time.time() - 1)
+        identity.provides.grant(RoleNeed('editor'), ttl=60)
+        assert not admin_permission.allows(identity)
+        assert editor_permission.allows(identity)
+
+    def test_expired_needs_drop_out_when_touched(self):
+        def identity():
+            identity = Identity('sam')
+            identity.provides.grant(RoleNeed('admin'), expires_at=time.time() - 1)
+            identity.provides.grant(ItemNeed('read', 5, 'posts'),
+                                    expires_at=time.time() - 1)
+            identity.provides.add(RoleNeed('user'))
+            return identity
+
+        assert RoleNeed('admin') not in identity().provides
+        assert list(identity().provides) == [RoleNeed('user')]
+        assert not RolenamePermission('admin').allows(identity())
+        can_read = Permission(ItemNeed('read', ITEM, 'posts'))
+        assert sql_filter(can_read, 'id', identity()) == ('1 = 0', [])
+        assert identity().snapshot().provides == {RoleNeed('user')}
+        assert identity().provides.expiring() == {}
+
+    def test_cached_provisions_expire_with_the_first_need(self):
+        cache = ProvisionCache(ttl=60)
+        now = time.time()
+        provides = frozenset([RoleNeed('admin'), RoleNeed('editor')])
+        cache.set('fresh', provides, {RoleNeed('admin'): now + 60})
+        cache.set('expired', provides, {RoleNeed('admin'): now - 1})
+        assert cache.get('fresh', fresh=True) == provides
+        assert cache.get('expired', fresh=True) is None
+        assert cache.get('expired') == {RoleNeed('editor')}
+
+    def test_principal_caches_expiries(self):
+        app = Flask(__name__)
+        cache = ProvisionCache(ttl=60)
+        principal = Principal(app, use_sessions=False, provision_cache=cache)
+        principal.identity_loader(lambda: Identity('sam'))
+        calls = []
+
+        def on_loaded(sender, identity):
+            calls.append(identity.id)
+            identity.provides.grant(RoleNeed('admin'), ttl=0.05)
+
+        @app.route('/')
+        def index():
+            return Response(str(sorted(n.value for n in g.identity.provides)))
+
+        identity_loaded.connect(on_loaded, app)
+        try:
+            client = app.test_client()
+            assert client.get('/').data == b"['admin']"
+            assert client.get('/').data == b"['admin']"
+            assert calls == ['sam']
+            time.sleep(0.06)
+            client.get('/')
+            assert calls == ['sam', 'sam']
+        finally:
+            identity_loaded.disconnect(on_loaded, app)
+
+
+    def test_reused_provisions_keep_their_expiries(self):
+        app = Flask(__name__)
+        cache = ProvisionCache(ttl=60)
+        principal = Principal(app, use_sessions=False, provision_cache=cache,
+                              anonymous_provisions=True)
+        expiries = []
+
+        def on_loaded(sender, identity):
+            identity.provides.grant(RoleNeed('admin'), ttl=0.05)
+            identity.provides_for('acme').grant(RoleNeed('editor'), ttl=0.05)
+            identity.tenant = 'acme'
+
+        @app.route('/<name>')
+        def index(name):
+            if name != 'anonymous':
+                identity_changed.send(app, identity=Identity(name))
+                identity_changed.send(app, identity=Identity(name))
+            expiries.append(g.identity.provides.expiry(RoleNeed('admin')))
+            time.sleep(0.06)
+            return Response('{0} {1}'.format(
+                Permission(RoleNeed('admin')).can(),
+                Permission(RoleNeed('editor')).can()))
+
+        identity_loaded.connect(on_loaded, app)
+        try:
+            client = app.test_client()
+            assert client.get('/anonymous').data == b'False False'
+            assert client.get('/sam').data == b'False False'
+            assert client.get('/anonymous').data == b'False False'
+            with app.test_request_context():
+                cache.set(('cached',), frozenset([RoleNeed('admin')]),
+                          {RoleNeed('admin'): time.time() + 0.05})
+                identity = Identity('sam')
+                principal._set_thread_identity(identity, ('cached',))
+                assert identity.provides.expiry(RoleNeed('admin')) is not None
+                time.sleep(0.06)
+                assert not identity.can(Permission(RoleNeed('admin')))
+        finally:
+            identity_loaded.disconnect(on_loaded, app)
+        assert None not in expiries[:2]
+
+class TenantTests(unittest.TestCase):
+
+    def identity(self, tenant=None):
+        identity = Identity('sam')
+        identity.provides.add(RoleNeed('user'))
+        identity.provides_for('acme').add(RoleNeed('admin'))
+        identity.provides_for('globex').add(RoleNeed('editor'))
+        identity.tenant = tenant
+        return identity
+
+    def test_only_the_active_partition_is_checked(self):
+        user = Permission(RoleNeed('user'))
+        for tenant, admin, editor in ((None, False, False),
+                                      ('acme', True, False),
+                                      ('globex', False, True),
+                                      ('initech', False, False)):
+            identity = self.identity(tenant)
+            assert admin_permission.allows(identity) is admin
+            assert editor_permission.allows(identity) is editor
+            assert user.allows(identity)
+        identity = self.identity('acme')
+        assert not admin_denied.allows(identity)
+        assert admin_denied.allows(self.identity('globex'))
+
+    def test_fingerprints_and_snapshots(self):
+        acme, globex = self.identity('acme'), self.identity('globex')
+        assert acme.fingerprint() != globex.fingerprint()
+        assert self.identity().fingerprint() == \
+            Provides([RoleNeed('user')]).fingerprint()
+        snapshot = acme.snapshot()
+        assert snapshot.provides == {RoleNeed('user'), RoleNeed('admin')}
+
+    def test_decision_cache_keeps_tenants_apart(self):
+        previous = set_decision_cache(DecisionCache())
+        try:
+            assert self.identity('acme').can(admin_permission)
+            assert not self.identity('globex').can(admin_permission)
+        finally:
+            set_decision_cache(previous)
+
+    def test_registry_partitions(self):
+        registry = PermissionRegistry()
+        registry.register('user', Permission(RoleNeed('user')))
+        registry.for_tenant('acme').register('billing', admin_permission)
+        registry.for_tenant('globex').register('billing', editor_permission)
+        registry.for_tenant('globex').register('posts', editor_permission)
+        assert registry.allowed_for(self.identity()) == ['user']
+        assert registry.allowed_for(self.identity('acme')) == ['user', 'billing']
+        assert registry.allowed_for(self.identity('globex')) == \
+            ['user', 'billing', 'posts']
+        assert 'billing' not in registry
+
+    def test_principal_resolves_tenants(self):
+        app = Flask(__name__)
+        cache = ProvisionCache(ttl=60)
+        principal = Principal(
+            app, use_sessions=False, provision_cache=cache,
+            tenant_resolver=lambda: request.headers.get('X-Tenant'))
+        principal.identity_loader(lambda: Identity('sam'))
+        calls = []
+
+        def on_loaded(sender, identity):
+            calls.append(identity.tenant)
+            if identity.tenant == 'acme':
+                identity.provides_for('acme').add(RoleNeed('admin'))
+
+        @app.route('/')
+        def index():
+            return Response('{0} {1}'.format(
+                g.identity.tenant, admin_permission.can()))
+
+        identity_loaded.connect(on_loaded, app)
+        try:
+            client = app.test_client()
+            for _ in range(2):
+                assert client.get('/', headers={'X-Tenant': 'acme'}).data == \
+                    b'acme True'
+                assert client.get('/', headers={'X-Tenant': 'globex'}).data == \
+                    b'globex False'
+            assert calls == ['acme', 'globex']
+        finally:
+            identity_loaded.disconnect(on_loaded, app)
+
+    def test_unchanged_identity_adopts_partitions(self):
+        app = Flask(__name__)
+        principal = Principal(app, use_sessions=False,
+                              tenant_resolver=lambda: 'acme')
+
+        def on_loaded(sender, identity):
+            identity.provides_for('acme').add(RoleNeed('admin'))
+
+        identity_loaded.connect(on_loaded, app)
+        try:
+            with app.test_request_context():
+                first = Identity('sam')
+                principal.set_identity(first)
+                second = Identity('sam')
+                principal.set_identity(second)
+                assert g.identity is second
+                assert admin_permission.can()
+        finally:
+            identity_loaded.disconnect(on_loaded, app)
+
+
+class CompactProvidesTests(unittest.TestCase):
+
+    def needs(self, n=2000):
+        return [ItemNeed('read', i, 'posts') for i in range(n)] + [RoleNeed('user')]
+
+    def test_membership(self):
+        provides = CompactProvides(self.needs())
+        assert len(provides) == 2001
+        assert ItemNeed('read', 1999, 'posts') in provides
+        assert RoleNeed('user') in provides
+        assert ItemNeed('read', 2000, 'posts') not in provides
+        assert ItemNeed('write', 1, 'posts') not in provides
+        assert provides.contains_any([RoleNeed('admin'), RoleNeed('user')])
+        assert not provides.contains_any([RoleNeed('admin')])
+        assert not provides.contains_any([])
+
+    def test_digest_collisions_are_not_granted(self):
+        class Slug(str):
+            def __repr__(self):
+                return "'x'"
+
+        class Tag(object):
+            def __repr__(self):
+                return 'Tag'
+
+        tag = Tag()
+        granted = ItemNeed('read', Slug('y'), 'posts')
+        colliding = ItemNeed('read', 'x', 'posts')
+        assert _need_digest(granted) == _need_digest(colliding)
+        assert _need_digest(tag) == _need_digest(Tag())
+        provides = CompactProvides([granted, tag, RoleNeed('user')])
+        assert granted in provides and tag in provides
+        assert colliding not in provides and Tag() not in provides
+        assert not Permission(colliding).allows_for(IdentitySnapshot('sam', provides=provides))
+        assert len(provides) == 3
+        assert provides.fingerprint() == Provides([granted, tag, RoleNeed('user')]).fingerprint()
+        changed = provides.with_changes(add=[colliding], remove=[granted, tag])
+        assert colliding in changed and granted not in changed and tag not in changed
+        self.assertRaises(TypeError, provides.save, io.BytesIO())
+
+    def test_fingerprint_matches_provides(self):
+        needs = self.needs(100)
+        assert CompactProvides(needs).fingerprint() == Provides(needs).fingerprint()
+        identity = Identity('sam')
+        identity.provides = CompactProvides(needs)
+        assert identity.fingerprint() == Provides(needs).fingerprint()
+
+    def test_permissions(self):
+        identity = Identity('sam')
+        identity.provides = CompactProvides(self.needs())
+        assert Permission(ItemNeed('read', 7, 'posts')).allows(identity)
+        assert not Permission(ItemNeed('read', -7, 'posts')).allows(identity)
+        assert not Denial(RoleNeed('user')).allows(identity)
+        assert (Permission(RoleNeed('user')) & ~admin_permission).allows(identity)
+        snapshot = pickle.loads(pickle.dumps(identity.snapshot()))
+        assert Permission(ItemNeed('read', 7, 'posts')).allows_for(snapshot)
+
+    def test_sets_are_not_iterated(self):
+        class Unlisted(Provides):
+            def __iter__(self):
+                raise AssertionError('iterated')
+
+        identity = Identity('sam')
+        identity.provides.update(self.needs())
+        identity.provides.__class__ = Unlisted
+        assert Permission(RoleNeed('user')).allows(identity)
+        assert not Permission(RoleNeed('admin')).allows(identity)
+        assert not Denial(RoleNeed('user')).allows(identity)
+
+    def test_with_changes(self):
+        provides = CompactProvides([RoleNeed('user'), RoleNeed('editor')])
+        changed = provides.with_changes(add=[RoleNeed('admin')],
+                                        remove=[RoleNeed('editor')])
+        assert changed.fingerprint() == \
+            Provides([RoleNeed('user'), RoleNeed('admin')]).fingerprint()
+        assert RoleNeed('editor') in provides
+
+    def test_principal_caches_compact_provisions(self):
+        app = Flask(__name__)
+        cache = ProvisionCache(ttl=60)
+        principal = Principal(app, use_sessions=False, provision_cache=cache)
+        principal.identity_loader(lambda: Identity('sam'))
+        calls = []
+
+        def on_loaded(sender, identity):
+            calls.append(identity.id)
+            identity.provides = CompactProvides(self.needs(10))
+
+        @app.route('/<int:post>')
+        def index(post):
+            return Response(str(Permission(ItemNeed('read', post, 'posts')).can()))
+
+        identity_loaded.connect(on_loaded, app)
+        try:
+            client = app.test_client()
+            assert client.get('/3').data == b'True'
+            assert client.get('/30').data == b'False'
+            assert calls == ['sam']
+            with app.test_request_context():
+                principal.update_provisions('sam', add=[ItemNeed('read', 30, 'posts')])
+            assert client.get('/30').data == b'True'
+        finally:
+            identity_loaded.disconnect(on_loaded, app)
+
+
+class LazyProvidesTests(unittest.TestCase):
+
+    needs = [ItemNeed('read', i, 'posts') for i in range(500)] + [RoleNeed('user')]
+
+    def sqlite_provides(self):
+        store = SQLiteNeedStore(sqlite3.connect(':memory:'))
+        store.grant('sam', self.needs)
+        store.grant('ali', [RoleNeed('admin')])
+        return store, store.provides('sam')
+
+    def mapped_provides(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wb') as f:
+            CompactProvides(self.needs).save(f)
+        mapped = MappedNeedFile(path)
+        self.addCleanup(mapped.close)
+        return mapped.provides()
+
+    def check_backend(self, provides):
+        assert ItemNeed('read', 499, 'posts') in provides
+        assert ItemNeed('read', 500, 'posts') not in provides
+        assert RoleNeed('admin') not in provides
+        assert len(provides) == 501
+        assert provides.fingerprint() == Provides(self.needs).fingerprint()
+
+        identity = Identity('sam')
+        identity.provides = provides.copy()
+        permission = Permission(*[ItemNeed('read', -i, 'posts') for i in range(1, 50)]
+                                + [RoleNeed('user')])
+        assert permission.allows(identity)
+        assert identity.provides.lookups == 1
+        assert permission.allows(identity)
+        assert Denial(RoleNeed('admin')).allows(identity)
+        assert identity.provides.lookups == 2
+        assert identity.fingerprint() == Provides(self.needs).fingerprint()
+
+    def test_sqlite(self):
+        store, provides = self.sqlite_provides()
+        self.check_backend(provides)
+        store.revoke('sam', [RoleNeed('user'), RoleNeed('nobody')])
+        assert RoleNeed('user') not in store.provides('sam')
+        assert store.provides('sam').fingerprint() == \
+            Provides(self.needs[:-1]).fingerprint()
+        assert store.provides('ali').fingerprint() == \
+            Provides([RoleNeed('admin')]).fingerprint()
+        assert len(store.provides('nobody')) == 0
+
+    def test_concurrent_changes(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        SQLiteNeedStore(sqlite3.connect(path)).connection.close()
+
+        def grant(start):
+            connection = sqlite3.connect(path, timeout=30)
+            store = SQLiteNeedStore(connection)
+            for need in self.needs[start:start + 100]:
+                store.grant('sam', [need])
+            connection.close()
+
+        threads = [threading.Thread(target=grant, args=(i * 100,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        provides = SQLiteNeedStore(sqlite3.connect(path)).provides('sam')
+        assert len(provides) == 400
+        assert provides.fingerprint() == Provides(self.needs[:400]).fingerprint()
+        provides.backend.store.connection.close()
+
+    def test_mapped_file(self):
+        self.check_backend(self.mapped_provides())
+
+    def test_digest_collisions_are_not_granted(self):
+        class Slug(str):
+            def __repr__(self):
+                return "'x'"
+
+        granted = ItemNeed('read', Slug('y'), 'posts')
+        colliding = ItemNeed('read', 'x', 'posts')
+        assert _need_digest(granted) == _need_digest(colliding)
+        self.needs = [granted]
+        store, provides = self.sqlite_provides()
+        for provides in provides, self.mapped_provides():
+            assert granted in provides and colliding not in provides
+            changed = provides.with_changes(add=[colliding], remove=[granted])
+            assert colliding in changed and granted not in changed
+            assert changed.fingerprint() == Provides([colliding]).fingerprint()
+        store.grant('sam', [colliding])
+        assert colliding in store.provides('sam')
+        assert len(store.provides('sam')) == 2
+        self.assertRaises(TypeError, store.grant, 'sam', [object()])
+
+    def test_cannot_be_snapshotted(self):
+        identity = Identity('sam')
+        identity.provides = self.mapped_provides()
+        self.assertRaises(TypeError, identity.snapshot)
+        self.assertRaises(TypeError, IdentitySnapshot, 'sam', provides=identity.provides)
+        identity.provides_for('acme').add(RoleNeed('admin'))
+        identity.tenant = 'acme'
+        self.assertRaises(TypeError, identity.snapshot)
+
+    def test_lookaside_is_bounded(self):
+        provides = LazyProvides(self.mapped_provides().backend, maxsize=10)
+        for i in range(30):
+            assert ItemNeed('read', i, 'posts') in provides
+        assert len(provides._known) <= 10
+
+    def test_with_changes(self):
+        store, provides = self.sqlite_provides()
+        changed = provides.with_changes(add=[RoleNeed('admin')],
+                                        remove=[RoleNeed('user')])
+        assert RoleNeed('admin') in changed and RoleNeed('user') not in changed
+        assert RoleNeed('user') in provides
+        assert changed.fingerprint() == \
+            Provides(self.needs[:-1] + [RoleNeed('admin')]).fingerprint()
+
+    def test_fingerprint_is_read_once(self):
+        store, provides = self.sqlite_provides()
+        queries = []
+        store.connection.set_trace_callback(queries.append)
+        app = Flask(__name__)
+        identity = Identity('sam')
+        identity.provides = provides.with_changes(add=[RoleNeed('admin')])
+        permission = Permission(RoleNeed('user'))
+        with app.test_request_context():
+            for _ in range(10):
+                assert identity.can(permission)
+            assert len(identity.provides) == 502
+        assert len(queries) == 3
+
+    def test_registry_looks_up_needs_in_one_query(self):
+        registry = PermissionRegistry()
+        for i in range(50):
+            registry.register(str(i), Permission(ItemNeed('read', i * 20, 'posts')))
+        store, provides = self.sqlite_provides()
+        identity = Identity('sam')
+        identity.provides = provides
+        assert registry.allowed_for(identity) == [str(i) for i in range(25)]
+        assert provides.lookups == 1
+
+    def test_principal_gives_each_request_its_lookaside(self):
+        app = Flask(__name__)
+        cache = ProvisionCache(ttl=60)
+        principal = Principal(app, use_sessions=False, provision_cache=cache)
+        principal.identity_loader(lambda: Identity('sam'))
+        store, provides = self.sqlite_provides()
+        seen = []
+
+        def on_loaded(sender, identity):
+            identity.provides = provides
+
+        @app.route('/<int:post>')
+        def index(post):
+            seen.append(g.identity.provides)
+            return Response(str(Permission(ItemNeed('read', post, 'posts')).can()))
+
+        identity_loaded.connect(on_loaded, app)
+        try:
+            client = app.test_client()
+            assert client.get('/3').data == b'True'
+            assert client.get('/700').data == b'False'
+            assert seen[0] is provides and seen[1] is not provides
+            assert seen[1].lookups == 1
+        finally:
+            identity_loaded.disconnect(on_loaded, app)